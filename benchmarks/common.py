@@ -0,0 +1,110 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# vim: ai ts=4 sts=4 et sw=4 nu
+
+''' helpers shared by benchmark scripts '''
+
+from __future__ import (unicode_literals, absolute_import,
+                        division, print_function)
+
+import os
+import sys
+import time
+import random
+import datetime
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def setup():
+    ''' configure Django with the benchmark settings '''
+    if ROOT not in sys.path:
+        sys.path.insert(0, ROOT)
+    os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'benchmarks.settings')
+    import django
+    django.setup()
+
+
+def migrate(target=None):
+    from django.core.management import call_command
+    args = ['orangeapisms', target] if target else []
+    call_command('migrate', *args, verbosity=0, interactive=False)
+
+
+def truncate():
+    ''' removes all SMSMessage, without loading them '''
+    from django.db import connection
+    from orangeapisms.models import SMSMessage
+    with connection.cursor() as cursor:
+        cursor.execute("DELETE FROM {}".format(
+            connection.ops.quote_name(SMSMessage._meta.db_table)))
+
+
+def populate(rows, chunk_size=10000, days=365, seed=0):
+    ''' inserts `rows` random SMSMessage spread over `days`
+
+        without rollups: their table may not exist yet (see migrate) '''
+    from orangeapisms.config import get_config, update_config
+
+    rollups_enabled = get_config('rollups_enabled')
+    update_config({'rollups_enabled': False})
+    try:
+        return insert_random(rows, chunk_size, days, seed)
+    finally:
+        update_config({'rollups_enabled': rollups_enabled})
+
+
+def insert_random(rows, chunk_size, days, seed):
+    from django.utils import timezone
+    from orangeapisms.models import SMSMessage
+
+    rand = random.Random(seed)
+    now = timezone.now()
+    statuses = list(SMSMessage.STATUSES.keys())
+    done = 0
+    while done < rows:
+        batch = []
+        for index in range(done, min(done + chunk_size, rows)):
+            incoming = rand.random() < 0.3
+            batch.append(SMSMessage(
+                direction=SMSMessage.INCOMING if incoming
+                else SMSMessage.OUTGOING,
+                sms_type=SMSMessage.MO if incoming
+                else rand.choice([SMSMessage.MT, SMSMessage.DR]),
+                status=SMSMessage.RECEIVED if incoming
+                else rand.choice(statuses),
+                created_on=now - datetime.timedelta(
+                    seconds=rand.randint(0, days * 86400)),
+                sender_address='+2237{:07d}'.format(rand.randint(0, 10 ** 6)),
+                destination_address='+22300000',
+                message_id='mo{}'.format(index) if incoming else None,
+                reference_code=None if incoming else 'ref{}'.format(index),
+                content="Benchmark message #{}".format(index)))
+        SMSMessage.objects.bulk_create(batch)
+        done += len(batch)
+    return done
+
+
+def explain(queryset):
+    ''' database query plan of a QuerySet, as text '''
+    from django.db import connection
+    sql, params = queryset.query.sql_with_params()
+    prefix = {
+        'sqlite': 'EXPLAIN QUERY PLAN ',
+        'postgresql': 'EXPLAIN ANALYZE ',
+    }.get(connection.vendor, 'EXPLAIN ')
+    with connection.cursor() as cursor:
+        cursor.execute(prefix + sql, params)
+        return "\n".join(" ".join("{}".format(col) for col in row)
+                         for row in cursor.fetchall())
+
+
+def timeit(func, repeat=3):
+    ''' best duration (seconds) of `repeat` calls to func '''
+    best = None
+    for _ in range(repeat):
+        started = time.time()
+        func()
+        duration = time.time() - started
+        best = duration if best is None else min(best, duration)
+    return best
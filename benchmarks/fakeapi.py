@@ -0,0 +1,80 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# vim: ai ts=4 sts=4 et sw=4 nu
+
+''' in-process fake Orange API (a requests transport adapter) '''
+
+from __future__ import (unicode_literals, absolute_import,
+                        division, print_function)
+
+import time
+import itertools
+
+import simplejson
+import requests
+from requests.adapters import BaseAdapter
+
+
+class FakeOrangeAPI(BaseAdapter):
+    ''' answers token, SMS-MT, contracts and subscriptions requests
+
+        latency (seconds) is added to every response '''
+
+    def __init__(self, latency=0, units=10 ** 9):
+        super(FakeOrangeAPI, self).__init__()
+        self.latency = latency
+        self.units = units
+        self.counter = itertools.count()
+
+    def route(self, request):
+        ''' (status code, JSON body) for request '''
+        url = request.url.split('?', 1)[0]
+        if url.endswith('/token'):
+            return 200, {'token_type': 'Bearer', 'expires_in': '3600',
+                         'access_token': 'fake{}'.format(next(self.counter))}
+        if '/outbound/' in url and url.endswith('/requests'):
+            return 201, {'outboundSMSMessageRequest': {
+                'resourceURL': '{}/{}'.format(url, next(self.counter))}}
+        if url.endswith('/contracts'):
+            return 200, {'partnerContracts': {'contracts': [{
+                'service': 'SMS_OCB',
+                'serviceContracts': [{
+                    'country': 'MLI', 'service': 'SMS_OCB',
+                    'availableUnits': self.units,
+                    'expires': '2100-01-01T00:00:00'}]}]}}
+        if '/subscriptions' in url:
+            if request.method == 'DELETE':
+                return 204, None
+            return 201, {'deliveryReceiptSubscription': {
+                'callbackReference': {'notifyURL': 'http://localhost/smsdr'},
+                'resourceURL': '{}/{}'.format(url, next(self.counter))}}
+        return 404, {'requestError': {'serviceException': {
+            'messageId': 'SVC0001', 'text': 'Unknown resource %1',
+            'variables': url}}}
+
+    def send(self, request, **kwargs):
+        if self.latency:
+            time.sleep(self.latency)
+        status, body = self.route(request)
+
+        response = requests.Response()
+        response.request = request
+        response.url = request.url
+        response.status_code = status
+        response.headers['Content-Type'] = 'application/json'
+        response._content = simplejson.dumps(body).encode('utf-8') \
+            if body is not None else b''
+        return response
+
+    def close(self):
+        pass
+
+
+def install(**kwargs):
+    ''' route API calls of the shared session to a new FakeOrangeAPI '''
+    from orangeapisms import client
+    adapter = FakeOrangeAPI(**kwargs)
+    session = client.get_session()
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
+    return adapter
@@ -0,0 +1,248 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# vim: ai ts=4 sts=4 et sw=4 nu
+
+''' throughput of send and webhook hot paths, against a fake API
+
+    python benchmarks/hot_paths.py         # compare to baseline.json
+    python benchmarks/hot_paths.py --save  # store new baseline '''
+
+from __future__ import (unicode_literals, absolute_import,
+                        division, print_function)
+
+import os
+import sys
+import uuid
+import random
+import logging
+import platform
+import argparse
+import tempfile
+import itertools
+from collections import OrderedDict
+
+import simplejson
+
+try:
+    from benchmarks import common, fakeapi, msisdn
+except ImportError:
+    import common
+    import fakeapi
+    import msisdn
+
+BASELINE = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                        'baseline.json')
+
+
+def configure():
+    from orangeapisms.config import update_config
+    update_config({
+        'client_id': 'bench', 'client_secret': 'bench',
+        'token_store': 'file',
+        'token_file': os.path.join(tempfile.mkdtemp(), 'token.json'),
+        'country_prefix': '223', 'fix_msisdn': True,
+        'send_async': False, 'handler_dispatch': 'inline',
+        'write_behind': False, 'gsm7_transliterate': False,
+    })
+
+
+def bench_send_sms(db_save):
+    from orangeapisms.utils import send_sms
+
+    def run(count):
+        for index in range(count):
+            send_sms('7{:07d}'.format(index), "Benchmark message",
+                     as_addr='+22300000', db_save=db_save)
+    return run
+
+
+def bench_mt_payload(count):
+    from orangeapisms.utils import mt_payload
+    for index in range(count):
+        mt_payload('+2237{:07d}'.format(index), "Benchmark message",
+                   sender_address='+22300000', sender_name='Bench',
+                   callback_data=uuid.uuid4().hex)
+
+
+def bench_cleaned_msisdn(count):
+    from orangeapisms.utils import cleaned_msisdn
+    for number in msisdn.numbers(count):
+        cleaned_msisdn(number)
+
+
+def bench_request_token(count):
+    from orangeapisms.utils import request_token
+    for _ in range(count):
+        request_token()
+
+
+_ids = itertools.count()
+
+
+def mo_payload():
+    return {'inboundSMSMessageNotification': {'inboundSMSMessage': {
+        'senderAddress': 'tel:+2237{:07d}'.format(random.randint(0, 10 ** 6)),
+        'destinationAddress': '+22300000',
+        'messageId': 'bench{}'.format(next(_ids)),
+        'message': "Benchmark SMS-MO",
+        'dateTime': '2017-01-01T00:00:00.000Z'}}}
+
+
+def dr_payload(msg, status='DeliveredToTerminal'):
+    return {'deliveryInfoNotification': {
+        'callbackData': msg.suuid,
+        'deliveryInfo': {
+            'address': 'tel:{}'.format(msg.destination_address),
+            'deliveryStatus': status}}}
+
+
+def bench_webhook(path, payloads):
+    from django.test import Client
+    client = Client()
+
+    def run(count):
+        for payload in itertools.islice(payloads, count):
+            resp = client.post(path, data=simplejson.dumps(payload),
+                               content_type='application/json')
+            assert resp.status_code == 200, resp.content
+    return run
+
+
+def sent_messages():
+    ''' endless SMS-MT (existing in DB) for SMS-DR payloads '''
+    from orangeapisms.models import SMSMessage
+    while True:
+        messages = [SMSMessage.build_mt('+2237{:07d}'.format(index),
+                                        "Benchmark", '+22300000')
+                    for index in range(1000)]
+        SMSMessage.objects.bulk_create(messages)
+        for msg in messages:
+            yield msg
+
+
+def bench_record_dr(rows):
+    ''' SMS-DR lookups by callbackData then by reference in a large table '''
+    from orangeapisms.models import SMSMessage
+
+    sample = []
+
+    def run(count):
+        if not sample:
+            print("Inserting {} rows...".format(rows))
+            common.populate(rows)
+            sample.extend(SMSMessage.objects.filter(
+                direction=SMSMessage.OUTGOING, reference_code__isnull=False)
+                .values_list('uuid', 'reference_code')[:10000])
+        for index in range(count):
+            pk, reference = sample[index % len(sample)]
+            payload = {'deliveryInfo': {
+                'deliveryStatus': 'DeliveredToNetwork'}}
+            # half by uuid, half through the reference fallback
+            if index % 2:
+                payload['callbackData'] = str(pk)
+            else:
+                payload['resourceURL'] = 'http://x/requests/{}'.format(
+                    reference)
+            SMSMessage.record_dr_from_payload(payload)
+    return run
+
+
+def benchmarks(rows):
+    ''' OrderedDict of name: callable(count) '''
+    return OrderedDict([
+        ('send_sms (no db)', bench_send_sms(db_save=False)),
+        ('send_sms (db)', bench_send_sms(db_save=True)),
+        ('mt_payload', bench_mt_payload),
+        ('cleaned_msisdn', bench_cleaned_msisdn),
+        ('token refresh', bench_request_token),
+        ('smsmo webhook', bench_webhook(
+            '/smsmo', (mo_payload() for _ in itertools.count()))),
+        ('smsdr webhook', bench_webhook(
+            '/smsdr', (dr_payload(msg) for msg in sent_messages()))),
+        ('record_dr_from_payload ({} rows)'.format(rows),
+         bench_record_dr(rows)),
+    ])
+
+
+def metadata():
+    from django.db import connection
+    return {
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'database': connection.vendor,
+    }
+
+
+def load_baseline(path):
+    if not os.path.exists(path):
+        return None
+    with open(path, 'r') as f:
+        return simplejson.load(f)
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description=__doc__, formatter_class=argparse.RawTextHelpFormatter)
+    parser.add_argument('--count', type=int, default=1000,
+                        help="operations per run (x100 for pure functions)")
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--rows', type=int, default=100000,
+                        help="SMSMessage rows for the SMS-DR lookups")
+    parser.add_argument('--only', help="run benchmarks containing ONLY")
+    parser.add_argument('--baseline', default=BASELINE)
+    parser.add_argument('--save', action='store_true',
+                        help="store results as the new baseline")
+    parser.add_argument('--tolerance', type=float, default=0.2,
+                        help="slowdown considered a regression (0.2: 20%%)")
+    args = parser.parse_args()
+
+    common.setup()
+    common.migrate()
+    common.truncate()
+    configure()
+    fakeapi.install()
+    # silence per-request logging
+    logging.disable(logging.WARNING)
+
+    pure = ('mt_payload', 'cleaned_msisdn')
+    results = OrderedDict()
+    for name, func in benchmarks(args.rows).items():
+        if args.only and args.only not in name:
+            continue
+        count = args.count * 100 if name in pure else args.count
+        duration = common.timeit(lambda: func(count), repeat=args.repeat)
+        results[name] = round(count / duration, 1)
+
+    baseline = load_baseline(args.baseline)
+    regressions = []
+    print("{:<40} {:>12} {:>12} {:>8}".format(
+        "benchmark", "ops/s", "baseline", "change"))
+    for name, rate in results.items():
+        reference = (baseline or {}).get('results', {}).get(name)
+        change = ''
+        if reference:
+            ratio = rate / reference - 1
+            change = "{:+.0%}".format(ratio)
+            if ratio < -args.tolerance:
+                regressions.append(name)
+                change += ' !'
+        print("{:<40} {:>12,.1f} {:>12} {:>8}".format(
+            name, rate, "{:,.1f}".format(reference) if reference else '-',
+            change))
+
+    if args.save:
+        if baseline and args.only:
+            # keep results of benchmarks which didn't run
+            baseline['results'].update(results)
+            results = baseline['results']
+        with open(args.baseline, 'w') as f:
+            simplejson.dump({'meta': metadata(), 'results': results}, f,
+                            indent=4)
+        print("Baseline saved to {}".format(args.baseline))
+    elif regressions:
+        print("Regressions: {}".format(", ".join(regressions)))
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
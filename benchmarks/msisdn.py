@@ -0,0 +1,83 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# vim: ai ts=4 sts=4 et sw=4 nu
+
+''' MSISDN normalization of a campaign list
+
+    python benchmarks/msisdn.py --count 1000000 '''
+
+from __future__ import (unicode_literals, absolute_import,
+                        division, print_function)
+
+import re
+import random
+import argparse
+
+try:
+    from benchmarks import common
+except ImportError:
+    import common
+
+FORMATS = ["+2237{:07d}", "002237{:07d}", "2237{:07d}", "7{:07d}",
+           "7{:01d} {:02d} {:02d} {:02d}"]
+
+
+def legacy_cleaned_msisdn(to_addr, prefix='223'):
+    ''' cleaned_msisdn before precompiled patterns (for reference) '''
+    to_addr = re.sub(r"^00", "+", to_addr)
+    if to_addr.startswith('+'):
+        return "+{addr}".format(addr=re.sub(r"\D", "", to_addr))
+    to_addr = re.sub(r"\D", "", to_addr)
+    if to_addr.startswith(prefix):
+        to_addr = re.sub(r"^{prefix}".format(prefix=prefix), "", to_addr)
+    return "+{prefix}{addr}".format(prefix=prefix, addr=to_addr)
+
+
+def numbers(count, seed=0):
+    rand = random.Random(seed)
+    for _ in range(count):
+        fmt = rand.choice(FORMATS)
+        if ' ' in fmt:
+            yield fmt.format(rand.randint(0, 9), rand.randint(0, 99),
+                             rand.randint(0, 99), rand.randint(0, 99))
+        else:
+            yield fmt.format(rand.randint(0, 10 ** 7 - 1))
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description=__doc__, formatter_class=argparse.RawTextHelpFormatter)
+    parser.add_argument('--count', type=int, default=1000000)
+    args = parser.parse_args()
+
+    common.setup()
+    from orangeapisms.config import update_config
+    from orangeapisms.utils import cleaned_msisdn, cleaned_msisdn_many
+    update_config({'country_prefix': '223', 'fix_msisdn': True})
+
+    recipients = list(numbers(args.count))
+    expected = [legacy_cleaned_msisdn(number) for number in recipients]
+    assert list(cleaned_msisdn_many(recipients)) == expected
+    assert [cleaned_msisdn(number) for number in recipients] == expected
+
+    candidates = [
+        ("legacy", lambda: [legacy_cleaned_msisdn(number)
+                            for number in recipients]),
+        ("cleaned_msisdn", lambda: [cleaned_msisdn(number)
+                                    for number in recipients]),
+        ("cleaned_msisdn_many", lambda: list(cleaned_msisdn_many(
+            recipients))),
+        # campaign lists often repeat numbers
+        ("cleaned_msisdn (repeated)", lambda: [
+            cleaned_msisdn(number) for number in recipients[:1000]
+            for _ in range(args.count // 1000)]),
+    ]
+    print("Normalizing {} numbers".format(args.count))
+    for name, func in candidates:
+        duration = common.timeit(func)
+        print("{name}: {duration:.3f}s ({rate:,.0f}/s)".format(
+            name=name, duration=duration, rate=args.count / duration))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,78 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# vim: ai ts=4 sts=4 et sw=4 nu
+
+''' query plans and timings of SMSMessage hot queries, before the indexes
+    added from migration 0004 on and after the latest migration
+
+    python benchmarks/query_plans.py --rows 5000000 '''
+
+from __future__ import (unicode_literals, absolute_import,
+                        division, print_function)
+
+import argparse
+
+try:
+    from benchmarks import common
+except ImportError:
+    import common
+
+# last migration without hot path indexes (columns are the latest ones)
+BEFORE = '0003_smsmessage_outbox'
+
+
+def hot_queries():
+    from django.utils import timezone
+    from orangeapisms.models import SMSMessage
+    from orangeapisms.outbox import claimable
+
+    objects = SMSMessage.objects
+    return [
+        ("logs page", objects.order_by('-created_on', '-uuid')[:26]),
+        ("admin status filter",
+         objects.filter(status=SMSMessage.DELIVERED)
+                .order_by('-created_on')[:100]),
+        ("admin direction filter",
+         objects.filter(direction=SMSMessage.INCOMING)
+                .order_by('-created_on')[:100]),
+        ("admin type filter",
+         objects.filter(sms_type=SMSMessage.DR)
+                .order_by('-created_on')[:100]),
+        ("SMS-DR by reference", objects.filter(reference_code='ref4242')),
+        ("SMS-MO by message_id", objects.filter(message_id='mo4241')),
+        ("outbox claim",
+         claimable(timezone.now()).order_by('created_on').values('pk')[:100]),
+    ]
+
+
+def report(label):
+    print("=" * 20, label, "=" * 20)
+    for name, queryset in hot_queries():
+        duration = common.timeit(lambda: list(queryset.all()))
+        print("{name}: {ms:.2f}ms".format(name=name, ms=duration * 1000))
+        print("    " + common.explain(queryset).replace("\n", "\n    "))
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description=__doc__, formatter_class=argparse.RawTextHelpFormatter)
+    parser.add_argument('--rows', type=int, default=1000000)
+    parser.add_argument('--reuse', action='store_true',
+                        help="don't populate (table already filled)")
+    args = parser.parse_args()
+
+    common.setup()
+    common.migrate(BEFORE)
+    if not args.reuse:
+        from orangeapisms.models import SMSMessage
+        SMSMessage.objects.all().delete()
+        print("Inserting {} rows...".format(args.rows))
+        common.populate(args.rows)
+
+    report("before ({})".format(BEFORE))
+    common.migrate()
+    report("after (latest)")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,31 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# vim: ai ts=4 sts=4 et sw=4 nu
+
+''' Django settings for benchmarks
+
+    Uses SQLite in the system temp folder by default. Set BENCH_DB_NAME
+    to use another path or BENCH_DB_ENGINE (ie.
+    django.db.backends.postgresql), BENCH_DB_NAME, BENCH_DB_USER,
+    BENCH_DB_PASSWORD and BENCH_DB_HOST to benchmark another database. '''
+
+import os
+import tempfile
+
+from orangeapisms.dj_settings_tests import *  # noqa
+
+DATABASES = {
+    'default': {
+        'ENGINE': os.environ.get('BENCH_DB_ENGINE',
+                                 'django.db.backends.sqlite3'),
+        'NAME': os.environ.get('BENCH_DB_NAME',
+                               os.path.join(tempfile.gettempdir(),
+                                            'orangeapisms-bench.sqlite3')),
+        'USER': os.environ.get('BENCH_DB_USER', ''),
+        'PASSWORD': os.environ.get('BENCH_DB_PASSWORD', ''),
+        'HOST': os.environ.get('BENCH_DB_HOST', ''),
+    }
+}
+
+DEBUG = False
+ALLOWED_HOSTS = ['*']
@@ -5,6 +5,8 @@
 from __future__ import (unicode_literals, absolute_import,
                         division, print_function)
 
+import itertools
+
 from orangeapisms.config import get_config
 
 
@@ -29,14 +31,29 @@ def import_path(callable_name, module, fallback=None):
             return None
         return ret(fallback, callable_name)
 
+
+def chunked(iterable, size):
+    ''' yields lists of at most `size` items from iterable '''
+    iterator = iter(iterable)
+    while True:
+        chunk = list(itertools.islice(iterator, size))
+        if not chunk:
+            return
+        yield chunk
+
 SEND_ASYNC = get_config('send_async')
+SEND_ASYNC_BACKEND = get_config('send_async_backend')
 CELERY_TASK = import_path('submit_sms_mt_request_task',
                           get_config('celery_module'))
 
 
 def async_check(func):
-    ''' decorator to route API-call request to celery depending on config '''
+    ''' decorator to route API-call request to celery or to a thread pool
+        depending on config '''
     def _decorated(*args, **kwargs):
+        if SEND_ASYNC and SEND_ASYNC_BACKEND == 'thread':
+            from orangeapisms.workers import get_send_executor
+            return get_send_executor().submit(func, *args, **kwargs)
         if SEND_ASYNC and CELERY_TASK:
             return CELERY_TASK.apply_async(args)
         return func(*args, **kwargs)
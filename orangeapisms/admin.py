@@ -7,13 +7,47 @@ from __future__ import (unicode_literals, absolute_import,
 
 from django.contrib import admin
 
-from orangeapisms.models import SMSMessage
+from orangeapisms.models import SMSMessage, DailyRollup, ConfigEntry
+from orangeapisms.pagination import EstimatedCountPaginator
+from orangeapisms.export import CSV, JSONL, export_response
+from orangeapisms.search import search_messages
 
 
 @admin.register(SMSMessage)
 class SMSMessageAdmin(admin.ModelAdmin):
-    date_hierarchy = 'created_on'
+    # no COUNT(*) on the whole table (see EstimatedCountPaginator)
+    paginator = EstimatedCountPaginator
+    show_full_result_count = False
     list_display = ('sms_type', 'created_on', 'identity', 'content', 'status')
     list_display_links = ('created_on', )
     list_filter = ('sms_type', 'direction', 'status',)
     search_fields = ['sender_address', 'destination_address', 'content']
+    actions = ['export_csv', 'export_jsonl']
+
+    def get_search_results(self, request, queryset, search_term):
+        # numbers and full-text index instead of LIKE on search_fields
+        if not search_term.strip():
+            return queryset, False
+        return search_messages(search_term, queryset), False
+
+    def export_csv(self, request, queryset):
+        return export_response(queryset, CSV)
+    export_csv.short_description = "Export selected messages as CSV"
+
+    def export_jsonl(self, request, queryset):
+        return export_response(queryset, JSONL)
+    export_jsonl.short_description = "Export selected messages as JSONL"
+
+
+@admin.register(DailyRollup)
+class DailyRollupAdmin(admin.ModelAdmin):
+    list_display = ('day', 'direction', 'sms_type', 'status', 'sender',
+                    'count')
+    list_filter = ('direction', 'sms_type', 'status')
+    date_hierarchy = 'day'
+    search_fields = ['sender']
+
+
+@admin.register(ConfigEntry)
+class ConfigEntryAdmin(admin.ModelAdmin):
+    list_display = ('key', 'value', 'updated_on')
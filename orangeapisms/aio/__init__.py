@@ -0,0 +1,19 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# vim: ai ts=4 sts=4 et sw=4 nu
+
+''' asyncio client for Orange API (optional: Python 3.5+ and aiohttp)
+
+    install with `pip install orangeapisms[async]` '''
+
+from __future__ import (unicode_literals, absolute_import,
+                        division, print_function)
+
+import sys
+
+if sys.version_info < (3, 5):
+    raise ImportError("orangeapisms.aio requires Python 3.5+")
+
+from orangeapisms.aio.client import AsyncClient, AsyncResponse  # noqa
+
+__all__ = ['AsyncClient', 'AsyncResponse']
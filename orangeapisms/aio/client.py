@@ -0,0 +1,268 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# vim: ai ts=4 sts=4 et sw=4 nu
+
+''' asyncio client for Orange API (Python 3.5+ only: not installed on
+    Python 2, import orangeapisms.aio)
+
+    Mirrors the API calls of orangeapisms.utils so that a single event loop
+    can keep many requests in flight. Number of concurrent requests is
+    bounded by a semaphore (`async_concurrency` config).
+
+    async with AsyncClient() as api:
+        await asyncio.gather(*[api.submit_sms_mt_request(p) for p in ...])
+'''
+
+import time
+import asyncio
+import logging
+
+from orangeapisms import exceptions
+from orangeapisms.config import get_config
+from orangeapisms.exceptions import OrangeAPIError
+from orangeapisms.metrics import inc, record_api_call
+from orangeapisms.ratelimit import get_rate_limiter, TOO_MANY_REQUESTS
+from orangeapisms.tokens import get_token_manager
+from orangeapisms.utils import (get_config_token, bearer_header, jsonloads,
+                                reference_from_url, sms_mt_url, token_url,
+                                token_headers, token_data_from_response,
+                                contracts_url, sms_balance_from_contracts,
+                                dr_subscription_url, dr_subscriptions_url,
+                                dr_subscription_payload,
+                                dr_endpoint_from_subscriptions, sms_units,
+                                sms_mt_reference, record_submission,
+                                dr_subscribed, dr_unsubscribed)
+
+try:
+    import aiohttp
+except ImportError:
+    aiohttp = None
+    SUBMISSION_ERRORS = (OrangeAPIError, asyncio.TimeoutError)
+else:
+    SUBMISSION_ERRORS = (OrangeAPIError, aiohttp.ClientError,
+                         asyncio.TimeoutError)
+    # so failed submissions are retried by the outbox
+    exceptions.CONNECTION_ERRORS += (aiohttp.ClientError,
+                                     asyncio.TimeoutError)
+
+logger = logging.getLogger(__name__)
+
+
+class AsyncResponse(object):
+    ''' requests.Response look-alike fed to OrangeAPIError.from_request '''
+
+    def __init__(self, status_code, text, headers=None):
+        self.status_code = status_code
+        self.text = text
+        self.headers = headers or {}
+
+    def json(self):
+        return jsonloads(self.text)
+
+
+class AsyncClient(object):
+
+    def __init__(self, concurrency=None, session=None):
+        if aiohttp is None:
+            raise ImportError("AsyncClient requires aiohttp. Install it "
+                              "with `pip install orangeapisms[async]`")
+        self.concurrency = concurrency or get_config('async_concurrency')
+        self._session = session
+        self._semaphore = None
+        self._token_lock = None
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self.close()
+
+    @property
+    def session(self):
+        if self._session is None:
+            connector = aiohttp.TCPConnector(
+                limit=self.concurrency,
+                limit_per_host=self.concurrency,
+                force_close=not get_config('http_keep_alive'))
+            self._session = aiohttp.ClientSession(
+                connector=connector,
+                timeout=aiohttp.ClientTimeout(
+                    total=get_config('http_timeout')))
+        return self._session
+
+    async def close(self):
+        if self._session is not None:
+            await self._session.close()
+            self._session = None
+
+    async def request(self, method, url, **kwargs):
+        ''' perform an HTTP request, waiting for a free slot if needed '''
+        # created here so it binds to the running loop
+        if self._semaphore is None:
+            self._semaphore = asyncio.Semaphore(self.concurrency)
+        async with self._semaphore:
+            started = time.time()
+            try:
+                async with self.session.request(method, url,
+                                                **kwargs) as resp:
+                    response = AsyncResponse(resp.status, await resp.text(),
+                                             resp.headers)
+            except Exception as exp:
+                record_api_call(method, url, time.time() - started,
+                                exception=exp)
+                raise
+            record_api_call(method, url, time.time() - started,
+                            response=response)
+            return response
+
+    async def in_thread(self, func, *args):
+        ''' run blocking (DB, file) func outside of the event loop '''
+        loop = asyncio.get_event_loop()
+        return await loop.run_in_executor(None, func, *args)
+
+    async def get_token(self):
+        token = get_config_token()
+        if token is not None:
+            return token
+        if self._token_lock is None:
+            self._token_lock = asyncio.Lock()
+        # single refresh for all coroutines waiting on an expired token
+        async with self._token_lock:
+            token = get_config_token()
+            if token is None:
+                token = (await self.request_token())['token']
+        return token
+
+    async def get_standard_header(self):
+        return bearer_header(await self.get_token())
+
+    async def request_token(self, silent_failure=False):
+        req = await self.request(
+            'POST', token_url(), headers=token_headers(),
+            data={'grant_type': 'client_credentials'})
+        token_data = token_data_from_response(req.json())
+        inc('orangeapisms_token_refreshes_total',
+            {'result': 'failure' if token_data is None else 'success'})
+        if token_data is not None:
+            await self.in_thread(get_token_manager().set_token, token_data)
+            return token_data
+        else:
+            exp = OrangeAPIError.from_request(req)
+            logger.error("Unable to retrieve token. {}".format(exp))
+            logger.exception(exp)
+            if not silent_failure:
+                raise exp
+            return False
+
+    async def post_sms_mt_request(self, payload):
+        ''' same as utils.post_sms_mt_request, waiting for rate limits
+            with asyncio.sleep (concurrency: see self.concurrency) '''
+        request = payload['outboundSMSMessageRequest']
+        sender_address = request['senderAddress']
+        units = sms_units(request['outboundSMSTextMessage']['message'])
+        limiter = get_rate_limiter()
+        retries = get_config('throttle_retries')
+
+        for attempt in range(retries + 1):
+            buckets, wait = limiter.reserve(sender_address, cost=units)
+            if wait:
+                await asyncio.sleep(wait)
+            req = await self.request(
+                'POST', sms_mt_url(sender_address),
+                headers=await self.get_standard_header(), json=payload)
+            if req.status_code != TOO_MANY_REQUESTS:
+                break
+            backoff = limiter.backoff(buckets, req)
+            if attempt < retries and backoff:
+                await asyncio.sleep(backoff)
+
+        return sms_mt_reference(req, units)
+
+    async def submit_sms_mt_request(self, payload, message=None,
+                                    silent_failure=False):
+        ''' submit an SMS-MT request to Orange API
+
+            same as utils.do_submit_sms_mt_request. message (if any) is
+            updated in a thread so DB access doesn't block the loop '''
+        try:
+            rurl = await self.post_sms_mt_request(payload)
+        except SUBMISSION_ERRORS as exp:
+            logger.error("Unable to transmit SMS-MT. {exp}".format(exp=exp))
+            logger.exception(exp)
+            await self.in_thread(record_submission, message, None, exp)
+            if not silent_failure:
+                raise exp
+            return False
+
+        return await self.in_thread(record_submission, message, rurl)
+
+    async def get_contracts(self, silent_failure=False):
+        req = await self.request('GET', contracts_url(),
+                                 headers=await self.get_standard_header())
+        if req.status_code == 200:
+            return req.json()
+        exp = OrangeAPIError.from_request(req)
+        logger.error("Unable to retrieve contracts. {exp}".format(exp=exp))
+        logger.exception(exp)
+        if not silent_failure:
+            raise exp
+
+    async def get_sms_balance(self, country=None):
+        return sms_balance_from_contracts(await self.get_contracts(),
+                                          country or get_config('country'))
+
+    async def get_sms_dr_subscriptions(self, silent_failure=False):
+        subscription_id = get_config('smsmtdr_subsription_id')
+        if not subscription_id:
+            return {}
+        req = await self.request('GET', dr_subscription_url(subscription_id),
+                                 headers=await self.get_standard_header())
+        if req.status_code == 200:
+            return req.json()
+        exp = OrangeAPIError.from_request(req)
+        logger.error("Unable to retrieve contracts. {exp}".format(exp=exp))
+        logger.exception(exp)
+        if not silent_failure:
+            raise exp
+
+    async def get_sms_dr_endpoint(self, silent_failure=False):
+        return dr_endpoint_from_subscriptions(
+            await self.get_sms_dr_subscriptions(silent_failure))
+
+    async def subscribe_sms_dr_endpoint(self, endpoint_url,
+                                        silent_failure=False):
+        req = await self.request(
+            'POST', dr_subscriptions_url(get_config('sender_address')),
+            headers=await self.get_standard_header(),
+            json=dr_subscription_payload(endpoint_url))
+        if req.status_code != 201:
+            exp = OrangeAPIError.from_request(req)
+            logger.error("Unable to subscribe an SMS-DR endpoint. {exp}"
+                         .format(exp=exp))
+            logger.exception(exp)
+            if not silent_failure:
+                raise exp
+            return False
+
+        subscription_id = reference_from_url(
+            req.json()['deliveryReceiptSubscription'].get('resourceURL'))
+        await self.in_thread(dr_subscribed, subscription_id)
+        return bool(subscription_id)
+
+    async def unsubscribe_sms_dr_endpoint(self, subscription_id,
+                                          silent_failure=False):
+        req = await self.request(
+            'DELETE', dr_subscriptions_url(get_config('sender_address'),
+                                           subscription_id),
+            headers=await self.get_standard_header())
+        if req.status_code != 204:
+            exp = OrangeAPIError.from_request(req)
+            logger.error("Unable to unsubscribe an SMS-DR endpoint. {exp}"
+                         .format(exp=exp))
+            logger.exception(exp)
+            if not silent_failure:
+                raise exp
+            return False
+
+        await self.in_thread(dr_unsubscribed, subscription_id)
+        return True
@@ -0,0 +1,197 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# vim: ai ts=4 sts=4 et sw=4 nu
+
+''' Archival of old SMSMessage rows to compressed JSON-lines files '''
+
+from __future__ import (unicode_literals, absolute_import,
+                        division, print_function)
+
+import os
+import zlib
+import glob
+import gzip
+import time
+import uuid
+import logging
+import datetime
+
+import simplejson
+from django.utils import timezone
+
+from orangeapisms.config import get_config, get_settings_folder
+from orangeapisms.datetime import aware_datetime_from_iso
+from orangeapisms.models import SMSMessage
+from orangeapisms.pagination import keyset_chunks
+
+logger = logging.getLogger(__name__)
+PREFIX = 'smsmessage-'
+SUFFIX = '.jsonl.gz'
+
+
+def get_archive_folder():
+    return get_config('archive_folder') or os.path.join(
+        get_settings_folder(), 'archives')
+
+
+def archive_path(folder, msg):
+    ''' path of the file starting with msg (first of its day in a chunk)
+
+        the same chunk gets the same name if archived again (ie. crashed
+        before deleting it) so rows are not archived twice '''
+    created_on = msg.created_on.astimezone(timezone.utc)
+    return os.path.join(folder, created_on.strftime('%Y'),
+                        created_on.strftime('%m'),
+                        '{prefix}{day}-{time}-{uuid}{suffix}'.format(
+                            prefix=PREFIX, day=created_on.date().isoformat(),
+                            time=created_on.strftime('%H%M%S%f'),
+                            uuid=msg.uuid.hex[:8], suffix=SUFFIX))
+
+
+def to_archive(msg):
+    data = msg.to_dict()
+    data.update({'attempts': msg.attempts, 'last_error': msg.last_error})
+    return data
+
+
+def from_archive(data):
+    ''' unsaved SMSMessage from an archived row (ie. to restore it) '''
+    data = dict(data)
+    data['uuid'] = uuid.UUID(data['uuid'])
+    for field in ('created_on', 'delivery_status_on'):
+        if data.get(field):
+            data[field] = aware_datetime_from_iso(data[field])
+    return SMSMessage(**data)
+
+
+def archivable(cutoff):
+    ''' messages created before cutoff, except those yet to be sent '''
+    return SMSMessage.objects \
+        .filter(created_on__lt=cutoff) \
+        .exclude(status=SMSMessage.PENDING) \
+        .exclude(next_attempt_on__isnull=False)
+
+
+class ArchiveFile(object):
+    ''' gzip file written under a temporary name until complete '''
+
+    def __init__(self, path):
+        self.path = path
+        folder, name = os.path.split(path)
+        if not os.path.exists(folder):
+            os.makedirs(folder)
+        # not matched by archive_files()
+        self.tmp_path = os.path.join(folder, '.{}.tmp'.format(name))
+        self.raw = open(self.tmp_path, 'wb')
+        self.file = gzip.GzipFile(filename='', mode='wb', fileobj=self.raw)
+
+    def write(self, data):
+        self.file.write((simplejson.dumps(data) + '\n').encode('utf-8'))
+
+    def close(self):
+        ''' make it complete on disk, under its final name '''
+        self.file.close()
+        self.raw.flush()
+        os.fsync(self.raw.fileno())
+        self.raw.close()
+        os.rename(self.tmp_path, self.path)
+
+    def abort(self):
+        self.file = None
+        self.raw.close()
+        os.unlink(self.tmp_path)
+
+
+class ArchiveWriter(object):
+    ''' writes rows to a new file per (UTC) day. never appends '''
+
+    def __init__(self, folder):
+        self.folder = folder
+        self.files = {}
+
+    def write(self, msg):
+        day = msg.created_on.astimezone(timezone.utc).date()
+        if day not in self.files:
+            self.files[day] = ArchiveFile(archive_path(self.folder, msg))
+        self.files[day].write(to_archive(msg))
+
+    def close(self):
+        ''' complete written files: rows are then safely on disk '''
+        files, self.files = self.files, {}
+        for archive in files.values():
+            archive.close()
+
+    def abort(self):
+        ''' remove files being written '''
+        files, self.files = self.files, {}
+        for archive in files.values():
+            archive.abort()
+
+
+def archive_messages(cutoff, folder=None, chunk_size=None, pause=0,
+                     limit=None, dry_run=False, progress=None):
+    ''' move messages created before cutoff to archive files
+
+        returns number of archived messages. progress is called with it
+        after each chunk '''
+    folder = folder or get_archive_folder()
+    chunk_size = chunk_size or get_config('archive_chunk_size')
+    archived = 0
+    for messages in keyset_chunks(archivable(cutoff), chunk_size):
+        if limit is not None:
+            messages = messages[:limit - archived]
+        if not dry_run:
+            writer = ArchiveWriter(folder)
+            try:
+                for msg in messages:
+                    writer.write(msg)
+            except Exception:
+                writer.abort()
+                raise
+            writer.close()
+            SMSMessage.objects.filter(
+                uuid__in=[msg.uuid for msg in messages]).delete()
+        archived += len(messages)
+        if progress is not None:
+            progress(archived)
+        if limit is not None and archived >= limit:
+            break
+        if pause:
+            time.sleep(pause)
+    return archived
+
+
+def archive_files(folder=None, since=None, until=None):
+    ''' archive files of days from since to until (dates, included) '''
+    folder = folder or get_archive_folder()
+    paths = sorted(glob.glob(os.path.join(
+        folder, '*', '*', '{}*{}'.format(PREFIX, SUFFIX))))
+    for path in paths:
+        name = os.path.basename(path)
+        day = datetime.datetime.strptime(
+            name[len(PREFIX):len(PREFIX) + 10], '%Y-%m-%d').date()
+        if since is not None and day < since:
+            continue
+        if until is not None and day > until:
+            continue
+        yield path
+
+
+def read_archive(path):
+    ''' archived rows (dicts) of an archive file (generator)
+
+        rows following a corrupted part are skipped (logged) '''
+    with gzip.open(path, 'rb') as f:
+        try:
+            for line in f:
+                if line.strip():
+                    yield simplejson.loads(line.decode('utf-8'))
+        except (EOFError, IOError, OSError, ValueError, zlib.error) as exp:
+            logger.error("Corrupted archive {}: {}".format(path, exp))
+
+
+def read_archives(folder=None, since=None, until=None):
+    ''' archived rows (dicts) of days from since to until (generator) '''
+    for path in archive_files(folder, since, until):
+        for data in read_archive(path):
+            yield data
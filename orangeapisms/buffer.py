@@ -0,0 +1,342 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# vim: ai ts=4 sts=4 et sw=4 nu
+
+''' Write-behind buffer for SMS-MO inserts and SMS-DR updates
+
+    Notifications are journaled (crash safety) then written in bulk. '''
+
+from __future__ import (unicode_literals, absolute_import,
+                        division, print_function)
+
+import os
+import glob
+import uuid
+import socket
+import atexit
+import logging
+import threading
+
+import simplejson
+from django.db import (close_old_connections, transaction,
+                       OperationalError, InterfaceError)
+from django.utils import timezone
+
+from orangeapisms.config import get_config, get_settings_folder
+from orangeapisms.datetime import datetime_to_iso
+from orangeapisms.models import SMSMessage
+
+try:
+    import fcntl
+except ImportError:  # not available on Windows: no replay of others
+    fcntl = None
+
+logger = logging.getLogger(__name__)
+MO = 'mo'
+DR = 'dr'
+# DB unreachable: the whole batch is kept for the next flush
+TRANSIENT_ERRORS = (OperationalError, InterfaceError)
+
+
+class BufferFull(Exception):
+    ''' too many notifications waiting for DB: retry later '''
+
+
+class JournalSegment(object):
+    ''' append-only JSON-lines file, flock()ed while its owner lives '''
+
+    prefix = 'orangeapisms-journal-'
+
+    def __init__(self, path, fsync=True):
+        self.path = path
+        self.fsync = fsync
+        self.count = 0
+        self.file = open(path, 'a+')
+
+    @classmethod
+    def create(cls, folder, fsync=True):
+        name = '{prefix}{host}-{pid}-{uid}.jsonl'.format(
+            prefix=cls.prefix, host=socket.gethostname()[:40],
+            pid=os.getpid(), uid=uuid.uuid4().hex[:8])
+        segment = cls(os.path.join(folder, name), fsync)
+        segment.lock(blocking=True)
+        return segment
+
+    @classmethod
+    def orphans(cls, folder):
+        ''' segments of dead processes, now locked by us '''
+        if fcntl is None:
+            return
+        for path in sorted(glob.glob(
+                os.path.join(folder, '{}*.jsonl'.format(cls.prefix)))):
+            segment = cls(path)
+            if segment.lock(blocking=False):
+                yield segment
+            else:
+                segment.file.close()
+
+    def lock(self, blocking):
+        if fcntl is None:
+            return True
+        flags = fcntl.LOCK_EX if blocking else fcntl.LOCK_EX | fcntl.LOCK_NB
+        try:
+            fcntl.flock(self.file.fileno(), flags)
+        except (IOError, OSError):
+            return False
+        return True
+
+    def append(self, kind, data):
+        self.write(kind, data)
+        self.sync()
+
+    def write(self, kind, data):
+        self.file.write(simplejson.dumps([kind, data]) + '\n')
+        self.file.flush()
+        self.count += 1
+
+    def sync(self):
+        if not self.fsync:
+            return
+        try:
+            os.fsync(self.file.fileno())
+        except ValueError:
+            # closed: removed once its content was in DB
+            pass
+
+    def read(self):
+        self.file.seek(0)
+        for line in self.file:
+            try:
+                kind, data = simplejson.loads(line)
+            except ValueError:
+                # last line of a crashed process might be truncated
+                logger.warning("Skipping invalid journal line in {}"
+                               .format(self.path))
+                continue
+            yield kind, data
+
+    def remove(self):
+        os.unlink(self.path)
+        self.file.close()
+
+
+class WriteBehindBuffer(object):
+
+    dead_letter_name = 'orangeapisms-dead-letter.jsonl'
+
+    def __init__(self, max_rows=500, max_delay=200, folder=None, fsync=True,
+                 max_queue=50000):
+        self.max_rows = max_rows
+        self.max_delay = max_delay / 1000
+        self.max_queue = max_queue
+        self.folder = folder or get_settings_folder()
+        self.fsync = fsync
+        self.pending = []
+        self.condition = threading.Condition()
+        self.flush_lock = threading.Lock()
+        self.journal = None
+        # journal segments holding notifications not yet in DB
+        self.sealed = []
+        self.thread = None
+        self.stopped = False
+
+    def start(self):
+        for segment in JournalSegment.orphans(self.folder):
+            items = list(segment.read())
+            logger.info("Replaying {} notifications from {}"
+                        .format(len(items), segment.path))
+            self.pending.extend(items)
+            self.sealed.append(segment)
+        self.journal = JournalSegment.create(self.folder, self.fsync)
+        self.thread = threading.Thread(target=self.run,
+                                       name='orangeapisms-write-behind')
+        self.thread.daemon = True
+        self.thread.start()
+        atexit.register(self.stop)
+
+    def add(self, kind, data):
+        ''' journal and buffer a notification
+
+            raises BufferFull if max_queue are waiting (ie. DB down) '''
+        with self.condition:
+            if self.max_queue and len(self.pending) >= self.max_queue:
+                raise BufferFull("{} notifications waiting for DB"
+                                 .format(len(self.pending)))
+            journal = self.journal
+            journal.write(kind, data)
+            self.pending.append((kind, data))
+            if len(self.pending) >= self.max_rows:
+                self.condition.notify()
+        # outside of the lock so concurrent adds share disk flushes
+        journal.sync()
+
+    def run(self):
+        while not self.stopped:
+            with self.condition:
+                if len(self.pending) < self.max_rows:
+                    self.condition.wait(self.max_delay)
+            try:
+                self.flush()
+            except Exception as exp:
+                logger.exception(exp)
+
+    def stop(self):
+        ''' flush remaining notifications. called on interpreter exit '''
+        self.stopped = True
+        with self.condition:
+            self.condition.notify()
+        try:
+            self.flush()
+        except Exception:
+            logger.error("Notifications left in journal: replayed on "
+                         "next start")
+            return
+        with self.condition:
+            if not self.journal.count:
+                self.journal.remove()
+
+    def seal(self):
+        ''' move on to a new journal segment. call with condition held '''
+        if self.journal.count:
+            self.sealed.append(self.journal)
+            self.journal = JournalSegment.create(self.folder, self.fsync)
+
+    def flush(self):
+        ''' write buffered notifications to DB. returns their number '''
+        with self.flush_lock:
+            with self.condition:
+                items, self.pending = self.pending, []
+                if not items:
+                    return 0
+                self.seal()
+                sealed = list(self.sealed)
+            try:
+                messages = self.write_all(items)
+            except Exception as exp:
+                logger.error("Unable to flush {} notifications: {}"
+                             .format(len(items), exp))
+                with self.condition:
+                    self.pending = items + self.pending
+                raise
+            finally:
+                close_old_connections()
+
+            # everything those segments hold is now in DB
+            with self.condition:
+                for segment in sealed:
+                    self.sealed.remove(segment)
+                    segment.remove()
+
+        self.handle_drs(messages)
+        return len(items)
+
+    def write_all(self, items):
+        ''' write items, one by one if the batch fails. returns SMS-DR
+
+            items still failing are moved to the dead-letter file
+            unless DB is unreachable (raises then) '''
+        try:
+            return self.write(items)
+        except TRANSIENT_ERRORS:
+            raise
+        except Exception as exp:
+            logger.warning("Unable to write {} notifications at once ({}): "
+                           "retrying one by one".format(len(items), exp))
+        messages = []
+        for item in items:
+            try:
+                messages.extend(self.write([item]))
+            except TRANSIENT_ERRORS:
+                raise
+            except Exception as exp:
+                self.dead_letter(item, exp)
+        return messages
+
+    def dead_letter(self, item, exp):
+        ''' keep a notification which can't be written, for inspection '''
+        path = os.path.join(self.folder, self.dead_letter_name)
+        logger.error("Unable to write {} notification ({}): moved to {}"
+                     .format(item[0], exp, path))
+        with open(path, 'a') as fd:
+            fd.write(simplejson.dumps(list(item) + ['{}'.format(exp)]) +
+                     '\n')
+            fd.flush()
+            os.fsync(fd.fileno())
+
+    def write(self, items):
+        ''' bulk insert SMS-MO and bulk update SMS-DR. returns SMS-DR '''
+        mos, drs = [], []
+        for kind, data in items:
+            if kind == MO:
+                msg = SMSMessage.build_mo_from_payload(data['payload'])
+                msg.uuid = uuid.UUID(data['uuid'])
+                mos.append(msg)
+            elif kind == DR:
+                drs.append(data)
+        with transaction.atomic():
+            if mos:
+                SMSMessage.bulk_insert_mo(mos)
+            if drs:
+                return [msg for msg in
+                        SMSMessage.record_drs_from_payloads(drs)
+                        if msg is not None]
+        return []
+
+    def handle_drs(self, messages):
+        from orangeapisms.dispatch import get_dispatcher
+        dispatcher = get_dispatcher()
+        for msg in messages:
+            if dispatcher.deferred:
+                dispatcher.executor.submit(
+                    dispatcher.run_deferred, 'smsdr', msg)
+            else:
+                dispatcher.run_deferred('smsdr', msg)
+
+    def record_mo(self, payload):
+        ''' (msg, created) for an SMS-MO notification, stored later '''
+        from orangeapisms.dedup import get_message_id_cache
+
+        message_id = payload.get('messageId')
+        seen = get_message_id_cache()
+        if message_id:
+            suuid = seen.get(message_id)
+            if suuid is not None:
+                return SMSMessage(uuid=uuid.UUID(suuid),
+                                  message_id=message_id), False
+
+        # a retry after a failed handler is buffered again: the flush
+        # only stores the first one
+        msg = SMSMessage.build_mo_from_payload(payload)
+        self.add(MO, {'uuid': msg.suuid, 'payload': payload})
+        return msg, True
+
+    def record_dr(self, payload):
+        ''' buffer an SMS-DR notification. its handler runs once stored '''
+        # reception time would be lost on replay
+        payload = dict(payload)
+        payload.setdefault('delivery_status_on',
+                           datetime_to_iso(timezone.now()))
+        # reject invalid payloads now rather than failing every flush
+        SMSMessage.dr_from_payload(payload)
+        self.add(DR, payload)
+
+
+_lock = threading.Lock()
+_buffers = {}
+
+
+def get_write_buffer():
+    ''' process-wide WriteBehindBuffer built from config and started '''
+    pid = os.getpid()
+    if pid not in _buffers:
+        with _lock:
+            if pid not in _buffers:
+                buffer_ = WriteBehindBuffer(
+                    max_rows=get_config('write_behind_max_rows'),
+                    max_delay=get_config('write_behind_max_delay'),
+                    folder=get_config('write_behind_folder'),
+                    fsync=get_config('write_behind_fsync'),
+                    max_queue=get_config('write_behind_max_queue'))
+                buffer_.start()
+                _buffers[pid] = buffer_
+    return _buffers[pid]
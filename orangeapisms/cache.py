@@ -0,0 +1,98 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# vim: ai ts=4 sts=4 et sw=4 nu
+
+''' Small in-process caches '''
+
+from __future__ import (unicode_literals, absolute_import,
+                        division, print_function)
+
+import time
+import logging
+import threading
+from collections import OrderedDict
+
+logger = logging.getLogger(__name__)
+
+
+class LRUCache(object):
+    ''' thread-safe mapping keeping the `maxsize` most recently used keys '''
+
+    def __init__(self, maxsize=1000):
+        self.maxsize = maxsize
+        self.data = OrderedDict()
+        self.lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.data)
+
+    def __contains__(self, key):
+        return key in self.data
+
+    def get(self, key, default=None):
+        with self.lock:
+            try:
+                value = self.data.pop(key)
+            except KeyError:
+                return default
+            self.data[key] = value
+            return value
+
+    def set(self, key, value):
+        with self.lock:
+            self.data.pop(key, None)
+            self.data[key] = value
+            while len(self.data) > self.maxsize:
+                self.data.popitem(last=False)
+
+    def delete(self, key):
+        with self.lock:
+            self.data.pop(key, None)
+
+    def clear(self):
+        with self.lock:
+            self.data.clear()
+
+
+class TTLCache(object):
+    ''' thread-safe mapping whose values expire after `ttl` seconds '''
+
+    def __init__(self, ttl=300):
+        self.ttl = ttl
+        self.data = {}
+        self.lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self.lock:
+            value, expires = self.data.get(key, (default, None))
+            if expires is not None and expires <= time.time():
+                del self.data[key]
+                return default
+            return value
+
+    def set(self, key, value, ttl=None):
+        ttl = self.ttl if ttl is None else ttl
+        if not ttl:
+            return
+        with self.lock:
+            self.data[key] = (value, time.time() + ttl)
+
+    def update(self, key, func):
+        ''' replace a fresh value by func(value), keeping its expiry
+
+            returns the new value, None if key is missing or expired '''
+        with self.lock:
+            value, expires = self.data.get(key, (None, None))
+            if expires is None or expires <= time.time():
+                return None
+            value = func(value)
+            self.data[key] = (value, expires)
+            return value
+
+    def delete(self, key):
+        with self.lock:
+            self.data.pop(key, None)
+
+    def clear(self):
+        with self.lock:
+            self.data.clear()
@@ -0,0 +1,222 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# vim: ai ts=4 sts=4 et sw=4 nu
+
+''' Streamed SMS-MT campaigns from CSV or JSON-lines recipient lists '''
+
+from __future__ import (unicode_literals, absolute_import,
+                        division, print_function)
+
+import io
+import os
+import csv
+import time
+import hashlib
+import logging
+import itertools
+from string import Formatter
+from concurrent.futures import ThreadPoolExecutor
+
+import simplejson
+from django.utils import timezone
+from py3compat import PY2
+
+from orangeapisms import chunked
+from orangeapisms.config import get_config, atomic_write_json, load_json
+from orangeapisms.models import SMSMessage
+from orangeapisms.utils import (cleaned_msisdn_many, sms_content, sms_units,
+                                submit_message)
+
+logger = logging.getLogger(__name__)
+CSV = 'csv'
+JSONL = 'jsonl'
+FORMATS = (CSV, JSONL)
+
+
+def guess_format(path):
+    ext = os.path.splitext(path)[1].lower()
+    return JSONL if ext in ('.jsonl', '.ndjson', '.json') else CSV
+
+
+def read_csv(path):
+    ''' dict for each row of a CSV file with a header line (generator) '''
+    if PY2:
+        with open(path, 'rb') as f:
+            for row in csv.DictReader(f):
+                yield {key.decode('utf-8-sig'): (value or b'').decode('utf-8')
+                       for key, value in row.items() if key is not None}
+        return
+
+    with io.open(path, 'r', encoding='utf-8-sig', newline='') as f:
+        for row in csv.DictReader(f):
+            yield {key: value or '' for key, value in row.items()
+                   if key is not None}
+
+
+def read_jsonl(path):
+    ''' dict for each non-empty line of a JSON-lines file (generator) '''
+    with io.open(path, 'r', encoding='utf-8') as f:
+        for line in f:
+            if line.strip():
+                yield simplejson.loads(line)
+
+
+def read_rows(path, fmt=None):
+    return {CSV: read_csv, JSONL: read_jsonl}[fmt or guess_format(path)](path)
+
+
+class MessageTemplate(object):
+    ''' str.format()-like template parsed once, rendered for each row
+
+        fields are row keys: `Hello {name}, you owe {amount:.2f}` '''
+
+    def __init__(self, text):
+        self.text = text
+        self.formatter = Formatter()
+        self.parts = list(self.formatter.parse(text))
+        self.fields = [field for _, field, _, _ in self.parts
+                       if field is not None]
+        for field in self.fields:
+            if not field or '.' in field or '[' in field:
+                raise ValueError("Invalid template field `{{{}}}`: use "
+                                 "plain column names".format(field))
+
+    def render(self, row):
+        ''' text for row. KeyError if a field is missing from row '''
+        chunks = []
+        for literal, field, spec, conversion in self.parts:
+            chunks.append(literal)
+            if field is None:
+                continue
+            value = self.formatter.convert_field(row[field], conversion)
+            chunks.append(self.formatter.format_field(value, spec or ''))
+        return ''.join(chunks)
+
+    @property
+    def digest(self):
+        return hashlib.sha1(self.text.encode('utf-8')).hexdigest()
+
+
+class Campaign(object):
+
+    def __init__(self, source, template, fmt=None, number_field='number',
+                 sender_name=None, batch_size=None, concurrency=None,
+                 checkpoint=None, db_save=None, dry_run=False):
+        self.source = source
+        self.template = template
+        self.fmt = fmt or guess_format(source)
+        self.number_field = number_field
+        self.sender_name = sender_name or get_config('default_sender_name')
+        self.batch_size = batch_size or get_config('bulk_batch_size')
+        self.concurrency = concurrency or get_config('bulk_concurrency')
+        self.checkpoint = checkpoint or '{}.checkpoint'.format(source)
+        self.db_save = get_config('use_db') if db_save is None else db_save
+        self.dry_run = dry_run
+        self.state = self.initial_state()
+        self.started_on = None
+        self.handled = 0
+
+    def initial_state(self):
+        return {'source': os.path.abspath(self.source),
+                'template': self.template.digest,
+                'offset': 0, 'sent': 0, 'failed': 0, 'rejected': 0,
+                'units': 0, 'completed': False}
+
+    def resume(self):
+        ''' load checkpoint if any. returns number of rows to skip '''
+        if self.dry_run or not os.path.exists(self.checkpoint):
+            return 0
+        state = load_json(self.checkpoint)
+        if state.get('template') != self.template.digest:
+            raise ValueError("Checkpoint {} was made with another template"
+                             .format(self.checkpoint))
+        self.state.update(state)
+        return self.state['offset']
+
+    def restart(self):
+        if os.path.exists(self.checkpoint):
+            os.unlink(self.checkpoint)
+        self.state = self.initial_state()
+
+    def save_state(self):
+        if self.dry_run:
+            return
+        self.state['updated_on'] = timezone.now()
+        atomic_write_json(self.checkpoint, self.state)
+
+    def build(self, rows):
+        ''' unsaved SMS-MT for valid rows. others are counted as rejected '''
+        numbers, contents = [], []
+        for index, row in enumerate(rows, self.state['offset'] + 1):
+            try:
+                number = '{}'.format(row[self.number_field]).strip()
+                content = sms_content(self.template.render(row))
+            except (KeyError, ValueError, TypeError) as exp:
+                logger.warning("Rejected row #{index}: {exp!r}"
+                               .format(index=index, exp=exp))
+                self.state['rejected'] += 1
+                continue
+            if not number:
+                logger.warning("Rejected row #{}: no number".format(index))
+                self.state['rejected'] += 1
+                continue
+            numbers.append(number)
+            contents.append(content)
+        return [SMSMessage.build_mt(to_addr, content, self.sender_name,
+                                    SMSMessage.PENDING)
+                for to_addr, content in zip(cleaned_msisdn_many(numbers),
+                                            contents)]
+
+    def process(self, executor, rows):
+        messages = self.build(rows)
+        self.state['units'] += sum(sms_units(msg.content)
+                                   for msg in messages)
+        if self.dry_run:
+            self.state['offset'] += len(rows)
+            return
+
+        if self.db_save:
+            # from now on, the outbox sends them if we're interrupted
+            SMSMessage.objects.bulk_create(messages)
+            self.state['offset'] += len(rows)
+            self.save_state()
+
+        for success in executor.map(submit_message, messages):
+            self.state['sent' if success else 'failed'] += 1
+        if self.db_save:
+            SMSMessage.save_attempts(messages)
+        else:
+            # not stored: sent again on resume if we're interrupted
+            self.state['offset'] += len(rows)
+        self.save_state()
+
+    def run(self, progress=None):
+        ''' send (remaining rows of) the campaign
+
+            progress is called with stats() after each batch '''
+        skip = self.resume()
+        if self.state['completed']:
+            return self.stats()
+
+        rows = itertools.islice(read_rows(self.source, self.fmt), skip, None)
+        self.started_on = time.time()
+        self.handled = 0
+        with ThreadPoolExecutor(max_workers=self.concurrency) as executor:
+            for batch in chunked(rows, self.batch_size):
+                self.process(executor, batch)
+                self.handled += len(batch)
+                if progress is not None:
+                    progress(self.stats())
+
+        self.state['completed'] = True
+        self.save_state()
+        return self.stats()
+
+    def stats(self):
+        elapsed = time.time() - self.started_on if self.started_on else 0
+        stats = dict(self.state)
+        stats.update({
+            'elapsed': elapsed,
+            'rate': self.handled / elapsed if elapsed else 0,
+        })
+        return stats
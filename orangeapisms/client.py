@@ -0,0 +1,91 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# vim: ai ts=4 sts=4 et sw=4 nu
+
+''' Shared HTTP client (keep-alive session per process) for Orange API '''
+
+from __future__ import (unicode_literals, absolute_import,
+                        division, print_function)
+
+import os
+import time
+import logging
+import threading
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from orangeapisms.config import get_config
+from orangeapisms.metrics import record_api_call
+
+logger = logging.getLogger(__name__)
+
+_lock = threading.Lock()
+_session = None
+_session_pid = None
+
+
+def build_session():
+    ''' a new requests.Session configured from the pool options '''
+    session = requests.Session()
+    adapter = HTTPAdapter(
+        pool_connections=get_config('http_pool_connections'),
+        pool_maxsize=get_config('http_pool_maxsize'),
+        pool_block=get_config('http_pool_block'),
+        max_retries=get_config('http_max_retries'))
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
+    if not get_config('http_keep_alive'):
+        session.headers['Connection'] = 'close'
+    return session
+
+
+def get_session():
+    ''' process-wide requests.Session, re-created after a fork '''
+    global _session, _session_pid
+    pid = os.getpid()
+    if _session is not None and _session_pid == pid:
+        return _session
+    with _lock:
+        if _session is None or _session_pid != pid:
+            # don't close the inherited session: its sockets belong
+            # to the parent process.
+            logger.debug("Creating HTTP session for process {}".format(pid))
+            _session = build_session()
+            _session_pid = pid
+    return _session
+
+
+def reset_session():
+    ''' close and discard the current session (ie. after config change) '''
+    global _session, _session_pid
+    with _lock:
+        if _session is not None and _session_pid == os.getpid():
+            _session.close()
+        _session = None
+        _session_pid = None
+
+
+def request(method, url, **kwargs):
+    ''' perform an HTTP request through the shared session '''
+    kwargs.setdefault('timeout', get_config('http_timeout'))
+    started = time.time()
+    try:
+        response = get_session().request(method, url, **kwargs)
+    except Exception as exp:
+        record_api_call(method, url, time.time() - started, exception=exp)
+        raise
+    record_api_call(method, url, time.time() - started, response=response)
+    return response
+
+
+def get(url, **kwargs):
+    return request('GET', url, **kwargs)
+
+
+def post(url, **kwargs):
+    return request('POST', url, **kwargs)
+
+
+def delete(url, **kwargs):
+    return request('DELETE', url, **kwargs)
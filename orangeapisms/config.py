@@ -4,13 +4,25 @@
 
 from __future__ import (unicode_literals, absolute_import,
                         division, print_function)
+import abc
 import logging
 import os
+import time
 import importlib
+import tempfile
+import threading
+from contextlib import contextmanager
+
 import simplejson
+from py3compat import with_metaclass
 
 from orangeapisms.datetime import encode_datetime, decode_datetime
 
+try:
+    import fcntl
+except ImportError:  # not available on Windows
+    fcntl = None
+
 SETTINGS_FNAME = 'orangeapi.json'
 logger = logging.getLogger(__name__)
 
@@ -28,10 +40,135 @@ def get_settings_folder():
         importlib.import_module(os.environ['DJANGO_SETTINGS_MODULE']).__file__)
 
 
+def get_json_config_path():
+    return os.path.join(get_settings_folder(), SETTINGS_FNAME)
+
+
 def get_json_config():
-    with open(os.path.join(get_settings_folder(), SETTINGS_FNAME), 'r') as f:
+    return load_json(get_json_config_path())
+
+
+def load_json(path):
+    with open(path, 'r') as f:
         return simplejson.load(f, object_hook=decode_datetime)
 
+
+def atomic_write_json(path, data, **kwargs):
+    ''' replace path with JSON data so readers never see a partial file '''
+    folder = os.path.dirname(os.path.abspath(path))
+    fd, tmp_path = tempfile.mkstemp(dir=folder, prefix='.orangeapisms-')
+    try:
+        with os.fdopen(fd, 'w') as f:
+            simplejson.dump(data, f, default=encode_datetime, **kwargs)
+            f.flush()
+            os.fsync(f.fileno())
+        # rename is atomic: readers see either the old or the new file
+        os.rename(tmp_path, path)
+    except Exception:
+        os.unlink(tmp_path)
+        raise
+
+
+@contextmanager
+def file_lock(path):
+    ''' exclusive cross-process lock on `path`.lock (no-op on Windows) '''
+    if fcntl is None:
+        yield
+        return
+    with open('{}.lock'.format(path), 'a') as f:
+        fcntl.flock(f.fileno(), fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(f.fileno(), fcntl.LOCK_UN)
+
+
+class ConfigBackend(with_metaclass(abc.ABCMeta, object)):
+    ''' persistent storage for config values changed at runtime '''
+
+    @abc.abstractmethod
+    def load(self):
+        ''' stored values (overlaid on orangeapi.json) '''
+
+    @abc.abstractmethod
+    def save(self, changes):
+        ''' store changed values '''
+
+    @abc.abstractmethod
+    def version(self):
+        ''' cheap marker changing whenever another process saved '''
+
+
+class FileConfigBackend(ConfigBackend):
+    ''' orangeapi.json itself, rewritten atomically under a file lock '''
+
+    def __init__(self, path):
+        self.path = path
+
+    def load(self):
+        return load_json(self.path)
+
+    def save(self, changes):
+        with file_lock(self.path):
+            # merge into the current file so that concurrent saves of
+            # different keys by other processes are kept
+            data = self.load()
+            data.update(changes)
+            atomic_write_json(self.path, data, indent=4)
+
+    def version(self):
+        stat = os.stat(self.path)
+        return (stat.st_ino, stat.st_mtime, stat.st_size)
+
+
+class DatabaseConfigBackend(ConfigBackend):
+    ''' values in the ConfigEntry model '''
+
+    def load(self):
+        from orangeapisms.models import ConfigEntry
+        return {entry.key: entry.decoded_value
+                for entry in ConfigEntry.objects.all()}
+
+    def save(self, changes):
+        from orangeapisms.models import ConfigEntry
+        for key, value in changes.items():
+            ConfigEntry.objects.update_or_create(
+                key=key, defaults={'value': ConfigEntry.encode(value)})
+
+    def version(self):
+        from django.db.models import Count, Max
+        from orangeapisms.models import ConfigEntry
+        agg = ConfigEntry.objects.aggregate(Max('updated_on'), Count('key'))
+        return (agg['updated_on__max'], agg['key__count'])
+
+
+class CacheConfigBackend(ConfigBackend):
+    ''' values in a (shared) Django cache '''
+
+    key = 'orangeapisms:config'
+
+    def __init__(self, alias='default'):
+        self.alias = alias
+
+    @property
+    def cache(self):
+        from django.core.cache import caches
+        return caches[self.alias]
+
+    def load(self):
+        return self.cache.get(self.key) or {}
+
+    def save(self, changes):
+        data = self.load()
+        data.update(changes)
+        self.cache.set_many({self.key: data,
+                             '{}:version'.format(self.key): time.time()},
+                            None)
+
+    def version(self):
+        return self.cache.get('{}:version'.format(self.key))
+
+
 DEFAULT_CONFIG = {
     'handler_module': 'orangeapisms.stub',
     'use_db': True,
@@ -43,20 +180,175 @@ DEFAULT_CONFIG = {
     'client_id': None,
     'client_secret': None,
     'token': None,
+    'token_expiry': None,
+    'token_store': 'config',
+    'token_cache_alias': 'default',
+    'token_file': None,
+    'token_refresh_ahead': 300,
+    'token_background_refresh': True,
     'smsmtdr_subsription_id': None,
     'enable_tester': False,
     'default_sender_name': 'sender_address',
     'send_async': False,
     'celery_module': None,
+    'send_async_backend': 'celery',
+    'send_async_workers': 4,
+    'send_async_queue_size': 1000,
+    'handler_dispatch': 'inline',
+    'handler_workers': 4,
+    'handler_queue_size': 100,
+    'handler_retry_after': 5,
+    'mo_dedup_cache_size': 10000,
+    'mo_dedup_cache_alias': None,
+    'mo_dedup_ttl': 86400,
+    'write_behind': False,
+    'write_behind_max_rows': 500,
+    'write_behind_max_delay': 200,
+    'write_behind_folder': None,
+    'write_behind_fsync': True,
+    'write_behind_max_queue': 50000,
     'country': 'MLI',
     'country_prefix': '223',
     'fix_msisdn': True,
+    'msisdn_memo_size': 10000,
+    'gsm7_transliterate': False,
+    'count_segments': True,
+    'check_sms_balance': False,
+    'contracts_cache_ttl': 300,
+    'dr_subscription_cache_ttl': 3600,
+    'http_pool_connections': 4,
+    'http_pool_maxsize': 16,
+    'http_pool_block': False,
+    'http_keep_alive': True,
+    'http_max_retries': 0,
+    'http_timeout': 30,
+    'bulk_concurrency': 8,
+    'bulk_batch_size': 500,
+    'async_concurrency': 100,
+    'rate_limit_sender': None,
+    'rate_limit_contract': None,
+    'rate_limit_burst': None,
+    'rate_limit_store': 'local',
+    'rate_limit_folder': None,
+    'throttle_retries': 1,
+    'adaptive_concurrency': False,
+    'max_concurrency': 32,
+    'target_latency': 1.0,
+    'outbox_max_attempts': 5,
+    'outbox_backoff': 30,
+    'outbox_max_backoff': 3600,
+    'outbox_batch_size': 100,
+    'outbox_concurrency': 8,
+    'outbox_lease': 300,
+    'outbox_pending_grace': 120,
+    'config_backend': 'file',
+    'config_cache_alias': 'default',
+    'config_reload_interval': 5,
+    'metrics_enabled': True,
+    'metrics_store': 'local',
+    'metrics_folder': None,
+    'metrics_export_interval': 1,
+    'metrics_buckets': None,
+    'metrics_token': None,
+    'archive_folder': None,
+    'archive_after_days': 180,
+    'archive_chunk_size': 5000,
+    'rollups_enabled': True,
+    'search_backend': 'auto',
 }
 
-CONFIG = build_config(DEFAULT_CONFIG, get_json_config())
+JSON_CONFIG = get_json_config()
+CONFIG = build_config(DEFAULT_CONFIG, JSON_CONFIG)
+# values set with update_config(save=False), kept over reloads
+OVERRIDES = {}
+
+
+def get_config_backend(name):
+    if name == 'db':
+        return DatabaseConfigBackend()
+    if name == 'cache':
+        return CacheConfigBackend(CONFIG.get('config_cache_alias'))
+    return FileConfigBackend(get_json_config_path())
+
+
+class ConfigState(object):
+    backend = get_config_backend(CONFIG.get('config_backend'))
+    version = None
+    loaded = False
+    next_check = 0
+    # incremented on every CONFIG change, for values derived from config
+    generation = 0
+    # (pid, thread) of the background reloader
+    reloader = None
+
+
+_reloader_lock = threading.Lock()
+
+
+def reload_config(force=False):
+    ''' refresh CONFIG from backend if it changed since last load '''
+    try:
+        version = ConfigState.backend.version()
+        if not force and version == ConfigState.version:
+            ConfigState.loaded = True
+            return False
+        stored = ConfigState.backend.load()
+    except Exception as exp:
+        # DB or cache not ready yet (app loading) ; retry shortly
+        logger.debug("Unable to reload config: {}".format(exp))
+        ConfigState.next_check = time.time() + 1
+        return False
+    if not isinstance(ConfigState.backend, FileConfigBackend):
+        stored = dict(JSON_CONFIG, **stored)
+    fresh = build_config(DEFAULT_CONFIG, stored)
+    fresh.update(OVERRIDES)
+    # update in place: CONFIG keys are never removed so readers are safe
+    CONFIG.update(fresh)
+    ConfigState.version = version
+    ConfigState.loaded = True
+    ConfigState.generation += 1
+    return True
+
+
+def reload_loop(interval):
+    while True:
+        time.sleep(interval)
+        reload_config()
+
+
+def start_reloader(interval):
+    ''' background thread reloading config (one per pid: forks too) '''
+    pid = os.getpid()
+    reloader = ConfigState.reloader
+    if reloader is not None and reloader[0] == pid and reloader[1].is_alive():
+        return
+    with _reloader_lock:
+        reloader = ConfigState.reloader
+        if reloader is None or reloader[0] != pid or \
+                not reloader[1].is_alive():
+            thread = threading.Thread(target=reload_loop, args=(interval, ),
+                                      name='orangeapisms-config')
+            thread.daemon = True
+            thread.start()
+            ConfigState.reloader = (pid, thread)
+
+
+def check_config():
+    ''' load config from backend once, then from a background thread
+
+        so that readers never wait on the backend '''
+    interval = CONFIG.get('config_reload_interval')
+    if not interval:
+        return
+    ConfigState.next_check = time.time() + interval
+    if not ConfigState.loaded:
+        reload_config()
+    start_reloader(interval)
 
 
 def get_config(key, default=None, raw=False):
+    if ConfigState.next_check <= time.time():
+        check_config()
     if key == 'default_sender_name' and not raw:
         nkey = CONFIG.get(key, True)
         if nkey in CONFIG.keys():
@@ -66,7 +358,15 @@ def get_config(key, default=None, raw=False):
 
 def update_config(extra, save=False):
     CONFIG.update(extra)
-    if save:
-        with open(os.path.join(get_settings_folder(),
-                               SETTINGS_FNAME), 'w') as f:
-            simplejson.dump(CONFIG, f, default=encode_datetime, indent=4)
+    ConfigState.generation += 1
+    if not save:
+        OVERRIDES.update(extra)
+        return
+    for key in extra.keys():
+        OVERRIDES.pop(key, None)
+    ConfigState.backend.save(extra)
+    try:
+        # our own change ; no need to reload it
+        ConfigState.version = ConfigState.backend.version()
+    except Exception:
+        ConfigState.version = None
@@ -9,6 +9,7 @@ import datetime
 
 import pytz
 import iso8601
+from py3compat import string_types
 
 logger = logging.getLogger(__name__)
 UTC = pytz.utc
@@ -50,7 +51,11 @@ def encode_datetime(obj):
 
 
 def decode_datetime(obj):
-    if 'datetime' not in obj:
+    if isinstance(obj, dict):
+        # used as json object_hook
+        return {key: decode_datetime(value) for key, value in obj.items()}
+    if not isinstance(obj, string_types) or \
+            not obj.startswith('datetime:'):
         return obj
     _, aniso = obj.split('datetime:')
     return datetime_from_iso(aniso)
@@ -0,0 +1,65 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# vim: ai ts=4 sts=4 et sw=4 nu
+
+''' Recently received SMS-MO messageIds '''
+
+from __future__ import (unicode_literals, absolute_import,
+                        division, print_function)
+
+import logging
+import threading
+
+from orangeapisms.cache import LRUCache
+from orangeapisms.config import get_config
+
+logger = logging.getLogger(__name__)
+
+
+class MessageIdCache(object):
+    ''' messageId -> uuid (hex) of the stored SMS-MO '''
+
+    prefix = 'orangeapisms:mo:'
+
+    def __init__(self, size=10000, alias=None, ttl=86400):
+        self.local = LRUCache(size)
+        self.ttl = ttl
+        self.shared = None
+        if alias:
+            from django.core.cache import caches
+            self.shared = caches[alias]
+
+    def get(self, message_id):
+        suuid = self.local.get(message_id)
+        if suuid is None and self.shared is not None:
+            suuid = self.shared.get(self.prefix + message_id)
+            if suuid is not None:
+                self.local.set(message_id, suuid)
+        return suuid
+
+    def add(self, message_id, suuid):
+        self.local.set(message_id, suuid)
+        if self.shared is not None:
+            self.shared.set(self.prefix + message_id, suuid, self.ttl)
+
+    def discard(self, message_id):
+        self.local.delete(message_id)
+        if self.shared is not None:
+            self.shared.delete(self.prefix + message_id)
+
+
+_lock = threading.Lock()
+_cache = None
+
+
+def get_message_id_cache():
+    ''' process-wide MessageIdCache built from config '''
+    global _cache
+    if _cache is None:
+        with _lock:
+            if _cache is None:
+                _cache = MessageIdCache(
+                    size=get_config('mo_dedup_cache_size'),
+                    alias=get_config('mo_dedup_cache_alias'),
+                    ttl=get_config('mo_dedup_ttl'))
+    return _cache
@@ -0,0 +1,147 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# vim: ai ts=4 sts=4 et sw=4 nu
+
+''' Execution of SMS-MO and SMS-DR handlers (inline or on a thread pool) '''
+
+from __future__ import (unicode_literals, absolute_import,
+                        division, print_function)
+
+import math
+import time
+import logging
+import threading
+from collections import deque
+
+from orangeapisms.config import get_config
+from orangeapisms import metrics
+from orangeapisms.workers import get_executor
+
+logger = logging.getLogger(__name__)
+
+
+class HandlerStats(object):
+    ''' calls, failures and latency (seconds) of a handler '''
+
+    def __init__(self, window=1000):
+        self.calls = 0
+        self.failures = 0
+        self.total_time = 0
+        self.max_time = 0
+        self.latencies = deque(maxlen=window)
+        self.lock = threading.Lock()
+
+    def record(self, duration, failed=False):
+        with self.lock:
+            self.calls += 1
+            self.failures += int(failed)
+            self.total_time += duration
+            self.max_time = max(self.max_time, duration)
+            self.latencies.append(duration)
+
+    def percentile(self, percent):
+        ''' percentile (nearest-rank) of the most recent latencies '''
+        with self.lock:
+            latencies = sorted(self.latencies)
+        if not latencies:
+            return None
+        rank = int(math.ceil(percent / 100 * len(latencies)))
+        return latencies[max(rank, 1) - 1]
+
+    def snapshot(self):
+        return {
+            'calls': self.calls,
+            'failures': self.failures,
+            'mean': self.total_time / self.calls if self.calls else None,
+            'max': self.max_time,
+            'p50': self.percentile(50),
+            'p99': self.percentile(99),
+        }
+
+
+class HandlerDispatcher(object):
+    ''' runs handle_<slug>(msg) inline or on a bounded thread pool '''
+
+    def __init__(self, mode='inline', workers=4, queue_size=100):
+        self.mode = mode
+        self.workers = workers
+        self.queue_size = queue_size
+        self.stats = {}
+        self.lock = threading.Lock()
+
+    @property
+    def deferred(self):
+        return self.mode == 'thread'
+
+    @property
+    def executor(self):
+        return get_executor('handlers', max_workers=self.workers,
+                            queue_size=self.queue_size)
+
+    def get_stats(self, slug):
+        if slug not in self.stats:
+            with self.lock:
+                self.stats.setdefault(slug, HandlerStats())
+        return self.stats[slug]
+
+    def run(self, slug, msg):
+        ''' call the handler, recording its latency. exceptions propagate '''
+        from orangeapisms.utils import get_handler
+        started = time.time()
+        failed = True
+        try:
+            result = get_handler(slug)(msg)
+            failed = False
+            return result
+        finally:
+            duration = time.time() - started
+            self.get_stats(slug).record(duration, failed)
+            metrics.observe('orangeapisms_webhook_duration_seconds',
+                            duration, {'webhook': slug, 'phase': 'handler'})
+
+    def run_deferred(self, slug, msg):
+        try:
+            return self.run(slug, msg)
+        except Exception as exp:
+            logger.error("Exception in {slug} processing #{uuid}"
+                         .format(slug=slug, uuid=msg.suuid))
+            logger.exception(exp)
+
+    def reserve(self):
+        ''' whether a handler can be accepted. must be followed by
+            dispatch() or cancel() '''
+        return self.executor.reserve() if self.deferred else True
+
+    def cancel(self):
+        if self.deferred:
+            self.executor.cancel()
+
+    def dispatch(self, slug, msg):
+        ''' run handler for msg (after a successful reserve())
+
+            inline: returns the handler's result or raises
+            thread: returns a Future '''
+        if self.deferred:
+            return self.executor.submit_reserved(
+                self.run_deferred, slug, msg)
+        return self.run(slug, msg)
+
+    def snapshot(self):
+        return {slug: stats.snapshot() for slug, stats in self.stats.items()}
+
+
+_lock = threading.Lock()
+_dispatcher = None
+
+
+def get_dispatcher():
+    ''' process-wide HandlerDispatcher built from config '''
+    global _dispatcher
+    if _dispatcher is None:
+        with _lock:
+            if _dispatcher is None:
+                _dispatcher = HandlerDispatcher(
+                    mode=get_config('handler_dispatch'),
+                    workers=get_config('handler_workers'),
+                    queue_size=get_config('handler_queue_size'))
+    return _dispatcher
@@ -0,0 +1,461 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# vim: ai ts=4 sts=4 et sw=4 nu
+
+''' Local emulator of the Orange API endpoints used by this package '''
+
+from __future__ import (unicode_literals, absolute_import,
+                        division, print_function)
+
+import re
+import time
+import uuid
+import heapq
+import random
+import base64
+import logging
+import datetime
+import itertools
+import threading
+from wsgiref.simple_server import (make_server, WSGIServer,
+                                   WSGIRequestHandler)
+
+import requests
+import simplejson
+from concurrent.futures import ThreadPoolExecutor
+
+from orangeapisms.segments import count_segments
+
+try:
+    from socketserver import ThreadingMixIn
+except ImportError:  # python 2
+    from SocketServer import ThreadingMixIn
+
+logger = logging.getLogger(__name__)
+
+STATUSES = {200: 'OK', 201: 'Created', 204: 'No Content',
+            400: 'Bad Request', 401: 'Unauthorized', 403: 'Forbidden',
+            404: 'Not Found', 405: 'Method Not Allowed',
+            429: 'Too Many Requests', 500: 'Internal Server Error',
+            503: 'Service Unavailable'}
+
+OUTBOUND = r'^/smsmessaging/v1/outbound'
+ROUTES = [
+    ('POST', r'^/oauth/v2/token$', 'token'),
+    ('POST', OUTBOUND + r'/(?P<addr>[^/]+)/requests$', 'outbound'),
+    ('POST', OUTBOUND + r'/(?P<addr>[^/]+)/subscriptions$', 'subscribe'),
+    ('GET', OUTBOUND + r'/(?:[^/]+/)?subscriptions/(?P<sid>[^/]+)$',
+     'subscription'),
+    ('DELETE', OUTBOUND + r'/(?:[^/]+/)?subscriptions/(?P<sid>[^/]+)$',
+     'unsubscribe'),
+    ('GET', r'^/sms/admin/v1/contracts$', 'contracts'),
+    ('GET', r'^/emulator/stats$', 'stats'),
+]
+ROUTES = [(method, re.compile(pattern), name)
+          for method, pattern, name in ROUTES]
+
+
+def strip_tel(address):
+    return address[4:] if address.startswith('tel:') else address
+
+
+def error(code, message, description):
+    return {'code': code, 'message': message, 'description': description}
+
+
+def request_error(kind, message_id, text, variables=None):
+    return {'requestError': {kind: {
+        'messageId': message_id, 'text': text, 'variables': variables}}}
+
+
+INVALID_CREDENTIALS = error(41, "Invalid credentials",
+                            "The requested service needs credentials, "
+                            "but the ones provided were invalid.")
+EXPIRED_CREDENTIALS = error(42, "Expired credentials",
+                            "The requested service needs credentials, and "
+                            "the ones provided were out-of-date.")
+TOO_MANY_REQUESTS = error(53, "Too many requests",
+                          "The application has made too many calls and "
+                          "has exceeded the rate limit for this service.")
+SERVER_ERRORS = [
+    (500, error(1, "Internal error", "Try later.")),
+    (503, error(5, "The service is temporarily unavailable",
+                "Try later.")),
+]
+
+
+class DRScheduler(object):
+    ''' POSTs SMS-DR notifications once due, from a few threads '''
+
+    def __init__(self, workers=4):
+        self.queue = []
+        self.seq = itertools.count()
+        self.condition = threading.Condition()
+        self.executor = ThreadPoolExecutor(max_workers=workers)
+        self.thread = None
+        self.posted = 0
+        self.failed = 0
+
+    def schedule(self, delay, url, payload):
+        with self.condition:
+            heapq.heappush(self.queue, (time.time() + delay, next(self.seq),
+                                        url, payload))
+            self.condition.notify()
+        if self.thread is None:
+            self.start()
+
+    def start(self):
+        with self.condition:
+            if self.thread is not None:
+                return
+            self.thread = threading.Thread(target=self.run,
+                                           name='orangeapisms-emulator-dr')
+            self.thread.daemon = True
+            self.thread.start()
+
+    def run(self):
+        while True:
+            with self.condition:
+                while not self.queue or self.queue[0][0] > time.time():
+                    self.condition.wait(
+                        self.queue[0][0] - time.time() if self.queue
+                        else None)
+                _, _, url, payload = heapq.heappop(self.queue)
+            self.executor.submit(self.post, url, payload)
+
+    def post(self, url, payload):
+        try:
+            req = requests.post(url, json=payload, timeout=10)
+            req.raise_for_status()
+        except Exception as exp:
+            logger.warning("Unable to POST SMS-DR to {}: {}".format(url, exp))
+            with self.condition:
+                self.failed += 1
+            return
+        with self.condition:
+            self.posted += 1
+
+    @property
+    def pending(self):
+        return len(self.queue)
+
+
+class OrangeAPIEmulator(object):
+    ''' WSGI application emulating the Orange SMS API
+
+        latency: seconds added to each response (+ up to jitter)
+        error_rate: share of SMS-MT answered with a 500 or 503
+        throttle_rate: SMS-MT requests per second above which 429 are
+            returned (None: no throttling)
+        token_ttl: seconds before an issued token expires
+        units: SMS units available in contract (decremented per segment)
+        dr_delay: seconds before posting the SMS-DR (None: no SMS-DR)
+        dr_url: SMS-DR endpoint (default: subscribed notifyURL)
+        dr_failure_rate: share of SMS-DR with DeliveryImpossible
+        client_id, client_secret: checked if set '''
+
+    def __init__(self, latency=0, jitter=0, error_rate=0, throttle_rate=None,
+                 token_ttl=3600, units=100000, country='MLI', dr_delay=1,
+                 dr_url=None, dr_failure_rate=0, client_id=None,
+                 client_secret=None, seed=None):
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.throttle_rate = throttle_rate
+        self.token_ttl = token_ttl
+        self.units = units
+        self.country = country
+        self.dr_delay = dr_delay
+        self.dr_url = dr_url
+        self.dr_failure_rate = dr_failure_rate
+        self.client_id = client_id
+        self.client_secret = client_secret
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+        self.tokens = {}
+        self.subscriptions = {}
+        self.dr_scheduler = DRScheduler()
+        # throttling: requests of the current second
+        self.window = (0, 0)
+        self.counts = {'requests': 0, 'sent': 0, 'throttled': 0,
+                       'errors': 0, 'tokens': 0, 'expired': 0}
+
+    def __call__(self, environ, start_response):
+        if self.latency or self.jitter:
+            time.sleep(self.latency + self.random.uniform(0, self.jitter))
+        method = environ['REQUEST_METHOD']
+        path = environ.get('PATH_INFO', '')
+        status, body, headers = 404, request_error(
+            'serviceException', 'SVC0001', "Unknown resource %1", path), {}
+        for route_method, pattern, name in ROUTES:
+            match = pattern.match(path)
+            if match is None:
+                continue
+            if route_method != method:
+                status, body = 405, error(405, "Method not allowed", path)
+                continue
+            try:
+                status, body, headers = getattr(self, name)(
+                    environ, **match.groupdict())
+            except Exception as exp:
+                logger.exception(exp)
+                status, body = 500, error(1, "Internal error",
+                                          "{}".format(exp))
+            break
+
+        with self.lock:
+            self.counts['requests'] += 1
+        content = simplejson.dumps(body).encode('utf-8') \
+            if body is not None else b''
+        headers = dict(headers)
+        headers['Content-Type'] = 'application/json'
+        headers['Content-Length'] = str(len(content))
+        start_response(str('{} {}'.format(status, STATUSES.get(status, ''))),
+                       [(str(key), str(value))
+                        for key, value in headers.items()])
+        return [content]
+
+    # helpers
+
+    def read_json(self, environ):
+        try:
+            length = int(environ.get('CONTENT_LENGTH') or 0)
+        except ValueError:
+            length = 0
+        data = environ['wsgi.input'].read(length) if length else b''
+        return simplejson.loads(data.decode('utf-8')) if data else {}
+
+    def base_url(self, environ):
+        return '{scheme}://{host}'.format(
+            scheme=environ.get('wsgi.url_scheme', 'http'),
+            host=environ.get('HTTP_HOST') or '{}:{}'.format(
+                environ['SERVER_NAME'], environ['SERVER_PORT']))
+
+    def authenticate(self, environ):
+        ''' error response (status, body, headers) or None if valid '''
+        authorization = environ.get('HTTP_AUTHORIZATION', '')
+        token = authorization[len('Bearer '):] \
+            if authorization.startswith('Bearer ') else None
+        expiry = self.tokens.get(token)
+        if expiry is None:
+            return 401, INVALID_CREDENTIALS, {}
+        if expiry <= time.time():
+            with self.lock:
+                self.counts['expired'] += 1
+            return 401, EXPIRED_CREDENTIALS, {}
+        return None
+
+    def throttled(self):
+        ''' whether an SMS-MT request exceeds throttle_rate '''
+        if not self.throttle_rate:
+            return False
+        with self.lock:
+            second, count = self.window
+            now = int(time.time())
+            if second != now:
+                second, count = now, 0
+            self.window = (second, count + 1)
+            return count >= self.throttle_rate
+
+    def subscription_body(self, environ, sid):
+        subscription = self.subscriptions[sid]
+        return {'deliveryReceiptSubscription': {
+            'callbackReference': {'notifyURL': subscription['notifyURL']},
+            'resourceURL': '{base}/smsmessaging/v1/outbound/{addr}/'
+                           'subscriptions/{sid}'.format(
+                               base=self.base_url(environ),
+                               addr=subscription['sender'], sid=sid)}}
+
+    def notify_url(self, sender):
+        if self.dr_url:
+            return self.dr_url
+        for subscription in self.subscriptions.values():
+            if strip_tel(subscription['sender']) == strip_tel(sender):
+                return subscription['notifyURL']
+
+    # endpoints
+
+    def token(self, environ):
+        authorization = environ.get('HTTP_AUTHORIZATION', '')
+        if not authorization.startswith('Basic '):
+            return 401, {'error': 'invalid_client',
+                         'error_description': "Missing credentials"}, {}
+        if self.client_id is not None:
+            expected = base64.b64encode('{}:{}'.format(
+                self.client_id, self.client_secret).encode('utf-8'))
+            if authorization[len('Basic '):].encode('ascii') != expected:
+                return 401, {'error': 'invalid_client',
+                             'error_description': "Invalid credentials"}, {}
+
+        token = 'emulator{}'.format(uuid.uuid4().hex)
+        now = time.time()
+        with self.lock:
+            # forget long expired tokens
+            self.tokens = {key: expiry for key, expiry in self.tokens.items()
+                           if expiry > now - 3600}
+            self.tokens[token] = now + self.token_ttl
+            self.counts['tokens'] += 1
+        return 200, {'token_type': 'Bearer', 'access_token': token,
+                     'expires_in': '{}'.format(self.token_ttl)}, {}
+
+    def outbound(self, environ, addr):
+        failure = self.authenticate(environ)
+        if failure:
+            return failure
+        if self.throttled():
+            with self.lock:
+                self.counts['throttled'] += 1
+            return 429, TOO_MANY_REQUESTS, {'Retry-After': 1}
+        if self.random.random() < self.error_rate:
+            with self.lock:
+                self.counts['errors'] += 1
+            status, body = self.random.choice(SERVER_ERRORS)
+            return status, body, {}
+
+        try:
+            request = self.read_json(environ)['outboundSMSMessageRequest']
+            address = request['address']
+            message = request['outboundSMSTextMessage']['message']
+        except (ValueError, KeyError, TypeError):
+            return 400, request_error(
+                'serviceException', 'SVC0002', "Invalid input value for "
+                "message part %1", 'outboundSMSMessageRequest'), {}
+        if not address.startswith('tel:+'):
+            return 400, request_error(
+                'serviceException', 'SVC0004',
+                "No valid addresses provided in message part %1",
+                'address'), {}
+
+        units = max(count_segments(message).count, 1)
+        with self.lock:
+            if self.units < units:
+                return 403, request_error(
+                    'policyException', 'POL0001', "Policy error: %1",
+                    "Not enough units"), {}
+            self.units -= units
+            self.counts['sent'] += 1
+
+        reference = uuid.uuid4().hex
+        resource_url = '{base}/smsmessaging/v1/outbound/{addr}/requests/' \
+                       '{ref}'.format(base=self.base_url(environ), addr=addr,
+                                      ref=reference)
+        notify_url = self.notify_url(addr)
+        if notify_url and self.dr_delay is not None:
+            delivered = self.random.random() >= self.dr_failure_rate
+            self.dr_scheduler.schedule(self.dr_delay, notify_url, {
+                'deliveryInfoNotification': {
+                    'callbackData': request.get('callbackData'),
+                    'resourceURL': resource_url,
+                    'deliveryInfo': {
+                        'address': address,
+                        'deliveryStatus': 'DeliveredToTerminal' if delivered
+                        else 'DeliveryImpossible'}}})
+
+        request = dict(request)
+        request['resourceURL'] = resource_url
+        return 201, {'outboundSMSMessageRequest': request}, {}
+
+    def subscribe(self, environ, addr):
+        failure = self.authenticate(environ)
+        if failure:
+            return failure
+        try:
+            notify_url = self.read_json(environ)[
+                'deliveryReceiptSubscription']['callbackReference'][
+                'notifyURL']
+        except (ValueError, KeyError, TypeError):
+            return 400, request_error(
+                'serviceException', 'SVC0002', "Invalid input value for "
+                "message part %1", 'notifyURL'), {}
+        sid = uuid.uuid4().hex
+        with self.lock:
+            self.subscriptions[sid] = {'sender': addr,
+                                       'notifyURL': notify_url}
+        return 201, self.subscription_body(environ, sid), {}
+
+    def subscription(self, environ, sid):
+        failure = self.authenticate(environ)
+        if failure:
+            return failure
+        if sid not in self.subscriptions:
+            return 404, request_error('serviceException', 'SVC0001',
+                                      "Unknown subscription %1", sid), {}
+        return 200, self.subscription_body(environ, sid), {}
+
+    def unsubscribe(self, environ, sid):
+        failure = self.authenticate(environ)
+        if failure:
+            return failure
+        with self.lock:
+            if self.subscriptions.pop(sid, None) is None:
+                return 404, request_error('serviceException', 'SVC0001',
+                                          "Unknown subscription %1", sid), {}
+        return 204, None, {}
+
+    def contracts(self, environ):
+        failure = self.authenticate(environ)
+        if failure:
+            return failure
+        expires = datetime.datetime.utcnow() + datetime.timedelta(days=365)
+        return 200, {'partnerContracts': {
+            'partnerId': 'emulator',
+            'contracts': [{
+                'service': 'SMS_OCB',
+                'contractDescription': "Emulated contract",
+                'serviceContracts': [{
+                    'country': self.country,
+                    'service': 'SMS_OCB',
+                    'contractId': 'emulator',
+                    'availableUnits': self.units,
+                    'expires': expires.strftime('%Y-%m-%dT%H:%M:%S'),
+                    'scDescription': "Emulated units"}]}]}}, {}
+
+    def stats(self, environ):
+        with self.lock:
+            stats = dict(self.counts)
+        stats.update({'units': self.units,
+                      'subscriptions': len(self.subscriptions),
+                      'dr_pending': self.dr_scheduler.pending,
+                      'dr_posted': self.dr_scheduler.posted,
+                      'dr_failed': self.dr_scheduler.failed})
+        return 200, stats, {}
+
+
+class ThreadingWSGIServer(ThreadingMixIn, WSGIServer):
+    daemon_threads = True
+
+
+class QuietRequestHandler(WSGIRequestHandler):
+
+    def log_message(self, format, *args):
+        logger.debug("{} - {}".format(self.address_string(), format % args))
+
+
+def make_emulator_server(emulator, host='127.0.0.1', port=8085):
+    ''' threaded HTTP server for emulator (call serve_forever()) '''
+    return make_server(host, port, emulator,
+                       server_class=ThreadingWSGIServer,
+                       handler_class=QuietRequestHandler)
+
+
+def start_emulator(host='127.0.0.1', port=0, **kwargs):
+    ''' emulator server running in a background thread
+
+        port 0 picks a free port: see server.server_port.
+        stop it with server.shutdown() '''
+    server = make_emulator_server(OrangeAPIEmulator(**kwargs), host, port)
+    thread = threading.Thread(target=server.serve_forever,
+                              name='orangeapisms-emulator')
+    thread.daemon = True
+    thread.start()
+    return server
+
+
+def emulator_config(host='127.0.0.1', port=8085):
+    ''' config entries pointing this package to an emulator '''
+    base = 'http://{}:{}'.format(host, port)
+    return {
+        'oauth_url': '{}/oauth/v2'.format(base),
+        'smsmt_url': '{}/smsmessaging/v1'.format(base),
+        'smsadmin_url': '{}/sms/admin/v1'.format(base),
+    }
@@ -7,13 +7,28 @@ from __future__ import (unicode_literals, absolute_import,
 import logging
 import re
 
+import requests
 from py3compat import string_types
 
 logger = logging.getLogger(__name__)
 
 
+# connection errors, timeouts (orangeapisms.aio adds aiohttp's)
+CONNECTION_ERRORS = (requests.RequestException,)
+
+
+def is_retryable(exp):
+    ''' whether a submission failing with exp might succeed later '''
+    if isinstance(exp, OrangeAPIError):
+        return exp.is_transient
+    return isinstance(exp, CONNECTION_ERRORS)
+
+
 class OrangeAPIError(Exception):
 
+    # HTTP statuses of errors not related to the request itself
+    TRANSIENT_HTTP_CODES = (408, 429, 500, 502, 503, 504)
+
     def __init__(self,
                  http_code, error_code=None,
                  message=None, description=None,
@@ -28,6 +43,10 @@ class OrangeAPIError(Exception):
     def code(self):
         return self.error_code
 
+    @property
+    def is_transient(self):
+        return self.http_code in self.TRANSIENT_HTTP_CODES
+
     @classmethod
     def from_request(cls, request):
         try:
@@ -73,7 +92,7 @@ class OrangeAPIError(Exception):
         # unexpected answer (probably empty)
         if not len([k for k in ('code', 'error', 'requestError')
                     if k in response.keys()]):
-            return cls.generic_http(request.http_code)
+            return cls.generic_http(request.status_code)
 
         # regular API error syntax
         if "code" in response.keys():
@@ -102,3 +121,14 @@ class OrangeAPIError(Exception):
     def __str__(self):
         return "<{cls} {text}>".format(cls=self.__class__.__name__,
                                        text=self.to_text())
+
+
+class InsufficientBalance(Exception):
+    ''' SMS balance doesn't allow sending (see check_sms_balance) '''
+
+    def __init__(self, units, *args, **kwargs):
+        super(InsufficientBalance, self).__init__(*args, **kwargs)
+        self.units = units
+
+    def __str__(self):
+        return "Insufficient SMS balance to send {} units".format(self.units)
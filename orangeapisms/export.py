@@ -0,0 +1,108 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# vim: ai ts=4 sts=4 et sw=4 nu
+
+''' Streaming export of SMSMessage rows as CSV or JSON-lines '''
+
+from __future__ import (unicode_literals, absolute_import,
+                        division, print_function)
+
+import csv
+import logging
+
+import iso8601
+import simplejson
+from django.http import StreamingHttpResponse
+from py3compat import PY2, text_type
+
+from orangeapisms.models import SMSMessage
+from orangeapisms.datetime import UTC
+from orangeapisms.pagination import keyset_chunks
+
+logger = logging.getLogger(__name__)
+
+CSV = 'csv'
+JSONL = 'jsonl'
+FORMATS = (CSV, JSONL)
+CONTENT_TYPES = {
+    CSV: 'text/csv; charset=utf-8',
+    JSONL: 'application/x-ndjson; charset=utf-8',
+}
+FIELDS = ('uuid', 'direction', 'sms_type', 'created_on', 'delivery_status_on',
+          'sender_address', 'destination_address', 'message_id',
+          'reference_code', 'content', 'status')
+CHUNK_SIZE = 1000
+
+
+def parse_date(value, name):
+    ''' aware datetime from an ISO 8601 date or datetime (UTC if naive) '''
+    try:
+        return iso8601.parse_date(value, default_timezone=UTC)
+    except (iso8601.ParseError, TypeError):
+        raise ValueError("Invalid {}: `{}`".format(name, value))
+
+
+def filtered_messages(params, queryset=None):
+    ''' messages matching filters of params (ie. request.GET)
+
+        sms_type, status, direction: values of the model choices
+        since (included), until (excluded): ISO 8601 date or datetime '''
+    queryset = queryset if queryset is not None \
+        else SMSMessage.objects.all()
+    for field, choices in (('sms_type', SMSMessage.TYPES),
+                           ('status', SMSMessage.STATUSES),
+                           ('direction', SMSMessage.DIRECTIONS)):
+        value = params.get(field)
+        if not value:
+            continue
+        if value not in choices:
+            raise ValueError("Invalid {}: `{}`".format(field, value))
+        queryset = queryset.filter(**{field: value})
+    if params.get('since'):
+        queryset = queryset.filter(
+            created_on__gte=parse_date(params.get('since'), 'since'))
+    if params.get('until'):
+        queryset = queryset.filter(
+            created_on__lt=parse_date(params.get('until'), 'until'))
+    return queryset
+
+
+class Echo(object):
+    ''' pseudo-buffer for csv.writer: write() returns the written line '''
+
+    def write(self, value):
+        return value
+
+
+def export_lines(queryset, fmt, chunk_size=CHUNK_SIZE):
+    ''' lines of the export file (generator), oldest messages first '''
+    if fmt == CSV:
+        writer = csv.writer(Echo())
+        header = list(FIELDS)
+        if PY2:
+            header = [field.encode('utf-8') for field in header]
+        yield writer.writerow(header)
+    for messages in keyset_chunks(queryset, chunk_size):
+        for msg in messages:
+            data = msg.to_dict()
+            if fmt == JSONL:
+                yield simplejson.dumps(data) + '\n'
+                continue
+            row = ['' if data[field] is None else data[field]
+                   for field in FIELDS]
+            if PY2:
+                # py2 csv only deals with bytes
+                row = [text_type(value).encode('utf-8')
+                       for value in row]
+            yield writer.writerow(row)
+
+
+def export_response(queryset, fmt=CSV, filename='sms-messages'):
+    ''' StreamingHttpResponse of queryset as an fmt file attachment '''
+    if fmt not in FORMATS:
+        raise ValueError("Invalid format: `{}`".format(fmt))
+    response = StreamingHttpResponse(export_lines(queryset, fmt),
+                                     content_type=CONTENT_TYPES[fmt])
+    response['Content-Disposition'] = 'attachment; filename="{}.{}"' \
+        .format(filename, fmt)
+    return response
@@ -0,0 +1,74 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# vim: ai ts=4 sts=4 et sw=4 nu
+
+from __future__ import (unicode_literals, absolute_import,
+                        division, print_function)
+import time
+import logging
+import datetime
+
+from django.core.management.base import BaseCommand, CommandError
+from django.utils import timezone
+
+from orangeapisms.archive import archive_messages, get_archive_folder
+from orangeapisms.config import get_config
+
+logger = logging.getLogger(__name__)
+
+
+class Command(BaseCommand):
+    help = "Move old messages out of the database to compressed archives"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--days', type=int,
+                            default=get_config('archive_after_days'),
+                            help="Archive messages older than that")
+        parser.add_argument('--before',
+                            help="Archive messages created before that "
+                                 "date (YYYY-MM-DD, UTC) instead")
+        parser.add_argument('--folder', default=None,
+                            help="Archives folder (default: {})"
+                                 .format(get_archive_folder()))
+        parser.add_argument('--chunk-size', type=int,
+                            default=get_config('archive_chunk_size'),
+                            help="Messages archived per transaction")
+        parser.add_argument('--pause', type=float, default=0,
+                            help="Seconds to wait between chunks")
+        parser.add_argument('--limit', type=int,
+                            help="Maximum messages archived in this run")
+        parser.add_argument('--dry-run', action='store_true', default=False,
+                            help="Count archivable messages only")
+
+    def handle(self, *args, **options):
+        if options['before']:
+            try:
+                day = datetime.datetime.strptime(options['before'],
+                                                 '%Y-%m-%d')
+            except ValueError:
+                raise CommandError("Invalid date `{}`"
+                                   .format(options['before']))
+            cutoff = timezone.make_aware(day, timezone.utc)
+        else:
+            cutoff = timezone.now() - datetime.timedelta(
+                days=options['days'])
+
+        self.stdout.write("Archiving messages created before {}"
+                          .format(cutoff.isoformat()))
+        started = time.time()
+        last_report = [started]
+
+        def progress(archived):
+            if time.time() - last_report[0] >= 5:
+                self.stdout.write("{} messages archived ({:.0f}/s)".format(
+                    archived, archived / (time.time() - started)))
+                last_report[0] = time.time()
+
+        archived = archive_messages(
+            cutoff, folder=options['folder'],
+            chunk_size=options['chunk_size'], pause=options['pause'],
+            limit=options['limit'], dry_run=options['dry_run'],
+            progress=progress)
+        self.stdout.write("{verb} {count} messages in {duration:.1f}s".format(
+            verb="Found" if options['dry_run'] else "Archived",
+            count=archived, duration=time.time() - started))
@@ -0,0 +1,105 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# vim: ai ts=4 sts=4 et sw=4 nu
+
+from __future__ import (unicode_literals, absolute_import,
+                        division, print_function)
+import io
+import time
+import logging
+
+from django.core.management.base import BaseCommand, CommandError
+
+from orangeapisms.campaign import Campaign, MessageTemplate, FORMATS
+from orangeapisms.config import get_config
+
+logger = logging.getLogger(__name__)
+
+
+class Command(BaseCommand):
+    help = "Send a templated SMS-MT to each row of a CSV or JSON-lines file"
+
+    def add_arguments(self, parser):
+        parser.add_argument('source',
+                            help="CSV (with header) or JSON-lines file")
+        template = parser.add_mutually_exclusive_group()
+        template.add_argument('--template',
+                              help="Message with {column} placeholders")
+        template.add_argument('--template-file',
+                              help="File containing the message template")
+        parser.add_argument('--format', choices=FORMATS,
+                            help="Source format (default: from extension)")
+        parser.add_argument('--number-field', default='number',
+                            help="Column holding recipients' numbers")
+        parser.add_argument('--sender-name',
+                            default=get_config('default_sender_name'))
+        parser.add_argument('--batch-size', type=int,
+                            default=get_config('bulk_batch_size'),
+                            help="Rows processed at once")
+        parser.add_argument('--concurrency', type=int,
+                            default=get_config('bulk_concurrency'),
+                            help="Concurrent API requests")
+        parser.add_argument('--checkpoint',
+                            help="Checkpoint file (default: "
+                                 "<source>.checkpoint)")
+        parser.add_argument('--restart', action='store_true', default=False,
+                            help="Ignore checkpoint and start over")
+        parser.add_argument('--no-db', action='store_true', default=False,
+                            help="Don't record messages in DB")
+        parser.add_argument('--dry-run', action='store_true', default=False,
+                            help="Render messages and count units only")
+        parser.add_argument('--progress-interval', type=float, default=5,
+                            help="Seconds between progress lines")
+
+    def handle(self, *args, **options):
+        if options['template_file']:
+            with io.open(options['template_file'], encoding='utf-8') as f:
+                text = f.read().strip()
+        elif options['template']:
+            text = options['template']
+        else:
+            raise CommandError("--template or --template-file is required")
+        try:
+            template = MessageTemplate(text)
+        except ValueError as exp:
+            raise CommandError(exp)
+
+        campaign = Campaign(
+            options['source'], template, fmt=options['format'],
+            number_field=options['number_field'],
+            sender_name=options['sender_name'],
+            batch_size=options['batch_size'],
+            concurrency=options['concurrency'],
+            checkpoint=options['checkpoint'],
+            db_save=False if options['no_db'] else None,
+            dry_run=options['dry_run'])
+        if options['restart']:
+            campaign.restart()
+
+        last_report = [time.time()]
+
+        def progress(stats):
+            if time.time() - last_report[0] >= options['progress_interval']:
+                self.report(stats)
+                last_report[0] = time.time()
+
+        try:
+            stats = campaign.run(progress=progress)
+        except ValueError as exp:
+            raise CommandError(exp)
+        except KeyboardInterrupt:
+            self.report(campaign.stats())
+            raise CommandError("Interrupted. Run again to resume from row "
+                               "{}".format(campaign.state['offset'] + 1))
+
+        if campaign.started_on is None:
+            self.stdout.write("Campaign already completed. Use --restart "
+                              "to send it again")
+            return
+        self.report(stats)
+        self.stdout.write("Done in {:.1f}s".format(stats['elapsed']))
+
+    def report(self, stats):
+        self.stdout.write(
+            "{offset} rows: {sent} sent, {failed} failed, {rejected} "
+            "rejected, {units} units. {rate:.1f} rows/s".format(**stats))
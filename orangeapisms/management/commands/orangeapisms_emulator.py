@@ -0,0 +1,75 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# vim: ai ts=4 sts=4 et sw=4 nu
+
+from __future__ import (unicode_literals, absolute_import,
+                        division, print_function)
+import logging
+
+import simplejson
+from django.core.management.base import BaseCommand
+
+from orangeapisms.emulator import (OrangeAPIEmulator, make_emulator_server,
+                                   emulator_config)
+
+logger = logging.getLogger(__name__)
+
+
+class Command(BaseCommand):
+    help = "Run a local emulator of the Orange SMS API (no SMS is sent)"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--host', default='127.0.0.1')
+        parser.add_argument('--port', type=int, default=8085)
+        parser.add_argument('--latency', type=float, default=0,
+                            help="Seconds added to each response")
+        parser.add_argument('--jitter', type=float, default=0,
+                            help="Up to that many more seconds (random)")
+        parser.add_argument('--error-rate', type=float, default=0,
+                            help="Share of SMS-MT failing with 500/503")
+        parser.add_argument('--throttle-rate', type=int,
+                            help="SMS-MT per second before answering 429")
+        parser.add_argument('--token-ttl', type=int, default=3600,
+                            help="Seconds before tokens expire")
+        parser.add_argument('--units', type=int, default=100000,
+                            help="SMS units available in contract")
+        parser.add_argument('--country', default='MLI')
+        parser.add_argument('--dr-delay', type=float, default=1,
+                            help="Seconds before posting SMS-DR")
+        parser.add_argument('--no-dr', action='store_true', default=False,
+                            help="Don't post SMS-DR")
+        parser.add_argument('--dr-url',
+                            help="SMS-DR endpoint (default: subscribed one)")
+        parser.add_argument('--dr-failure-rate', type=float, default=0,
+                            help="Share of SMS-DR not delivered")
+        parser.add_argument('--seed', type=int,
+                            help="Random seed for reproducible runs")
+
+    def handle(self, *args, **options):
+        emulator = OrangeAPIEmulator(
+            latency=options['latency'],
+            jitter=options['jitter'],
+            error_rate=options['error_rate'],
+            throttle_rate=options['throttle_rate'],
+            token_ttl=options['token_ttl'],
+            units=options['units'],
+            country=options['country'],
+            dr_delay=None if options['no_dr'] else options['dr_delay'],
+            dr_url=options['dr_url'],
+            dr_failure_rate=options['dr_failure_rate'],
+            seed=options['seed'])
+        server = make_emulator_server(emulator, options['host'],
+                                      options['port'])
+
+        self.stdout.write("Orange API emulator listening on {}:{}"
+                          .format(options['host'], server.server_port))
+        self.stdout.write("Point orangeapisms to it with:\n{}".format(
+            simplejson.dumps(emulator_config(options['host'],
+                                             server.server_port),
+                             indent=4)))
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            server.server_close()
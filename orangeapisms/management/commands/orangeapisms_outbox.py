@@ -0,0 +1,55 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# vim: ai ts=4 sts=4 et sw=4 nu
+
+from __future__ import (unicode_literals, absolute_import,
+                        division, print_function)
+import time
+import logging
+from concurrent.futures import ThreadPoolExecutor
+
+from django.core.management.base import BaseCommand
+
+from orangeapisms.config import get_config
+from orangeapisms.outbox import drain_batch, get_worker_id
+
+logger = logging.getLogger(__name__)
+
+
+class Command(BaseCommand):
+    help = "Submit pending SMS-MT and retry failed ones from the outbox"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int,
+                            default=get_config('outbox_batch_size'),
+                            help="Messages claimed at once")
+        parser.add_argument('--concurrency', type=int,
+                            default=get_config('outbox_concurrency'),
+                            help="Concurrent API requests")
+        parser.add_argument('--interval', type=float, default=5,
+                            help="Seconds to wait when outbox is empty")
+        parser.add_argument('--once', action='store_true', default=False,
+                            help="Exit once the outbox is empty")
+
+    def handle(self, *args, **options):
+        worker_id = get_worker_id()
+        self.stdout.write("Outbox worker {} started".format(worker_id))
+
+        with ThreadPoolExecutor(
+                max_workers=options['concurrency']) as executor:
+            while True:
+                messages = drain_batch(executor,
+                                       batch_size=options['batch_size'],
+                                       worker_id=worker_id)
+                if messages:
+                    sent = len([msg for msg in messages
+                                if msg.status == msg.SENT])
+                    self.stdout.write(
+                        "Processed {total} SMS-MT: {sent} sent, "
+                        "{failed} failed".format(
+                            total=len(messages), sent=sent,
+                            failed=len(messages) - sent))
+                    continue
+                if options['once']:
+                    break
+                time.sleep(options['interval'])
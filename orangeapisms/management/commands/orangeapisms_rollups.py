@@ -0,0 +1,59 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# vim: ai ts=4 sts=4 et sw=4 nu
+
+from __future__ import (unicode_literals, absolute_import,
+                        division, print_function)
+import time
+import logging
+import datetime
+
+from django.core.management.base import BaseCommand, CommandError
+from django.utils import timezone
+
+from orangeapisms.rollups import rebuild, utc_day
+
+logger = logging.getLogger(__name__)
+
+
+def parse_day(value):
+    try:
+        return datetime.datetime.strptime(value, '%Y-%m-%d').date()
+    except ValueError:
+        raise CommandError("Invalid date `{}`".format(value))
+
+
+class Command(BaseCommand):
+    help = "Rebuild daily rollups from the messages table (backfill)"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--since',
+                            help="First day to rebuild (YYYY-MM-DD, UTC). "
+                                 "Default: day of the oldest message")
+        parser.add_argument('--until',
+                            help="Last day to rebuild (YYYY-MM-DD, UTC). "
+                                 "Default: day of the latest message")
+        parser.add_argument('--days', type=int,
+                            help="Rebuild the last DAYS days (today "
+                                 "included) instead of --since/--until")
+
+    def handle(self, *args, **options):
+        since = parse_day(options['since']) if options['since'] else None
+        until = parse_day(options['until']) if options['until'] else None
+        if options['days'] is not None:
+            if options['days'] < 1:
+                raise CommandError("--days must be positive")
+            until = utc_day(timezone.now())
+            since = until - datetime.timedelta(days=options['days'] - 1)
+        if since and until and since > until:
+            raise CommandError("--since is after --until")
+
+        started = time.time()
+
+        def progress(day, count):
+            self.stdout.write("{day}: {count} messages".format(
+                day=day.isoformat(), count=count))
+
+        days = rebuild(since, until, progress=progress)
+        self.stdout.write("Rebuilt {days} days in {duration:.1f}s".format(
+            days=days, duration=time.time() - started))
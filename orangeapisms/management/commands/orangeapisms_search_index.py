@@ -0,0 +1,34 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# vim: ai ts=4 sts=4 et sw=4 nu
+
+from __future__ import (unicode_literals, absolute_import,
+                        division, print_function)
+import time
+import logging
+
+from django.core.management.base import BaseCommand
+from django.db import connections, transaction
+
+from orangeapisms.search import database_backend
+
+logger = logging.getLogger(__name__)
+
+
+class Command(BaseCommand):
+    help = "Create the full-text search index if missing and reindex messages"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--database', default='default',
+                            help="Database alias")
+
+    def handle(self, *args, **options):
+        connection = connections[options['database']]
+        backend = database_backend(connection)
+        started = time.time()
+        with transaction.atomic(using=connection.alias):
+            backend.install(connection)
+            backend.rebuild(connection)
+        self.stdout.write("{backend} index ready in {duration:.1f}s".format(
+            backend=type(backend).__name__,
+            duration=time.time() - started))
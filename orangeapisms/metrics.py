@@ -0,0 +1,362 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# vim: ai ts=4 sts=4 et sw=4 nu
+
+''' Counters and latency histograms, exposed in Prometheus text format '''
+
+from __future__ import (unicode_literals, absolute_import,
+                        division, print_function)
+
+import os
+import re
+import glob
+import time
+import errno
+import atexit
+import socket
+import logging
+import tempfile
+import threading
+from contextlib import contextmanager
+
+from orangeapisms.config import (get_config, atomic_write_json, load_json,
+                                 file_lock)
+
+logger = logging.getLogger(__name__)
+
+COUNTER = 'counter'
+HISTOGRAM = 'histogram'
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+METRICS = {
+    'orangeapisms_api_requests_total': (
+        COUNTER, "Orange API calls"),
+    'orangeapisms_api_request_duration_seconds': (
+        HISTOGRAM, "Orange API calls duration"),
+    'orangeapisms_webhook_requests_total': (
+        COUNTER, "SMS-MO and SMS-DR notifications received"),
+    'orangeapisms_webhook_duration_seconds': (
+        HISTOGRAM, "Notifications processing time, by phase"),
+    'orangeapisms_token_refreshes_total': (
+        COUNTER, "OAuth token requests"),
+    'orangeapisms_token_refresh_duration_seconds': (
+        HISTOGRAM, "OAuth token requests duration"),
+}
+
+ENDPOINTS = [
+    ('token', re.compile(r'/token$')),
+    ('smsmt', re.compile(r'/outbound/[^/]+/requests$')),
+    ('subscriptions', re.compile(r'/subscriptions(/[^/]+)?$')),
+    ('contracts', re.compile(r'/contracts$')),
+]
+
+
+def endpoint_name(url):
+    ''' label of an API URL (query string ignored) '''
+    path = url.split('?', 1)[0]
+    for name, pattern in ENDPOINTS:
+        if pattern.search(path):
+            return name
+    return 'other'
+
+
+def labels_key(labels):
+    return tuple(sorted((key, '{}'.format(value))
+                        for key, value in (labels or {}).items()))
+
+
+class MetricsRegistry(object):
+    ''' metrics of this process
+
+        histograms are [cumulative bucket counts..., sum, count] '''
+
+    def __init__(self, buckets=BUCKETS):
+        self.buckets = tuple(buckets)
+        self.lock = threading.Lock()
+        self.counters = {}
+        self.histograms = {}
+        self.changed = False
+
+    def inc(self, name, labels=None, value=1):
+        key = (name, labels_key(labels))
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+            self.changed = True
+
+    def observe(self, name, value, labels=None):
+        key = (name, labels_key(labels))
+        with self.lock:
+            histogram = self.histograms.get(key)
+            if histogram is None:
+                histogram = self.histograms[key] = \
+                    [0] * (len(self.buckets) + 2)
+            for index, bound in enumerate(self.buckets):
+                if value <= bound:
+                    histogram[index] += 1
+            histogram[-2] += value
+            histogram[-1] += 1
+            self.changed = True
+
+    def dump(self):
+        ''' JSON-able copy of the metrics '''
+        with self.lock:
+            return {
+                'buckets': list(self.buckets),
+                'counters': [[name, [list(pair) for pair in labels], value]
+                             for (name, labels), value
+                             in self.counters.items()],
+                'histograms': [[name, [list(pair) for pair in labels],
+                                list(values)]
+                               for (name, labels), values
+                               in self.histograms.items()],
+            }
+
+
+def merge(dumps):
+    ''' sum of several MetricsRegistry.dump() '''
+    counters, histograms, buckets = {}, {}, None
+    for data in dumps:
+        for name, labels, value in data['counters']:
+            key = (name, tuple(tuple(pair) for pair in labels))
+            counters[key] = counters.get(key, 0) + value
+        if buckets is None:
+            buckets = data['buckets']
+        if data['histograms'] and data['buckets'] != buckets:
+            logger.warning("Skipping histograms with other buckets")
+            continue
+        for name, labels, values in data['histograms']:
+            key = (name, tuple(tuple(pair) for pair in labels))
+            if key not in histograms:
+                histograms[key] = [0] * len(values)
+            histograms[key] = [total + value for total, value
+                               in zip(histograms[key], values)]
+    return {'buckets': buckets, 'counters': counters,
+            'histograms': histograms}
+
+
+def to_dump(merged):
+    ''' MetricsRegistry.dump() like copy of merged metrics '''
+    return {
+        'buckets': merged['buckets'] or [],
+        'counters': [[name, [list(pair) for pair in labels], value]
+                     for (name, labels), value in merged['counters'].items()],
+        'histograms': [[name, [list(pair) for pair in labels], values]
+                       for (name, labels), values
+                       in merged['histograms'].items()],
+    }
+
+
+def is_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except OSError as exp:
+        return exp.errno != errno.ESRCH
+    return True
+
+
+def format_labels(labels, **extra):
+    pairs = list(labels) + sorted(extra.items())
+    if not pairs:
+        return ''
+    return '{{{}}}'.format(','.join(
+        '{}="{}"'.format(key, '{}'.format(value).replace('\\', '\\\\')
+                         .replace('"', '\\"').replace('\n', '\\n'))
+        for key, value in pairs))
+
+
+def format_value(value):
+    if isinstance(value, float):
+        return repr(value)
+    return '{}'.format(value)
+
+
+def render(merged):
+    ''' Prometheus text exposition (version 0.0.4) of merged metrics '''
+    lines = []
+    buckets = merged['buckets']
+    for name in sorted(METRICS):
+        kind, help_text = METRICS[name]
+        series = merged['counters'] if kind == COUNTER \
+            else merged['histograms']
+        keys = sorted(key for key in series if key[0] == name)
+        if not keys:
+            continue
+        lines.append('# HELP {} {}'.format(name, help_text))
+        lines.append('# TYPE {} {}'.format(name, kind))
+        for key in keys:
+            labels, values = key[1], series[key]
+            if kind == COUNTER:
+                lines.append('{}{} {}'.format(
+                    name, format_labels(labels), format_value(values)))
+                continue
+            for bound, count in zip(buckets, values):
+                lines.append('{}_bucket{} {}'.format(
+                    name, format_labels(labels, le=bound), count))
+            lines.append('{}_bucket{} {}'.format(
+                name, format_labels(labels, le='+Inf'), values[-1]))
+            lines.append('{}_sum{} {}'.format(
+                name, format_labels(labels), format_value(values[-2])))
+            lines.append('{}_count{} {}'.format(
+                name, format_labels(labels), values[-1]))
+    return '\n'.join(lines) + '\n'
+
+
+class FileExporter(object):
+    ''' dumps a registry to its own file of a shared folder '''
+
+    prefix = 'orangeapisms-metrics-'
+
+    def __init__(self, registry, folder=None, interval=1):
+        self.registry = registry
+        self.folder = folder or tempfile.gettempdir()
+        self.interval = interval
+        self.host = socket.gethostname()[:40]
+        self.path = self.path_for(os.getpid())
+        # sum of exited processes of this host
+        self.retired_path = self.path_for('retired')
+        self.thread = None
+
+    def path_for(self, pid):
+        return os.path.join(self.folder, '{prefix}{host}-{pid}.json'.format(
+            prefix=self.prefix, host=self.host, pid=pid))
+
+    def start(self):
+        self.thread = threading.Thread(target=self.run,
+                                       name='orangeapisms-metrics')
+        self.thread.daemon = True
+        self.thread.start()
+        atexit.register(self.export)
+
+    def run(self):
+        while True:
+            time.sleep(self.interval)
+            if self.registry.changed:
+                try:
+                    self.export()
+                except Exception as exp:
+                    logger.error("Unable to export metrics. {}".format(exp))
+
+    def export(self):
+        # changes made while writing are exported next time
+        self.registry.changed = False
+        atomic_write_json(self.path, self.registry.dump())
+
+    def exited(self):
+        ''' paths of dumps of exited processes of this host '''
+        pattern = re.compile(r'^{}{}-(\d+)\.json$'.format(
+            re.escape(self.prefix), re.escape(self.host)))
+        for path in glob.glob(self.path_for('*')):
+            match = pattern.match(os.path.basename(path))
+            if match and not is_alive(int(match.group(1))):
+                yield path
+
+    def compact(self):
+        ''' merge dumps of exited processes into the retired one '''
+        if os.name != 'posix':
+            # no signal 0 to check processes
+            return
+        with file_lock(self.retired_path):
+            paths = list(self.exited())
+            if not paths:
+                return
+            dumps = []
+            for path in [self.retired_path] + paths:
+                try:
+                    dumps.append(load_json(path))
+                except (IOError, OSError, ValueError):
+                    continue
+            atomic_write_json(self.retired_path, to_dump(merge(dumps)))
+            for path in paths:
+                os.unlink(path)
+
+    def collect(self):
+        ''' dumps of all processes, ours being live '''
+        try:
+            self.compact()
+        except (IOError, OSError, ValueError) as exp:
+            logger.warning("Unable to compact metrics: {}".format(exp))
+        dumps = [self.registry.dump()]
+        for path in glob.glob(os.path.join(
+                self.folder, '{}*.json'.format(self.prefix))):
+            if path == self.path:
+                continue
+            try:
+                dumps.append(load_json(path))
+            except (IOError, OSError, ValueError) as exp:
+                logger.warning("Unable to read metrics {}: {}"
+                               .format(path, exp))
+        return dumps
+
+
+_lock = threading.Lock()
+_registries = {}
+
+
+def get_registry():
+    ''' (registry, exporter or None) of this process, built from config '''
+    pid = os.getpid()
+    if pid not in _registries:
+        with _lock:
+            if pid not in _registries:
+                registry = MetricsRegistry(
+                    get_config('metrics_buckets') or BUCKETS)
+                exporter = None
+                if get_config('metrics_store') == 'file':
+                    exporter = FileExporter(
+                        registry, folder=get_config('metrics_folder'),
+                        interval=get_config('metrics_export_interval'))
+                    exporter.start()
+                # a forked child must not report its parent's metrics
+                _registries.clear()
+                _registries[pid] = (registry, exporter)
+    return _registries[pid]
+
+
+def inc(name, labels=None, value=1):
+    if get_config('metrics_enabled'):
+        get_registry()[0].inc(name, labels, value)
+
+
+def observe(name, value, labels=None):
+    if get_config('metrics_enabled'):
+        get_registry()[0].observe(name, value, labels)
+
+
+@contextmanager
+def timed(name, labels=None):
+    ''' observe duration of the with block (even if it raises) '''
+    started = time.time()
+    try:
+        yield
+    finally:
+        observe(name, time.time() - started, labels)
+
+
+def record_api_call(method, url, duration, response=None, exception=None):
+    ''' account for an API call: response or exception it ended with '''
+    if not get_config('metrics_enabled'):
+        return
+    from orangeapisms.exceptions import OrangeAPIError
+    endpoint = endpoint_name(url)
+    if response is not None:
+        status = response.status_code
+        code = ''
+        if status >= 400:
+            code = OrangeAPIError.from_request(response).code or ''
+    else:
+        status, code = 'error', type(exception).__name__
+    inc('orangeapisms_api_requests_total',
+        {'endpoint': endpoint, 'method': method, 'status': status,
+         'error_code': code})
+    observe('orangeapisms_api_request_duration_seconds', duration,
+            {'endpoint': endpoint})
+
+
+def collect():
+    registry, exporter = get_registry()
+    return merge(exporter.collect() if exporter is not None
+                 else [registry.dump()])
+
+
+def render_metrics():
+    return render(collect())
@@ -0,0 +1,19 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('orangeapisms', '0003_smsmessage_outbox'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='smsmessage',
+            name='reference_code',
+            field=models.CharField(blank=True, db_index=True, max_length=64, null=True),
+        ),
+    ]
@@ -0,0 +1,18 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('orangeapisms', '0005_smsmessage_indexes'),
+    ]
+
+    operations = [
+        migrations.AlterIndexTogether(
+            name='smsmessage',
+            index_together=set([('created_on', 'uuid'), ('status', 'created_on'), ('direction', 'created_on'), ('sms_type', 'created_on'), ('status', 'next_attempt_on')]),
+        ),
+    ]
@@ -0,0 +1,36 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+from django.db.models import Count
+
+
+def clear_duplicate_message_ids(apps, schema_editor):
+    ''' keep messageId on the first SMS-MO only so it can be unique '''
+    SMSMessage = apps.get_model('orangeapisms', 'SMSMessage')
+    duplicates = SMSMessage.objects \
+        .exclude(message_id__isnull=True).order_by() \
+        .values('message_id').annotate(count=Count('uuid')) \
+        .filter(count__gt=1).values_list('message_id', flat=True)
+    for message_id in list(duplicates):
+        messages = SMSMessage.objects.filter(message_id=message_id) \
+            .order_by('created_on').values_list('uuid', flat=True)
+        SMSMessage.objects.filter(uuid__in=list(messages)[1:]) \
+            .update(message_id=None)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('orangeapisms', '0006_smsmessage_keyset_index'),
+    ]
+
+    operations = [
+        migrations.RunPython(clear_duplicate_message_ids,
+                             migrations.RunPython.noop),
+        migrations.AlterField(
+            model_name='smsmessage',
+            name='message_id',
+            field=models.CharField(blank=True, max_length=64, null=True, unique=True),
+        ),
+    ]
@@ -0,0 +1,30 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('orangeapisms', '0007_smsmessage_message_id_unique'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='DailyRollup',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('day', models.DateField()),
+                ('direction', models.CharField(choices=[('incoming', 'Incoming'), ('outgoing', 'Outgoing')], max_length=64)),
+                ('sms_type', models.CharField(choices=[('sms-mo', 'SMS-MO'), ('sms-mt', 'SMS-MT'), ('sms-mt+dr', 'SMS-MT+DR')], max_length=64)),
+                ('status', models.CharField(choices=[('pending', 'Not Sent Yet'), ('sent', 'Sent'), ('failed_to_send', 'Failed to send'), ('received', 'Received'), ('delivered', 'Delivered'), ('not_delivered', 'Not Delivered')], max_length=64)),
+                ('sender', models.CharField(blank=True, default='', max_length=255)),
+                ('count', models.IntegerField(default=0)),
+            ],
+        ),
+        migrations.AlterUniqueTogether(
+            name='dailyrollup',
+            unique_together=set([('day', 'direction', 'sms_type', 'status', 'sender')]),
+        ),
+    ]
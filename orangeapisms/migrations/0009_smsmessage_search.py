@@ -0,0 +1,125 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+import warnings
+
+from django.db import migrations, transaction, DatabaseError
+
+# frozen copy of orangeapisms.search at the time of this migration
+
+SQLITE_INSTALL = [
+    "CREATE TABLE IF NOT EXISTS orangeapisms_smsmessage_fts_map ("
+    "id INTEGER PRIMARY KEY, uuid char(32) NOT NULL UNIQUE)",
+    "CREATE VIRTUAL TABLE IF NOT EXISTS orangeapisms_smsmessage_fts "
+    "USING fts5(content)",
+    "CREATE TRIGGER IF NOT EXISTS orangeapisms_smsmessage_fts_ad "
+    "AFTER DELETE ON orangeapisms_smsmessage BEGIN "
+    "DELETE FROM orangeapisms_smsmessage_fts WHERE rowid = "
+    "(SELECT id FROM orangeapisms_smsmessage_fts_map "
+    "WHERE uuid = old.uuid); "
+    "DELETE FROM orangeapisms_smsmessage_fts_map "
+    "WHERE uuid = old.uuid; END",
+    "CREATE TRIGGER IF NOT EXISTS orangeapisms_smsmessage_fts_ai "
+    "AFTER INSERT ON orangeapisms_smsmessage BEGIN "
+    "INSERT INTO orangeapisms_smsmessage_fts_map(uuid) VALUES (new.uuid); "
+    "INSERT INTO orangeapisms_smsmessage_fts(rowid, content) VALUES ("
+    "(SELECT id FROM orangeapisms_smsmessage_fts_map "
+    "WHERE uuid = new.uuid), new.content); END",
+    "CREATE TRIGGER IF NOT EXISTS orangeapisms_smsmessage_fts_au "
+    "AFTER UPDATE OF content ON orangeapisms_smsmessage BEGIN "
+    "UPDATE orangeapisms_smsmessage_fts SET content = new.content "
+    "WHERE rowid = (SELECT id FROM orangeapisms_smsmessage_fts_map "
+    "WHERE uuid = new.uuid); END",
+    "INSERT INTO orangeapisms_smsmessage_fts_map(uuid) "
+    "SELECT uuid FROM orangeapisms_smsmessage",
+    "INSERT INTO orangeapisms_smsmessage_fts(rowid, content) "
+    "SELECT orangeapisms_smsmessage_fts_map.id, "
+    "orangeapisms_smsmessage.content FROM orangeapisms_smsmessage_fts_map "
+    "JOIN orangeapisms_smsmessage "
+    "ON orangeapisms_smsmessage.uuid = orangeapisms_smsmessage_fts_map.uuid",
+]
+
+SQLITE_UNINSTALL = [
+    "DROP TRIGGER IF EXISTS orangeapisms_smsmessage_fts_ad",
+    "DROP TRIGGER IF EXISTS orangeapisms_smsmessage_fts_ai",
+    "DROP TRIGGER IF EXISTS orangeapisms_smsmessage_fts_au",
+    "DROP TABLE IF EXISTS orangeapisms_smsmessage_fts",
+    "DROP TABLE IF EXISTS orangeapisms_smsmessage_fts_map",
+]
+
+POSTGRESQL_INSTALL = [
+    "CREATE INDEX IF NOT EXISTS orangeapisms_smsmessage_content_tsv "
+    "ON orangeapisms_smsmessage USING gin (to_tsvector('simple', content))",
+]
+
+# requires privileges we may not have
+POSTGRESQL_INSTALL_TRGM = [
+    "CREATE EXTENSION IF NOT EXISTS pg_trgm",
+    "CREATE INDEX IF NOT EXISTS orangeapisms_smsmessage_content_trgm "
+    "ON orangeapisms_smsmessage USING gin (content gin_trgm_ops)",
+]
+
+POSTGRESQL_UNINSTALL = [
+    "DROP INDEX IF EXISTS orangeapisms_smsmessage_content_tsv",
+    "DROP INDEX IF EXISTS orangeapisms_smsmessage_content_trgm",
+]
+
+
+def execute(connection, statements):
+    with connection.cursor() as cursor:
+        for statement in statements:
+            cursor.execute(statement)
+
+
+def has_fts5(connection):
+    try:
+        with transaction.atomic(using=connection.alias):
+            execute(connection, [
+                "CREATE VIRTUAL TABLE temp.orangeapisms_fts5_check "
+                "USING fts5(content)",
+                "DROP TABLE temp.orangeapisms_fts5_check"])
+    except DatabaseError:
+        return False
+    return True
+
+
+def install_search_index(apps, schema_editor):
+    ''' full-text index of the database (see orangeapisms.search) '''
+    connection = schema_editor.connection
+    if connection.vendor == 'sqlite':
+        if not has_fts5(connection):
+            warnings.warn("SQLite lacks FTS5: message searches will scan "
+                          "the table")
+            return
+        execute(connection, SQLITE_INSTALL)
+    elif connection.vendor == 'postgresql':
+        execute(connection, POSTGRESQL_INSTALL)
+        try:
+            with transaction.atomic(using=connection.alias):
+                execute(connection, POSTGRESQL_INSTALL_TRGM)
+        except DatabaseError as exp:
+            warnings.warn("Unable to create trigram index ({}): substring "
+                          "searches will scan the table".format(exp))
+
+
+def uninstall_search_index(apps, schema_editor):
+    connection = schema_editor.connection
+    if connection.vendor == 'sqlite':
+        execute(connection, SQLITE_UNINSTALL)
+    elif connection.vendor == 'postgresql':
+        execute(connection, POSTGRESQL_UNINSTALL)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('orangeapisms', '0008_dailyrollup'),
+    ]
+
+    operations = [
+        migrations.AlterIndexTogether(
+            name='smsmessage',
+            index_together=set([('created_on', 'uuid'), ('status', 'created_on'), ('direction', 'created_on'), ('sms_type', 'created_on'), ('status', 'next_attempt_on'), ('sender_address', 'created_on'), ('destination_address', 'created_on')]),
+        ),
+        migrations.RunPython(install_search_index, uninstall_search_index),
+    ]
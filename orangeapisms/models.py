@@ -7,23 +7,55 @@ from __future__ import (unicode_literals, absolute_import,
 import logging
 import re
 import uuid
+import datetime
 from collections import OrderedDict
 
-from django.db import models
+import simplejson
+
+from django.db import models, transaction, IntegrityError
+from django.db.models import Case, When, Value
 from django.utils import timezone
 from py3compat import implements_to_string
 
+from orangeapisms import chunked
 from orangeapisms.config import get_config
-from orangeapisms.datetime import aware_datetime_from_iso, datetime_to_iso
+from orangeapisms.exceptions import is_retryable
+from orangeapisms.segments import count_segments
+from orangeapisms.datetime import (aware_datetime_from_iso, datetime_to_iso,
+                                   encode_datetime, decode_datetime)
 
 logger = logging.getLogger(__name__)
 
 
+class SMSMessageQuerySet(models.QuerySet):
+
+    def bulk_create(self, objs, batch_size=None):
+        from orangeapisms.rollups import record_created
+        # a single commit for messages and rollups
+        with transaction.atomic(using=self.db):
+            objs = super(SMSMessageQuerySet, self).bulk_create(
+                objs, batch_size)
+            record_created(objs)
+        return objs
+
+
 @implements_to_string
 class SMSMessage(models.Model):
 
     class Meta:
         ordering = ['-created_on']
+        # most listings are filtered on one of those and sorted by date
+        index_together = [
+            # keyset pagination (see orangeapisms.pagination)
+            ('created_on', 'uuid'),
+            ('status', 'created_on'),
+            ('direction', 'created_on'),
+            # messages of a subscriber (see orangeapisms.search)
+            ('sender_address', 'created_on'),
+            ('destination_address', 'created_on'),
+            ('sms_type', 'created_on'),
+            ('status', 'next_attempt_on'),
+        ]
 
     INCOMING = 'incoming'
     OUTGOING = 'outgoing'
@@ -81,14 +113,48 @@ class SMSMessage(models.Model):
         max_length=255, blank=True, null=True)
 
     # incoming only
-    message_id = models.CharField(max_length=64, blank=True, null=True)
+    message_id = models.CharField(max_length=64, blank=True, null=True,
+                                  unique=True)
 
     # outgoing only
-    reference_code = models.CharField(max_length=64, blank=True, null=True)
+    reference_code = models.CharField(max_length=64, blank=True, null=True,
+                                      db_index=True)
 
     content = models.CharField(max_length=1600)
     status = models.CharField(max_length=64, choices=STATUSES.items())
 
+    # outgoing submission attempts (outbox)
+    attempts = models.PositiveIntegerField(default=0)
+    next_attempt_on = models.DateTimeField(null=True, blank=True)
+    last_error = models.CharField(max_length=255, blank=True, null=True)
+    claimed_by = models.CharField(max_length=64, blank=True, null=True)
+    claimed_until = models.DateTimeField(null=True, blank=True)
+
+    ATTEMPT_FIELDS = ['status', 'reference_code', 'attempts',
+                      'next_attempt_on', 'last_error',
+                      'claimed_by', 'claimed_until']
+    # statuses an attempt moves from (not yet sent nor delivered)
+    SENDABLE_STATUSES = [PENDING, FAILED_TO_SEND]
+
+    objects = SMSMessageQuerySet.as_manager()
+
+    def save(self, *args, **kwargs):
+        from orangeapisms.rollups import record_created
+        created = self._state.adding
+        with transaction.atomic(using=kwargs.get('using')):
+            super(SMSMessage, self).save(*args, **kwargs)
+            if created:
+                record_created([self])
+
+    def delete(self, *args, **kwargs):
+        from orangeapisms.rollups import FIELDS, record_deleted
+        with transaction.atomic(using=kwargs.get('using')):
+            rows = list(type(self).objects.filter(pk=self.pk)
+                        .select_for_update().values(*FIELDS))
+            deleted = super(SMSMessage, self).delete(*args, **kwargs)
+            record_deleted(rows)
+        return deleted
+
     def __str__(self):
         return "{type}: {uuid}".format(type=self.sms_type_verbose,
                                        uuid=self.suuid)
@@ -131,21 +197,114 @@ class SMSMessage(models.Model):
 
     @classmethod
     def create_mo_from_payload(cls, payload):
-        kwargs = {
-            'direction': cls.INCOMING,
-            'sms_type': cls.MO,
-            'status': cls.RECEIVED,
-
-            'sender_address': cls.clean_address(payload.get('senderAddress')),
-            'destination_address':
-                cls.clean_address(payload.get('destinationAddress')),
-            'message_id': payload.get('messageId'),
-            'content': payload.get('message'),
-            'created_on': aware_datetime_from_iso(payload.get('dateTime'))
+        return cls.get_or_create_mo_from_payload(payload)[0]
+
+    @classmethod
+    def build_mo_from_payload(cls, payload):
+        ''' unsaved SMS-MO from an SMS-MO notification '''
+        return cls(
+            direction=cls.INCOMING,
+            sms_type=cls.MO,
+            status=cls.RECEIVED,
+            sender_address=cls.clean_address(payload.get('senderAddress')),
+            destination_address=cls.clean_address(
+                payload.get('destinationAddress')),
+            message_id=payload.get('messageId'),
+            content=payload.get('message'),
+            created_on=aware_datetime_from_iso(payload.get('dateTime')))
+
+    @classmethod
+    def get_or_create_mo_from_payload(cls, payload):
+        ''' (msg, created) from an SMS-MO notification
+
+            an SMS-MO with an already received messageId is not stored
+            again. If it was found in the messageId cache, the returned
+            msg is not fetched from DB: only its uuid and message_id
+            are set. Call mark_seen() once its handler ran. '''
+        from orangeapisms.dedup import get_message_id_cache
+
+        message_id = payload.get('messageId')
+        if message_id:
+            suuid = get_message_id_cache().get(message_id)
+            if suuid is not None:
+                return cls(uuid=uuid.UUID(suuid), message_id=message_id), False
+
+        msg, created = cls.build_mo_from_payload(payload), True
+        if get_config('use_db'):
+            msg, created = cls.insert_mo(msg)
+        return msg, created
+
+    def mark_seen(self):
+        ''' acknowledge further notifications of this SMS-MO's messageId
+            as duplicates without querying DB '''
+        from orangeapisms.dedup import get_message_id_cache
+        if self.message_id:
+            get_message_id_cache().add(self.message_id, self.suuid)
+
+    def forget_mo(self):
+        ''' undo recording of an SMS-MO whose handler failed
+
+            so that the API retry stores it and runs its handler again '''
+        from orangeapisms.dedup import get_message_id_cache
+        if self.message_id:
+            get_message_id_cache().discard(self.message_id)
+        if not self._state.adding:
+            self.delete()
+
+    @classmethod
+    def insert_mo(cls, msg):
+        ''' (msg, created) inserting msg unless its uuid or message_id
+            is already stored '''
+        try:
+            # savepoint so a duplicate doesn't break an outer transaction
+            with transaction.atomic():
+                msg.save(force_insert=True)
+                return msg, True
+        except IntegrityError:
+            lookup = models.Q(uuid=msg.uuid)
+            if msg.message_id:
+                lookup |= models.Q(message_id=msg.message_id)
+            existing = cls.objects.filter(lookup).first()
+            if existing is None:
+                raise
+            return existing, False
+
+    @classmethod
+    def bulk_insert_mo(cls, messages):
+        ''' insert messages at once, skipping already stored ones '''
+        try:
+            with transaction.atomic():
+                cls.objects.bulk_create(messages)
+        except IntegrityError:
+            # a duplicate in the batch: fallback to one by one
+            for msg in messages:
+                cls.insert_mo(msg)
+
+    DR_FIELDS = ['sms_type', 'delivery_status_on', 'status']
+
+    @classmethod
+    def dr_from_payload(cls, payload):
+        ''' (uuid, reference, DR fields) from an SMS-DR payload
+
+            uuid is the callbackData we set on submission ; reference is
+            the resourceURL code which we store on SMS-MT as a fallback '''
+        try:
+            uuid_ = uuid.UUID('{}'.format(payload.get('callbackData')))
+        except ValueError:
+            uuid_ = None
+        delivery_info = payload.get('deliveryInfo', {})
+        resource_url = payload.get('resourceURL') or \
+            delivery_info.get('resourceURL') or ''
+        reference = resource_url.rsplit('/', 1)[-1] or None
+        fields = {
+            'sms_type': cls.DR,
+            'delivery_status_on': aware_datetime_from_iso(
+                payload.get('delivery_status_on',
+                            datetime_to_iso(timezone.now()))),
+            'status': cls.DELIVERY_STATUS_MATRIX.get(
+                delivery_info.get('deliveryStatus'), cls.NOT_DELIVERED)
         }
-        if not get_config('use_db'):
-            return cls(**kwargs)
-        return cls.objects.create(**kwargs)
+        return uuid_, reference, fields
 
     @classmethod
     def record_dr_from_payload(cls, payload):
@@ -153,40 +312,172 @@ class SMSMessage(models.Model):
         if not get_config('use_db'):
             return
 
-        uuid = payload.get('callbackData')
-        msg = cls.get_or_none(uuid)
+        uuid_, reference, kwargs = cls.dr_from_payload(payload)
+        msg = None
+        if uuid_ is not None:
+            msg = cls.get_or_none(uuid_)
+        if msg is None and reference is not None:
+            msg = cls.objects.filter(reference_code=reference).first()
         if msg is None:
             raise ValueError("SMS-DR reference unreachable SMS-MT `{uuid}`"
-                             .format(uuid=uuid))
-        kwargs = {
-            'sms_type': cls.DR,
-            'delivery_status_on': aware_datetime_from_iso(
-                payload.get('delivery_status_on',
-                            datetime_to_iso(timezone.now()))),
-            'status': cls.DELIVERY_STATUS_MATRIX.get(
-                payload.get('deliveryInfo', {})
-                       .get('deliveryStatus', cls.NOT_DELIVERED))
-        }
+                             .format(uuid=payload.get('callbackData')))
         msg.update(**kwargs)
-        msg.save()
+        cls.bulk_update([msg], cls.DR_FIELDS)
+        return msg
+
+    @classmethod
+    def record_drs_from_payloads(cls, payloads, batch_size=None):
+        ''' records many SMS-DR at once
+
+            one query per lookup kind (uuid, reference) and one UPDATE
+            per batch. returns updated SMS-MT (or None) in payloads order '''
+        if not get_config('use_db'):
+            return [None] * len(payloads)
+
+        parsed = [cls.dr_from_payload(payload) for payload in payloads]
+        by_uuid = cls.objects.in_bulk(
+            [uuid_ for uuid_, _, _ in parsed if uuid_ is not None])
+        references = [reference for uuid_, reference, _ in parsed
+                      if reference is not None and uuid_ not in by_uuid]
+        by_reference = {
+            msg.reference_code: msg for msg in
+            cls.objects.filter(reference_code__in=references)
+        } if references else {}
+
+        messages = []
+        for uuid_, reference, kwargs in parsed:
+            msg = by_uuid.get(uuid_) or by_reference.get(reference)
+            if msg is None:
+                logger.error("SMS-DR reference unreachable SMS-MT `{}`"
+                             .format(uuid_ or reference))
+            else:
+                msg.update(**kwargs)
+            messages.append(msg)
+        cls.bulk_update(set(msg for msg in messages if msg is not None),
+                        cls.DR_FIELDS, batch_size=batch_size)
+        return messages
+
+    @classmethod
+    def build_mt(cls, destination_address, content,
+                 sender_address=None, sending_status=SENT):
+        ''' unsaved SMS-MT instance
+
+            a PENDING one is leased to the current process, which is
+            about to send it: the outbox leaves it alone until the
+            attempt is recorded or outbox_lease elapsed. '''
+        msg = cls(direction=cls.OUTGOING,
+                  sms_type=cls.MT,
+                  created_on=timezone.now(),
+                  sender_address=sender_address,
+                  destination_address=destination_address,
+                  content=content,
+                  status=sending_status)
+        if sending_status == cls.PENDING:
+            from orangeapisms.outbox import get_worker_id
+            msg.claimed_by = get_worker_id()[-64:]
+            msg.claimed_until = msg.created_on + datetime.timedelta(
+                seconds=get_config('outbox_lease'))
         return msg
 
     @classmethod
     def create_mt(cls, destination_address, content,
                   sender_address=None, sending_status=SENT):
-        kwargs = {
-            'direction': cls.OUTGOING,
-            'sms_type': cls.MT,
-            'created_on': timezone.now(),
-
-            'sender_address': sender_address,
-            'destination_address': destination_address,
-            'content': content,
-            'status': sending_status,
-        }
-        if not get_config('use_db'):
-            return cls(**kwargs)
-        return cls.objects.create(**kwargs)
+        msg = cls.build_mt(destination_address, content,
+                           sender_address, sending_status)
+        if get_config('use_db'):
+            msg.save(force_insert=True)
+        return msg
+
+    STATE_FIELDS = ['sms_type', 'status']
+
+    @classmethod
+    def bulk_update(cls, messages, fields, batch_size=None,
+                    from_statuses=None):
+        ''' saves `fields` of all messages using one query per batch
+
+            Django 1.10 has no QuerySet.bulk_update so this builds the
+            same CASE WHEN pk=... THEN ... UPDATE statement.
+            sms_type and status are saved by save_states() (passed
+            from_statuses). returns the number of updated rows '''
+        messages = list(messages)
+        if not messages:
+            return 0
+        states = [name for name in fields if name in cls.STATE_FIELDS]
+        fields = [cls._meta.get_field(name) for name in fields
+                  if name not in states]
+        updated = 0
+        for batch in chunked(messages, batch_size or len(messages)):
+            with transaction.atomic():
+                if fields:
+                    updated += cls.objects.filter(
+                        pk__in=[msg.pk for msg in batch]).update(**{
+                            field.attname: Case(
+                                *[When(pk=msg.pk,
+                                       then=Value(getattr(msg, field.attname),
+                                                  output_field=field))
+                                  for msg in batch],
+                                output_field=field)
+                            for field in fields})
+                if states:
+                    moved = cls.save_states(batch, from_statuses)
+                    if not fields:
+                        updated += moved
+        return updated
+
+    @classmethod
+    def save_states(cls, messages, from_statuses=None):
+        ''' saves sms_type and status of messages, moving rollups along
+
+            only rows which status is one of from_statuses (if set) are
+            updated. Each UPDATE is conditioned on the state rows are
+            moved from so a change made meanwhile by another process is
+            neither overwritten nor miscounted: such rows are read again.
+            returns the number of rows moved '''
+        from orangeapisms.rollups import FIELDS, record_moves
+        targets = OrderedDict()
+        for msg in messages:
+            targets.setdefault((msg.sms_type, msg.status), []).append(msg.pk)
+
+        moved = 0
+        moves = []
+        with transaction.atomic():
+            for (sms_type, status), pks in targets.items():
+                rows = cls.objects.filter(pk__in=pks).exclude(
+                    sms_type=sms_type, status=status)
+                if from_statuses is not None:
+                    rows = rows.filter(status__in=from_statuses)
+                while True:
+                    # rows to move, by current state
+                    states = OrderedDict()
+                    for row in rows.order_by().values('pk', *FIELDS):
+                        states.setdefault(tuple(
+                            (name, row[name]) for name in sorted(FIELDS)),
+                            []).append(row['pk'])
+                    if not states:
+                        break
+                    missed = False
+                    for state, state_pks in states.items():
+                        row = dict(state)
+                        count = cls.objects.filter(
+                            pk__in=state_pks, sms_type=row['sms_type'],
+                            status=row['status']).update(
+                            sms_type=sms_type, status=status)
+                        missed = missed or count < len(state_pks)
+                        moves.append((row, sms_type, status, count))
+                        moved += count
+                    if not missed:
+                        break
+            record_moves(moves)
+        return moved
+
+    @classmethod
+    def save_attempts(cls, messages, batch_size=None):
+        ''' saves what record_attempt() set on messages
+
+            status is only saved on rows still pending or failed: an
+            SMS-DR recorded while the API call was in flight is kept '''
+        return cls.bulk_update(messages, cls.ATTEMPT_FIELDS, batch_size,
+                               from_statuses=cls.SENDABLE_STATUSES)
 
     def update(self, **kwargs):
         for k, v in kwargs.items():
@@ -197,26 +488,134 @@ class SMSMessage(models.Model):
         return mt_payload(dest_addr=self.destination_address,
                           message=self.content,
                           sender_address=get_config('sender_address'),
-                          sender_name=self.sender_address)
+                          sender_name=self.sender_address,
+                          callback_data=self.suuid)
 
     @property
     def suuid(self):
         return self.uuid.hex or None
 
+    @property
+    def segments(self):
+        ''' Segments (encoding, length, count, remaining) of content '''
+        return count_segments(self.content or '')
+
+    def to_dict(self):
+        ''' JSON-serializable representation '''
+        return {
+            'uuid': self.suuid,
+            'direction': self.direction,
+            'sms_type': self.sms_type,
+            'created_on': datetime_to_iso(self.created_on),
+            'delivery_status_on': datetime_to_iso(self.delivery_status_on)
+            if self.delivery_status_on else None,
+            'sender_address': self.sender_address,
+            'destination_address': self.destination_address,
+            'message_id': self.message_id,
+            'reference_code': self.reference_code,
+            'content': self.content,
+            'status': self.status,
+        }
+
     def update_reference(self, reference_code):
         self.reference_code = reference_code
         if not get_config('use_db'):
             return
-        self.save()
+        self.save(update_fields=['reference_code'])
 
     def update_status(self, status):
         self.status = status
         if not get_config('use_db'):
             return
-        self.save()
+        self.save_states([self])
+
+    def record_attempt(self, reference=None, error=None):
+        ''' account for a submission attempt, without saving
+
+            failed attempts are scheduled for a retry by the outbox
+            if error is retryable and max attempts is not reached '''
+        self.attempts += 1
+        self.claimed_by = None
+        self.claimed_until = None
+        if reference:
+            self.reference_code = reference
+            self.status = self.SENT
+            self.next_attempt_on = None
+            self.last_error = None
+            return
+
+        self.status = self.FAILED_TO_SEND
+        self.last_error = "{}".format(error)[:255] if error else None
+        if is_retryable(error) and \
+                self.attempts < get_config('outbox_max_attempts'):
+            self.next_attempt_on = timezone.now() + datetime.timedelta(
+                seconds=self.retry_delay(self.attempts))
+        else:
+            self.next_attempt_on = None
+
+    @classmethod
+    def retry_delay(cls, attempts):
+        ''' exponential backoff (seconds) after `attempts` failures '''
+        return min(get_config('outbox_backoff') * 2 ** (attempts - 1),
+                   get_config('outbox_max_backoff'))
+
+    def update_attempt(self, reference=None, error=None):
+        self.record_attempt(reference, error)
+        if not get_config('use_db'):
+            return
+        # its SMS-DR may be recorded before the API call returns
+        self.save_attempts([self])
 
     def reply(self, text, as_addr):
         from orangeapisms.utils import send_sms
         return send_sms(to_addr=self.sender_address,
                         message=text,
                         as_addr=as_addr)
+
+
+@implements_to_string
+class DailyRollup(models.Model):
+    ''' number of messages per creation day (UTC) and state
+
+        sender is our address: sender of SMS-MT, recipient of SMS-MO.
+        maintained by orangeapisms.rollups '''
+
+    class Meta:
+        unique_together = [
+            ('day', 'direction', 'sms_type', 'status', 'sender'),
+        ]
+
+    day = models.DateField()
+    direction = models.CharField(max_length=64,
+                                 choices=SMSMessage.DIRECTIONS.items())
+    sms_type = models.CharField(max_length=64,
+                                choices=SMSMessage.TYPES.items())
+    status = models.CharField(max_length=64,
+                              choices=SMSMessage.STATUSES.items())
+    sender = models.CharField(max_length=255, blank=True, default='')
+    count = models.IntegerField(default=0)
+
+    def __str__(self):
+        return "{day} {direction} {status}: {count}".format(
+            day=self.day, direction=self.direction, status=self.status,
+            count=self.count)
+
+
+@implements_to_string
+class ConfigEntry(models.Model):
+    ''' config value stored by the `db` config_backend '''
+
+    key = models.CharField(max_length=255, primary_key=True)
+    value = models.TextField()
+    updated_on = models.DateTimeField(auto_now=True)
+
+    def __str__(self):
+        return self.key
+
+    @classmethod
+    def encode(cls, value):
+        return simplejson.dumps(value, default=encode_datetime)
+
+    @property
+    def decoded_value(self):
+        return decode_datetime(simplejson.loads(self.value))
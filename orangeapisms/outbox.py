@@ -0,0 +1,77 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# vim: ai ts=4 sts=4 et sw=4 nu
+
+''' DB-backed outbox of SMS-MT to (re)submit '''
+
+from __future__ import (unicode_literals, absolute_import,
+                        division, print_function)
+
+import os
+import uuid
+import socket
+import logging
+import datetime
+
+from django.db.models import Q
+from django.utils import timezone
+
+from orangeapisms.config import get_config
+from orangeapisms.models import SMSMessage
+
+logger = logging.getLogger(__name__)
+
+
+def get_worker_id():
+    return "{host}:{pid}".format(host=socket.gethostname()[:40],
+                                 pid=os.getpid())
+
+
+def claimable(now=None):
+    ''' SMS-MT QuerySet which can be claimed for submission '''
+    now = now or timezone.now()
+    grace = datetime.timedelta(seconds=get_config('outbox_pending_grace'))
+    return SMSMessage.objects \
+        .filter(direction=SMSMessage.OUTGOING, sms_type=SMSMessage.MT) \
+        .filter(Q(status=SMSMessage.PENDING, created_on__lte=now - grace) |
+                Q(status=SMSMessage.FAILED_TO_SEND,
+                  next_attempt_on__lte=now)) \
+        .filter(Q(claimed_until__isnull=True) | Q(claimed_until__lt=now))
+
+
+def claim(batch_size, worker_id=None, lease=None):
+    ''' claims up to batch_size messages, returning those we got '''
+    now = timezone.now()
+    lease = lease or get_config('outbox_lease')
+    candidates = list(claimable(now).order_by('created_on')
+                      .values_list('pk', flat=True)[:batch_size])
+    if not candidates:
+        return []
+
+    # unique per batch so we only get back rows this very UPDATE claimed
+    token = "{worker}:{batch}".format(worker=worker_id or get_worker_id(),
+                                      batch=uuid.uuid4().hex[:12])[-64:]
+    claimable(now).filter(pk__in=candidates).update(
+        claimed_by=token,
+        claimed_until=now + datetime.timedelta(seconds=lease))
+    return list(SMSMessage.objects.filter(claimed_by=token)
+                .order_by('created_on'))
+
+
+def submit(msg):
+    ''' submit a claimed message, recording the attempt (no DB access) '''
+    from orangeapisms.utils import submit_message
+    submit_message(msg)
+    return msg
+
+
+def drain_batch(executor, batch_size=None, worker_id=None):
+    ''' claims, submits and saves a batch. returns processed messages '''
+    messages = claim(batch_size or get_config('outbox_batch_size'),
+                     worker_id=worker_id)
+    if not messages:
+        return []
+    list(executor.map(submit, messages))
+    # keeps the status of SMS-DR received meanwhile
+    SMSMessage.save_attempts(messages)
+    return messages
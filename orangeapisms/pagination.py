@@ -0,0 +1,168 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# vim: ai ts=4 sts=4 et sw=4 nu
+
+''' Keyset (cursor) pagination and count-less paginators for large tables '''
+
+from __future__ import (unicode_literals, absolute_import,
+                        division, print_function)
+
+import uuid
+import base64
+import logging
+import binascii
+
+from django.db import connections
+from django.db.models import Q
+from django.core.paginator import Paginator
+from django.utils.functional import cached_property
+
+from orangeapisms.datetime import aware_datetime_from_iso, datetime_to_iso
+
+logger = logging.getLogger(__name__)
+KEYS = ('created_on', 'uuid')
+
+
+def encode_cursor(msg):
+    ''' opaque URL-safe cursor pointing at msg '''
+    key = "{on}|{uuid}".format(on=datetime_to_iso(msg.created_on),
+                               uuid=msg.uuid.hex)
+    return base64.urlsafe_b64encode(key.encode('utf-8')).decode('ascii')
+
+
+def decode_cursor(cursor):
+    ''' (created_on, uuid) from a cursor. ValueError if invalid '''
+    try:
+        key = base64.urlsafe_b64decode(cursor.encode('ascii'))
+        created_on, pk = key.decode('utf-8').split('|')
+        return aware_datetime_from_iso(created_on), uuid.UUID(pk)
+    except (binascii.Error, TypeError, ValueError, AttributeError):
+        raise ValueError("Invalid cursor `{}`".format(cursor))
+
+
+class KeysetPage(object):
+    ''' a page of messages sorted by (-created_on, -uuid) '''
+
+    def __init__(self, object_list, has_next, has_previous):
+        self.object_list = object_list
+        self.has_next = has_next
+        self.has_previous = has_previous
+
+    def __iter__(self):
+        return iter(self.object_list)
+
+    def __len__(self):
+        return len(self.object_list)
+
+    @property
+    def next_cursor(self):
+        if self.has_next and self.object_list:
+            return encode_cursor(self.object_list[-1])
+
+    @property
+    def previous_cursor(self):
+        if self.has_previous and self.object_list:
+            return encode_cursor(self.object_list[0])
+
+
+def keyset_page(queryset, after=None, before=None, per_page=25):
+    ''' page of queryset following `after` cursor or preceding `before`
+
+        fetches a single extra row to know if there's a next page '''
+    if before:
+        created_on, pk = decode_cursor(before)
+        rows = list(queryset.filter(
+            Q(created_on__gt=created_on) |
+            Q(created_on=created_on, uuid__gt=pk))
+            .order_by(*KEYS)[:per_page + 1])
+        has_previous = len(rows) > per_page
+        return KeysetPage(list(reversed(rows[:per_page])),
+                          has_next=True, has_previous=has_previous)
+
+    queryset = queryset.order_by(*['-{}'.format(key) for key in KEYS])
+    if after:
+        created_on, pk = decode_cursor(after)
+        queryset = queryset.filter(
+            Q(created_on__lt=created_on) |
+            Q(created_on=created_on, uuid__lt=pk))
+    rows = list(queryset[:per_page + 1])
+    return KeysetPage(rows[:per_page], has_next=len(rows) > per_page,
+                      has_previous=bool(after))
+
+
+def keyset_chunks(queryset, chunk_size=1000):
+    ''' lists of at most chunk_size rows of queryset, oldest first
+
+        each chunk is a separate indexed query: memory use is bounded
+        whatever the queryset size (Django<2 iterator() can't chunk) '''
+    queryset = queryset.order_by(*KEYS)
+    last = None
+    while True:
+        chunk_queryset = queryset
+        if last is not None:
+            chunk_queryset = queryset.filter(
+                Q(created_on__gt=last[0]) |
+                Q(created_on=last[0], uuid__gt=last[1]))
+        rows = list(chunk_queryset[:chunk_size])
+        if not rows:
+            return
+        last = (rows[-1].created_on, rows[-1].uuid)
+        yield rows
+        if len(rows) < chunk_size:
+            return
+
+
+def keyset_iterator(queryset, chunk_size=1000):
+    ''' rows of queryset, oldest first, fetched chunk_size at a time '''
+    for rows in keyset_chunks(queryset, chunk_size):
+        for row in rows:
+            yield row
+
+
+def estimated_table_count(model, using='default'):
+    ''' row count of model's table from DB statistics, None if unavailable
+
+        cheap but approximate (stale statistics, deleted rows) '''
+    connection = connections[using]
+    table = model._meta.db_table
+    queries = {
+        'postgresql': ("SELECT reltuples::bigint FROM pg_class "
+                       "WHERE relname = %s", [table]),
+        'mysql': ("SELECT table_rows FROM information_schema.tables "
+                  "WHERE table_schema = DATABASE() AND table_name = %s",
+                  [table]),
+        # rowid is monotonic as long as rows are not deleted
+        'sqlite': ("SELECT MAX(_rowid_) FROM {}"
+                   .format(connection.ops.quote_name(table)), []),
+    }
+    if connection.vendor not in queries:
+        return None
+    try:
+        with connection.cursor() as cursor:
+            cursor.execute(*queries[connection.vendor])
+            row = cursor.fetchone()
+    except Exception as exp:
+        logger.warning("Unable to estimate {} count: {}".format(table, exp))
+        return None
+    if row is None or row[0] is None or row[0] < 0:
+        return None
+    return int(row[0])
+
+
+class EstimatedCountPaginator(Paginator):
+    ''' Paginator which never counts a whole table
+
+        unfiltered lists use the DB statistics estimate. Filtered ones
+        count at most `count_limit` rows: pages past it are not reachable
+        but can be narrowed down with filters. '''
+
+    count_limit = 10000
+
+    @cached_property
+    def count(self):
+        queryset = self.object_list
+        if not queryset.query.where:
+            estimate = estimated_table_count(queryset.model, queryset.db)
+            if estimate is not None:
+                return estimate
+        return queryset.values('pk')[:self.count_limit].count()
@@ -0,0 +1,267 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# vim: ai ts=4 sts=4 et sw=4 nu
+
+''' Outbound rate limiting (token buckets, adaptive concurrency) of SMS-MT '''
+
+from __future__ import (unicode_literals, absolute_import,
+                        division, print_function)
+
+import os
+import time
+import struct
+import hashlib
+import logging
+import tempfile
+import threading
+from contextlib import contextmanager
+
+from orangeapisms.config import get_config
+
+try:
+    import fcntl
+except ImportError:  # not available on Windows
+    fcntl = None
+
+logger = logging.getLogger(__name__)
+TOO_MANY_REQUESTS = 429
+
+
+def is_throttling(http_code):
+    ''' whether an HTTP status asks us to slow down '''
+    return http_code == TOO_MANY_REQUESTS or 500 <= (http_code or 0) < 600
+
+
+def retry_after(response, default=1):
+    ''' seconds to wait from a throttling response's Retry-After header '''
+    try:
+        return max(float(response.headers.get('Retry-After')), 0)
+    except (AttributeError, TypeError, ValueError):
+        return default
+
+
+class TokenBucket(object):
+    ''' in-process token bucket of `rate` tokens per second '''
+
+    def __init__(self, rate, burst=None):
+        self.rate = float(rate)
+        self.burst = float(burst or rate)
+        self.tokens = self.burst
+        self.stamp = time.time()
+        self.lock = threading.Lock()
+
+    def take(self, cost=1):
+        ''' take cost tokens, returning seconds to wait before using them '''
+        with self.lock:
+            self.tokens, self.stamp, wait = self.compute(
+                self.tokens, self.stamp, cost)
+            return wait
+
+    def compute(self, tokens, stamp, cost):
+        ''' (tokens, stamp, wait) after taking cost tokens
+
+            tokens can go negative: the debt is paid by waiting '''
+        now = time.time()
+        tokens = min(self.burst, tokens + (now - stamp) * self.rate) - cost
+        wait = -tokens / self.rate if tokens < 0 else 0
+        return tokens, now, wait
+
+    def pause(self, seconds):
+        ''' prevent any token to be available for seconds '''
+        self.take(seconds * self.rate + max(self.tokens, 0))
+
+    def acquire(self, cost=1):
+        wait = self.take(cost)
+        if wait:
+            time.sleep(wait)
+
+
+class FileTokenBucket(TokenBucket):
+    ''' token bucket shared by all processes through a flock()ed file '''
+
+    STATE = struct.Struct(str('dd'))
+
+    def __init__(self, path, rate, burst=None):
+        super(FileTokenBucket, self).__init__(rate, burst)
+        self.path = path
+
+    def take(self, cost=1):
+        if fcntl is None:
+            return super(FileTokenBucket, self).take(cost)
+        with self.lock:
+            fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o600)
+            try:
+                fcntl.flock(fd, fcntl.LOCK_EX)
+                data = os.read(fd, self.STATE.size)
+                if len(data) == self.STATE.size:
+                    tokens, stamp = self.STATE.unpack(data)
+                else:
+                    tokens, stamp = self.burst, time.time()
+                tokens, stamp, wait = self.compute(tokens, stamp, cost)
+                os.lseek(fd, 0, os.SEEK_SET)
+                os.write(fd, self.STATE.pack(tokens, stamp))
+                self.tokens = tokens
+                return wait
+            finally:
+                os.close(fd)
+
+
+class AdaptiveLimiter(object):
+    ''' AIMD concurrency limit
+
+        +1 slot per round of fast successful requests,
+        halved on throttling or server errors '''
+
+    def __init__(self, max_limit, target_latency, min_limit=1,
+                 initial=None, decrease_factor=0.5):
+        self.max_limit = max_limit
+        self.min_limit = min_limit
+        self.target_latency = target_latency
+        self.decrease_factor = decrease_factor
+        self.limit = float(initial or max(min_limit, max_limit // 4))
+        self.inflight = 0
+        self.condition = threading.Condition()
+
+    def acquire(self):
+        with self.condition:
+            while self.inflight >= int(self.limit):
+                self.condition.wait()
+            self.inflight += 1
+
+    def release(self, latency, throttled):
+        with self.condition:
+            self.inflight -= 1
+            if throttled:
+                self.limit = max(self.min_limit,
+                                 self.limit * self.decrease_factor)
+                logger.info("Throttled by API. Concurrency down to {}"
+                            .format(int(self.limit)))
+            elif latency <= self.target_latency:
+                self.limit = min(self.max_limit, self.limit + 1 / self.limit)
+            self.condition.notify_all()
+
+
+class Slot(object):
+    ''' outcome of a rate-limited request, filled by the caller '''
+
+    def __init__(self):
+        self.response = None
+        # seconds the caller should wait before retrying
+        self.backoff = 0
+
+    def observe(self, response):
+        self.response = response
+
+    @property
+    def http_code(self):
+        return getattr(self.response, 'status_code', None)
+
+    @property
+    def throttled(self):
+        # no response means a network error: slow down as well
+        return self.response is None or is_throttling(self.http_code)
+
+
+class RateLimiter(object):
+
+    def __init__(self, sender_rate=None, contract_rate=None, burst=None,
+                 store='local', folder=None, adaptive=False,
+                 max_concurrency=32, target_latency=1.0):
+        self.sender_rate = sender_rate
+        self.contract_rate = contract_rate
+        self.burst = burst
+        self.store = store
+        self.folder = folder or tempfile.gettempdir()
+        self.buckets = {}
+        self.lock = threading.Lock()
+        self.concurrency = AdaptiveLimiter(
+            max_limit=max_concurrency,
+            target_latency=target_latency) if adaptive else None
+
+    def get_bucket(self, key, rate):
+        bucket = self.buckets.get(key)
+        if bucket is None:
+            with self.lock:
+                if key not in self.buckets:
+                    self.buckets[key] = self.build_bucket(key, rate)
+                bucket = self.buckets[key]
+        return bucket
+
+    def build_bucket(self, key, rate):
+        if self.store == 'file':
+            name = hashlib.sha1(key.encode('utf-8')).hexdigest()[:16]
+            path = os.path.join(self.folder,
+                                'orangeapisms-{}.bucket'.format(name))
+            return FileTokenBucket(path, rate, self.burst)
+        return TokenBucket(rate, self.burst)
+
+    def buckets_for(self, sender_address):
+        if self.contract_rate:
+            yield self.get_bucket(
+                'contract:{}'.format(get_config('client_id')),
+                self.contract_rate)
+        if self.sender_rate:
+            yield self.get_bucket('sender:{}'.format(sender_address),
+                                  self.sender_rate)
+
+    def reserve(self, sender_address, cost=1):
+        ''' (buckets, seconds to wait) taking cost without sleeping
+
+            for callers which can't block (event loop). Not covered by
+            adaptive concurrency. '''
+        buckets = list(self.buckets_for(sender_address))
+        return buckets, max([bucket.take(cost) for bucket in buckets] or [0])
+
+    def backoff(self, buckets, response):
+        ''' seconds to wait before retrying a throttled (429) request
+
+            buckets are paused instead if there are some '''
+        pause = retry_after(response)
+        for bucket in buckets:
+            bucket.pause(pause)
+        return 0 if buckets else pause
+
+    @contextmanager
+    def limit(self, sender_address, cost=1):
+        ''' wait for rate and concurrency limits before a request
+
+            call observe(response) on the yielded Slot to feed the
+            adaptive limiter and pause buckets on throttling. Without
+            buckets, slot.backoff is then the time to wait before retrying '''
+        buckets = list(self.buckets_for(sender_address))
+        for bucket in buckets:
+            bucket.acquire(cost)
+        if self.concurrency is not None:
+            self.concurrency.acquire()
+        slot = Slot()
+        started = time.time()
+        try:
+            yield slot
+        finally:
+            if self.concurrency is not None:
+                self.concurrency.release(time.time() - started,
+                                         slot.throttled)
+            if slot.http_code == TOO_MANY_REQUESTS:
+                slot.backoff = self.backoff(buckets, slot.response)
+
+
+_lock = threading.Lock()
+_limiter = None
+
+
+def get_rate_limiter():
+    ''' process-wide RateLimiter built from config '''
+    global _limiter
+    if _limiter is None:
+        with _lock:
+            if _limiter is None:
+                _limiter = RateLimiter(
+                    sender_rate=get_config('rate_limit_sender'),
+                    contract_rate=get_config('rate_limit_contract'),
+                    burst=get_config('rate_limit_burst'),
+                    store=get_config('rate_limit_store'),
+                    folder=get_config('rate_limit_folder'),
+                    adaptive=get_config('adaptive_concurrency'),
+                    max_concurrency=get_config('max_concurrency'),
+                    target_latency=get_config('target_latency'))
+    return _limiter
@@ -0,0 +1,198 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# vim: ai ts=4 sts=4 et sw=4 nu
+
+''' Daily message counts, maintained as messages are written '''
+
+from __future__ import (unicode_literals, absolute_import,
+                        division, print_function)
+
+import logging
+import datetime
+from collections import Counter, OrderedDict
+
+from django.conf import settings
+from django.db import transaction, IntegrityError, DatabaseError
+from django.db.models import F, Sum, Count, Min, Max
+from django.utils import timezone
+
+from orangeapisms.config import get_config
+from orangeapisms.models import SMSMessage, DailyRollup
+
+logger = logging.getLogger(__name__)
+
+KEY_FIELDS = ('day', 'direction', 'sms_type', 'status', 'sender')
+# SMSMessage fields a rollup key is made of
+FIELDS = frozenset(['created_on', 'direction', 'sms_type', 'status',
+                    'sender_address', 'destination_address'])
+
+
+def utc_day(adate):
+    if timezone.is_aware(adate):
+        adate = adate.astimezone(timezone.utc)
+    return adate.date()
+
+
+def day_start(day):
+    start = datetime.datetime.combine(day, datetime.time.min)
+    if settings.USE_TZ:
+        start = timezone.make_aware(start, timezone.utc)
+    return start
+
+
+def rollup_key(msg):
+    ''' (day, direction, sms_type, status, sender) of msg '''
+    if msg.created_on is None:
+        return None
+    sender = msg.destination_address if msg.direction == msg.INCOMING \
+        else msg.sender_address
+    return (utc_day(msg.created_on), msg.direction, msg.sms_type,
+            msg.status, sender or '')
+
+
+def record_created(messages):
+    ''' account for messages just inserted '''
+    record_deltas(Counter(rollup_key(msg) for msg in messages))
+
+
+def record_deleted(rows):
+    ''' account for rows (FIELDS values) just deleted '''
+    deltas = Counter()
+    for row in rows:
+        deltas[rollup_key(SMSMessage(**row))] -= 1
+    record_deltas(deltas)
+
+
+def record_moves(moves):
+    ''' account for rows moved to another type and status
+
+        moves are (row, sms_type, status, count): count rows of the
+        state of row (FIELDS values) got sms_type and status '''
+    deltas = Counter()
+    for row, sms_type, status, count in moves:
+        msg = SMSMessage(**row)
+        deltas[rollup_key(msg)] -= count
+        msg.sms_type, msg.status = sms_type, status
+        deltas[rollup_key(msg)] += count
+    record_deltas(deltas)
+
+
+def record_deltas(deltas):
+    if not get_config('rollups_enabled'):
+        return
+    deltas.pop(None, None)
+    if any(deltas.values()):
+        apply_deltas(deltas)
+
+
+def apply_deltas(deltas):
+    ''' add deltas ({key: delta}) to rollup rows
+
+        a failure is logged but doesn't fail the message write: run
+        rebuild() for the day to fix it. '''
+    try:
+        # savepoint so a failure doesn't break an outer transaction
+        with transaction.atomic():
+            # same order everywhere so concurrent writers don't deadlock
+            for key in sorted(key for key in deltas if deltas[key]):
+                increment(dict(zip(KEY_FIELDS, key)), deltas[key])
+    except DatabaseError as exp:
+        logger.error("Unable to update rollups: {}".format(exp))
+        logger.exception(exp)
+
+
+def increment(lookup, delta):
+    rollups = DailyRollup.objects.filter(**lookup)
+    if rollups.update(count=F('count') + delta):
+        return
+    try:
+        with transaction.atomic():
+            DailyRollup.objects.create(count=delta, **lookup)
+    except IntegrityError:
+        # created concurrently
+        rollups.update(count=F('count') + delta)
+
+
+def rebuild_day(day):
+    ''' recompute rollups of a day from the messages table '''
+    start = day_start(day)
+    messages = SMSMessage.objects.order_by().filter(
+        created_on__gte=start,
+        created_on__lt=start + datetime.timedelta(days=1))
+    counts = Counter()
+    for direction, sender_field in ((SMSMessage.OUTGOING, 'sender_address'),
+                                    (SMSMessage.INCOMING,
+                                     'destination_address')):
+        rows = messages.filter(direction=direction) \
+            .values('sms_type', 'status', sender_field) \
+            .annotate(count=Count('uuid'))
+        for row in rows:
+            counts[(day, direction, row['sms_type'], row['status'],
+                    row[sender_field] or '')] += row['count']
+    with transaction.atomic():
+        DailyRollup.objects.filter(day=day).delete()
+        DailyRollup.objects.bulk_create([
+            DailyRollup(count=count, **dict(zip(KEY_FIELDS, key)))
+            for key, count in counts.items()])
+    return sum(counts.values())
+
+
+def rebuild(since=None, until=None, progress=None):
+    ''' recompute rollups of days from since to until (dates, included)
+
+        defaults to the days of the first and last stored messages.
+        Days without messages left (ie. archived) lose their rollups.
+        progress is called with (day, messages count) after each day '''
+    if since is None or until is None:
+        bounds = SMSMessage.objects.aggregate(first=Min('created_on'),
+                                              last=Max('created_on'))
+        if bounds['first'] is None:
+            return 0
+        since = since or utc_day(bounds['first'])
+        until = until or utc_day(bounds['last'])
+    day, days = since, 0
+    while day <= until:
+        count = rebuild_day(day)
+        if progress is not None:
+            progress(day, count)
+        day += datetime.timedelta(days=1)
+        days += 1
+    return days
+
+
+def summarize(rows):
+    ''' per day totals (most recent first) of rollup rows
+
+        rows are dicts with day, direction, status and count '''
+    days = OrderedDict()
+    for row in sorted(rows, key=lambda row: row['day'], reverse=True):
+        totals = days.get(row['day'])
+        if totals is None:
+            totals = days[row['day']] = {
+                'day': row['day'],
+                SMSMessage.INCOMING: 0, SMSMessage.OUTGOING: 0}
+            totals.update({status: 0 for status in SMSMessage.STATUSES})
+        totals[row['direction']] += row['count']
+        totals[row['status']] += row['count']
+    for totals in days.values():
+        outgoing = totals[SMSMessage.OUTGOING]
+        totals['delivery_rate'] = \
+            totals[SMSMessage.DELIVERED] / outgoing if outgoing else None
+    return list(days.values())
+
+
+def daily_totals(since, until=None, **filters):
+    ''' per day totals from since to until (dates, included)
+
+        filters apply to DailyRollup fields, ie. sender='+22300000' '''
+    rollups = DailyRollup.objects.filter(day__gte=since, **filters)
+    if until is not None:
+        rollups = rollups.filter(day__lte=until)
+    return summarize(rollups.values('day', 'direction', 'status')
+                     .annotate(count=Sum('count')).order_by())
+
+
+def recent_totals(days=7):
+    ''' per day totals of the last days (today included, UTC) '''
+    today = utc_day(timezone.now())
+    return daily_totals(today - datetime.timedelta(days=days - 1))
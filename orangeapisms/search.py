@@ -0,0 +1,245 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# vim: ai ts=4 sts=4 et sw=4 nu
+
+''' Search of messages by number and content (full-text backends) '''
+
+from __future__ import (unicode_literals, absolute_import,
+                        division, print_function)
+
+import re
+import abc
+import logging
+
+from django.db import connections, transaction, DatabaseError
+from django.db.models import Q
+from py3compat import with_metaclass
+
+from orangeapisms.config import get_config
+from orangeapisms.models import SMSMessage
+from orangeapisms.utils import cleaned_msisdn
+
+logger = logging.getLogger(__name__)
+
+TABLE = SMSMessage._meta.db_table
+NUMBER = re.compile(r'^(tel:)?\+?\d{6,}$')
+
+
+def split_query(query):
+    ''' (numbers, words) of a search query '''
+    numbers, words = [], []
+    for term in query.split():
+        if NUMBER.match(term):
+            numbers.append(SMSMessage.clean_address(term))
+        else:
+            words.append(term)
+    return numbers, words
+
+
+def escape_like(text):
+    return text.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_')
+
+
+class SearchBackend(with_metaclass(abc.ABCMeta, object)):
+    ''' full-text search on SMSMessage.content '''
+
+    vendor = None
+
+    def install(self, connection):
+        ''' create index structures, if missing '''
+
+    def uninstall(self, connection):
+        pass
+
+    def rebuild(self, connection):
+        ''' reindex all stored messages '''
+
+    def is_installed(self, connection):
+        return True
+
+    @abc.abstractmethod
+    def filter(self, queryset, words):
+        ''' messages of queryset containing all words '''
+
+
+class LikeSearchBackend(SearchBackend):
+    ''' no index: scans the table '''
+
+    def filter(self, queryset, words):
+        for word in words:
+            queryset = queryset.filter(content__icontains=word)
+        return queryset
+
+
+class PostgreSQLSearchBackend(SearchBackend):
+    ''' tsvector and trigram GIN indexes (expressions: always in sync) '''
+
+    vendor = 'postgresql'
+    TSV_INDEX = '{}_content_tsv'.format(TABLE)
+    TRGM_INDEX = '{}_content_trgm'.format(TABLE)
+
+    def install(self, connection):
+        with connection.cursor() as cursor:
+            cursor.execute(
+                "CREATE INDEX IF NOT EXISTS {index} ON {table} "
+                "USING gin (to_tsvector('simple', content))"
+                .format(index=self.TSV_INDEX, table=TABLE))
+        try:
+            # savepoint: requires privileges we may not have
+            with transaction.atomic(using=connection.alias):
+                with connection.cursor() as cursor:
+                    cursor.execute("CREATE EXTENSION IF NOT EXISTS pg_trgm")
+                    cursor.execute(
+                        "CREATE INDEX IF NOT EXISTS {index} ON {table} "
+                        "USING gin (content gin_trgm_ops)"
+                        .format(index=self.TRGM_INDEX, table=TABLE))
+        except DatabaseError as exp:
+            logger.warning("Unable to create trigram index ({}): substring "
+                           "searches will scan the table".format(exp))
+
+    def uninstall(self, connection):
+        with connection.cursor() as cursor:
+            for index in (self.TSV_INDEX, self.TRGM_INDEX):
+                cursor.execute("DROP INDEX IF EXISTS {}".format(index))
+
+    def filter(self, queryset, words):
+        text = ' '.join(words)
+        # expression must be the indexed one to use the index
+        return queryset.extra(
+            where=["(to_tsvector('simple', {table}.content) "
+                   "@@ plainto_tsquery('simple', %s) "
+                   "OR {table}.content ILIKE %s)".format(table=TABLE)],
+            params=[text, '%{}%'.format(escape_like(text))])
+
+
+class SQLiteSearchBackend(SearchBackend):
+    ''' FTS5 table of content, its rowids mapped to messages' uuid
+
+        (messages' own rowids are renumbered by VACUUM) '''
+
+    vendor = 'sqlite'
+    FTS_TABLE = '{}_fts'.format(TABLE)
+    MAP_TABLE = '{}_fts_map'.format(TABLE)
+    TABLES = [
+        "CREATE TABLE IF NOT EXISTS {map} ("
+        "id INTEGER PRIMARY KEY, uuid char(32) NOT NULL UNIQUE)",
+        "CREATE VIRTUAL TABLE IF NOT EXISTS {fts} USING fts5(content)",
+    ]
+    TRIGGERS = {
+        'ai': "AFTER INSERT ON {table} BEGIN "
+              "INSERT INTO {map}(uuid) VALUES (new.uuid); "
+              "INSERT INTO {fts}(rowid, content) VALUES ("
+              "(SELECT id FROM {map} WHERE uuid = new.uuid), new.content); "
+              "END",
+        'ad': "AFTER DELETE ON {table} BEGIN "
+              "DELETE FROM {fts} WHERE rowid = "
+              "(SELECT id FROM {map} WHERE uuid = old.uuid); "
+              "DELETE FROM {map} WHERE uuid = old.uuid; END",
+        'au': "AFTER UPDATE OF content ON {table} BEGIN "
+              "UPDATE {fts} SET content = new.content WHERE rowid = "
+              "(SELECT id FROM {map} WHERE uuid = new.uuid); END",
+    }
+    REBUILD = [
+        "DELETE FROM {fts}",
+        "DELETE FROM {map}",
+        "INSERT INTO {map}(uuid) SELECT uuid FROM {table}",
+        "INSERT INTO {fts}(rowid, content) SELECT {map}.id, {table}.content "
+        "FROM {map} JOIN {table} ON {table}.uuid = {map}.uuid",
+    ]
+
+    def trigger_name(self, suffix):
+        return '{}_{}'.format(self.FTS_TABLE, suffix)
+
+    def sql(self, statement):
+        return statement.format(table=TABLE, fts=self.FTS_TABLE,
+                                map=self.MAP_TABLE)
+
+    def install(self, connection):
+        with connection.cursor() as cursor:
+            for statement in self.TABLES:
+                cursor.execute(self.sql(statement))
+            for suffix, trigger in sorted(self.TRIGGERS.items()):
+                cursor.execute("CREATE TRIGGER IF NOT EXISTS {} {}".format(
+                    self.trigger_name(suffix), self.sql(trigger)))
+        self.rebuild(connection)
+
+    def uninstall(self, connection):
+        with connection.cursor() as cursor:
+            for suffix in sorted(self.TRIGGERS):
+                cursor.execute("DROP TRIGGER IF EXISTS {}"
+                               .format(self.trigger_name(suffix)))
+            for table in (self.FTS_TABLE, self.MAP_TABLE):
+                cursor.execute("DROP TABLE IF EXISTS {}".format(table))
+
+    def rebuild(self, connection):
+        with connection.cursor() as cursor:
+            for statement in self.REBUILD:
+                cursor.execute(self.sql(statement))
+
+    def is_installed(self, connection):
+        # triggers are lost if a migration rebuilds the messages table
+        names = [self.FTS_TABLE, self.MAP_TABLE] + [
+            self.trigger_name(suffix) for suffix in self.TRIGGERS]
+        with connection.cursor() as cursor:
+            cursor.execute("SELECT COUNT(*) FROM sqlite_master WHERE name IN "
+                           "({})".format(', '.join(['%s'] * len(names))),
+                           names)
+            return cursor.fetchone()[0] == len(names)
+
+    @staticmethod
+    def match_query(words):
+        ''' FTS5 query: all words, as prefixes '''
+        return ' '.join('"{}"*'.format(word.replace('"', '""'))
+                        for word in words)
+
+    def filter(self, queryset, words):
+        return queryset.extra(
+            where=[self.sql("{table}.uuid IN (SELECT uuid FROM {map} WHERE "
+                            "id IN (SELECT rowid FROM {fts} "
+                            "WHERE {fts} MATCH %s))")],
+            params=[self.match_query(words)])
+
+
+BACKENDS = {
+    'postgresql': PostgreSQLSearchBackend,
+    'sqlite': SQLiteSearchBackend,
+    'like': LikeSearchBackend,
+}
+
+
+def database_backend(connection):
+    ''' full-text backend for the database of connection '''
+    for backend in BACKENDS.values():
+        if backend.vendor == connection.vendor:
+            return backend()
+    return LikeSearchBackend()
+
+
+def get_search_backend(using='default'):
+    name = get_config('search_backend')
+    connection = connections[using]
+    backend = database_backend(connection) if name == 'auto' \
+        else BACKENDS[name]()
+    if backend.vendor not in (None, connection.vendor) or \
+            not backend.is_installed(connection):
+        logger.warning("{} search index unavailable: scanning messages. "
+                       "Run orangeapisms_search_index."
+                       .format(type(backend).__name__))
+        return LikeSearchBackend()
+    return backend
+
+
+def search_messages(query, queryset=None):
+    ''' messages of queryset (default: all) matching a search query
+
+        numbers must match an address, other words the content '''
+    queryset = queryset if queryset is not None \
+        else SMSMessage.objects.all()
+    numbers, words = split_query(query)
+    for number in numbers:
+        addresses = set([number, cleaned_msisdn(number)])
+        queryset = queryset.filter(Q(sender_address__in=addresses) |
+                                   Q(destination_address__in=addresses))
+    if words:
+        queryset = get_search_backend(queryset.db).filter(queryset, words)
+    return queryset
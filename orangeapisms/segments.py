@@ -0,0 +1,110 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# vim: ai ts=4 sts=4 et sw=4 nu
+
+''' SMS encoding (GSM-7 or UCS-2) and segments (billed units) of a text '''
+
+from __future__ import (unicode_literals, absolute_import,
+                        division, print_function)
+
+import logging
+import unicodedata
+from collections import namedtuple
+
+logger = logging.getLogger(__name__)
+
+GSM7 = 'GSM-7'
+UCS2 = 'UCS-2'
+
+GSM7_BASIC = frozenset(
+    "@£$¥èéùìòÇ\nØø\rÅåΔ_ΦΓΛΩΠΨΣΘΞÆæßÉ !\"#¤%&'()*+,-./0123456789:;<=>?"
+    "¡ABCDEFGHIJKLMNOPQRSTUVWXYZÄÖÑÜ§¿abcdefghijklmnopqrstuvwxyzäöñüà")
+GSM7_EXTENDED = frozenset("\f^{}\\[~]|€")
+GSM7_CHARS = GSM7_BASIC | GSM7_EXTENDED
+
+# (single SMS, per segment of a concatenated SMS)
+LIMITS = {
+    GSM7: (160, 153),
+    UCS2: (70, 67),
+}
+
+TRANSLITERATIONS = {
+    '\u00a0': ' ', '\u2002': ' ', '\u2003': ' ', '\u2009': ' ',
+    '\u2018': "'", '\u2019': "'", '\u201a': "'", '\u2032': "'",
+    '\u201c': '"', '\u201d': '"', '\u201e': '"', '\u00ab': '"',
+    '\u00bb': '"', '\u2033': '"',
+    '\u2010': '-', '\u2011': '-', '\u2012': '-', '\u2013': '-',
+    '\u2014': '-', '\u2212': '-',
+    '\u2026': '...', '\u2022': '*', '\u00b7': '.',
+    '\u0153': 'oe', '\u0152': 'OE', '\u00e7': 'c', '\t': ' ',
+}
+
+Segments = namedtuple('Segments', ['encoding', 'length', 'count',
+                                   'remaining'])
+
+
+def is_gsm7(text):
+    return GSM7_CHARS.issuperset(text)
+
+
+def char_length(char, encoding):
+    ''' units (septets or UTF-16 code units) used by char '''
+    if encoding == GSM7:
+        return 2 if char in GSM7_EXTENDED else 1
+    return 2 if ord(char) > 0xFFFF else 1
+
+
+def count_segments(text):
+    ''' Segments (encoding, length in units, count, units remaining in
+        last segment) needed to send text '''
+    if is_gsm7(text):
+        encoding = GSM7
+        length = len(text) + sum(text.count(char)
+                                 for char in GSM7_EXTENDED)
+    else:
+        encoding = UCS2
+        length = len(text.encode('utf-16-le')) // 2
+
+    single, per_segment = LIMITS[encoding]
+    if length <= single:
+        return Segments(encoding, length, 1 if length else 0,
+                        single - length)
+
+    # a two-units char can't be split over two segments
+    count, used = 1, 0
+    for char in text:
+        units = char_length(char, encoding)
+        if used + units > per_segment:
+            count += 1
+            used = 0
+        used += units
+    return Segments(encoding, length, count, per_segment - used)
+
+
+_transliterated = {}
+
+
+def transliterate_char(char):
+    if char in GSM7_CHARS:
+        return char
+    if char not in _transliterated:
+        replacement = TRANSLITERATIONS.get(char)
+        if replacement is None:
+            # accented letters: drop the accent if base letter is GSM-7
+            decomposed = ''.join(
+                part for part in unicodedata.normalize('NFKD', char)
+                if not unicodedata.combining(part))
+            replacement = decomposed if decomposed and \
+                is_gsm7(decomposed) else char
+        _transliterated[char] = replacement
+    return _transliterated[char]
+
+
+def transliterate(text):
+    ''' text with non-GSM characters replaced by GSM-7 look-alikes
+
+        characters without look-alike (emoji, non-latin scripts) are kept
+        so the text would still be sent as UCS-2 '''
+    if is_gsm7(text):
+        return text
+    return ''.join(transliterate_char(char) for char in text)
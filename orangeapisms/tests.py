@@ -5,9 +5,47 @@
 from __future__ import (unicode_literals, absolute_import,
                         division, print_function)
 
+import io
+import time
+import uuid
+import subprocess
+import datetime
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from wsgiref.util import setup_testing_defaults
+
+import pytz
 import pytest
+import requests
+import simplejson
+from django.db import connection, OperationalError
 
-from orangeapisms.utils import cleaned_msisdn
+from orangeapisms import utils, campaign, cache, config, views, workers
+from orangeapisms.utils import cleaned_msisdn, cleaned_msisdn_many
+from orangeapisms.config import (update_config, DatabaseConfigBackend,
+                                 CacheConfigBackend)
+from orangeapisms.ratelimit import TokenBucket, AdaptiveLimiter, RateLimiter
+from orangeapisms.tokens import TokenManager, FileTokenStore
+from orangeapisms.exceptions import (OrangeAPIError, InsufficientBalance,
+                                     is_retryable)
+from orangeapisms.pagination import encode_cursor, decode_cursor
+from orangeapisms.dispatch import HandlerStats, HandlerDispatcher
+from orangeapisms.cache import LRUCache, TTLCache
+from orangeapisms.buffer import (JournalSegment, WriteBehindBuffer,
+                                 BufferFull)
+from orangeapisms.segments import count_segments, transliterate
+from orangeapisms.campaign import MessageTemplate, Campaign
+from orangeapisms.emulator import OrangeAPIEmulator
+from orangeapisms.metrics import (MetricsRegistry, FileExporter, merge,
+                                  render)
+from orangeapisms.archive import (ArchiveWriter, read_archives, from_archive,
+                                  archive_messages)
+from orangeapisms.export import filtered_messages, parse_date, export_lines
+from orangeapisms.rollups import rollup_key, summarize, rebuild
+from orangeapisms.search import (split_query, SQLiteSearchBackend,
+                                 get_search_backend, search_messages)
+from orangeapisms.outbox import claim, drain_batch
+from orangeapisms.models import SMSMessage, DailyRollup
 
 
 @pytest.fixture()
@@ -47,3 +85,848 @@ def test_msisdn_extra_chars(correct_msisdn):
 def test_msisdn_zero_prefixed(correct_msisdn):
     number = "0022376333005"
     assert correct_msisdn == cleaned_msisdn(number)
+
+
+def test_msisdn_many(correct_msisdn):
+    numbers = ["76333005", "+223 76 33 30 05", "0022376333005"]
+    assert list(cleaned_msisdn_many(numbers)) == [correct_msisdn] * 3
+
+
+def test_token_bucket_wait():
+    bucket = TokenBucket(rate=10, burst=2)
+    assert bucket.take() == 0
+    assert bucket.take() == 0
+    assert 0.05 < bucket.take() <= 0.1
+
+
+def test_adaptive_limiter_aimd():
+    limiter = AdaptiveLimiter(max_limit=8, target_latency=1, initial=4)
+    limiter.acquire()
+    limiter.release(latency=0.1, throttled=False)
+    assert limiter.limit == 4.25
+    limiter.acquire()
+    limiter.release(latency=0.1, throttled=True)
+    assert limiter.limit == 2.125
+
+
+def test_rate_limiter_retry_after():
+    response = requests.Response()
+    response.status_code = 429
+    response.headers['Retry-After'] = '3'
+    # no bucket to pause: the caller waits
+    with RateLimiter().limit('tel:+22300000') as slot:
+        slot.observe(response)
+    assert slot.backoff == 3
+    limiter = RateLimiter(sender_rate=10)
+    with limiter.limit('tel:+22300000') as slot:
+        slot.observe(response)
+    assert slot.backoff == 0
+    assert limiter.reserve('tel:+22300000')[1] > 2
+
+
+def test_retryable_errors():
+    assert is_retryable(OrangeAPIError(http_code=503))
+    assert is_retryable(OrangeAPIError(http_code=429))
+    assert not is_retryable(OrangeAPIError(http_code=400,
+                                           error_code='SVC0004'))
+    assert is_retryable(requests.ConnectionError())
+    assert not is_retryable(ValueError())
+
+
+def test_keyset_cursor():
+    class Message(object):
+        created_on = datetime.datetime(2016, 11, 20, 10, 30, 12, 123456)
+        uuid = uuid.uuid4()
+
+    created_on, pk = decode_cursor(encode_cursor(Message))
+    assert created_on.replace(tzinfo=None) == Message.created_on
+    assert pk == Message.uuid
+    with pytest.raises(ValueError):
+        decode_cursor("not-a-cursor")
+
+
+def test_handler_stats():
+    stats = HandlerStats(window=10)
+    for duration in range(1, 21):
+        stats.record(duration, failed=duration == 20)
+    snapshot = stats.snapshot()
+    assert snapshot['calls'] == 20 and snapshot['failures'] == 1
+    assert snapshot['max'] == 20 and snapshot['mean'] == 10.5
+    # percentiles are computed on the window only
+    assert snapshot['p50'] == 15 and snapshot['p99'] == 20
+
+
+def test_lru_cache():
+    cache = LRUCache(maxsize=2)
+    cache.set('a', 1)
+    cache.set('b', 2)
+    assert cache.get('a') == 1  # b is now least recently used
+    cache.set('c', 3)
+    assert 'b' not in cache and len(cache) == 2
+    assert cache.get('b', 'missing') == 'missing'
+
+
+def test_ttl_cache():
+    cache = TTLCache(ttl=60)
+    cache.set('balance', 10)
+    assert cache.update('balance', lambda value: value - 3) == 7
+    assert cache.get('balance') == 7
+    cache.set('expired', 1, ttl=-1)
+    assert cache.get('expired') is None
+    assert cache.update('expired', lambda value: value - 1) is None
+    cache.set('disabled', 1, ttl=0)
+    assert cache.get('disabled', 'missing') == 'missing'
+
+
+@pytest.mark.django_db
+def test_sms_balance(monkeypatch):
+    class Clock(object):
+        now = 1000
+
+        @classmethod
+        def time(cls):
+            return cls.now
+    monkeypatch.setattr(cache, 'time', Clock)
+    monkeypatch.setattr(utils, 'api_cache', TTLCache())
+    fetched = []
+
+    def get_contracts(use_cache=True):
+        fetched.append(use_cache)
+        return {'partnerContracts': {'contracts': [{
+            'service': 'SMS_OCB', 'serviceContracts': [{
+                'service': 'SMS_OCB', 'country': 'MLI',
+                'availableUnits': 5, 'expires': '2099-01-01T00:00:00'}]}]}}
+    monkeypatch.setattr(utils, 'get_contracts', get_contracts)
+    assert utils.has_sms_balance(3)
+    # decremented locally until contracts_cache_ttl elapsed
+    utils.consume_sms_balance(3)
+    assert not utils.has_sms_balance(3) and fetched == [False]
+    Clock.now += 300
+    assert utils.has_sms_balance(3) and fetched == [False, False]
+
+    utils.consume_sms_balance(4)
+    update_config({'check_sms_balance': True})
+    try:
+        with pytest.raises(InsufficientBalance):
+            utils.send_sms('+22370000000', "a" * 161, '+22300000')
+        results = utils.send_sms_bulk(['+22370000001', '+22370000002'],
+                                      "hello", '+22300000', batch_size=2)
+    finally:
+        update_config({'check_sms_balance': False})
+    assert [success for success, msg in results] == [False, False]
+    assert set(SMSMessage.objects.values_list('status', 'last_error')) == \
+        set([(SMSMessage.FAILED_TO_SEND,
+              "Insufficient SMS balance to send 2 units")])
+
+
+class FakeTokenEndpoint(object):
+    ''' fetch function of a TokenManager counting calls '''
+
+    def __init__(self, lifetime=3600):
+        self.lifetime = lifetime
+        self.calls = 0
+        self.lock = threading.Lock()
+
+    def __call__(self):
+        with self.lock:
+            self.calls += 1
+            calls = self.calls
+        time.sleep(0.05)  # so that callers overlap
+        return {'token': 'token{}'.format(calls),
+                'token_expiry': datetime.datetime.now() +
+                datetime.timedelta(seconds=self.lifetime)}
+
+
+def test_token_single_flight(tmpdir):
+    store = FileTokenStore(str(tmpdir.join('token.json')))
+    store.save({'token': 'expired', 'token_expiry': datetime.datetime.now()})
+    fetch = FakeTokenEndpoint()
+    manager = TokenManager(store, fetch, background_refresh=False)
+    tokens = []
+    threads = [threading.Thread(target=lambda: tokens.append(
+        manager.get_token())) for _ in range(10)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert tokens == ['token1'] * 10 and fetch.calls == 1
+    # another process picks the shared token
+    other = TokenManager(store, fetch, background_refresh=False)
+    assert other.get_token() == 'token1' and fetch.calls == 1
+
+
+def test_token_refresh_ahead(tmpdir):
+    store = FileTokenStore(str(tmpdir.join('token.json')))
+    fetch = FakeTokenEndpoint()
+    # about to expire, though still usable
+    store.save({'token': 'old', 'token_expiry': datetime.datetime.now() +
+                datetime.timedelta(seconds=120)})
+    manager = TokenManager(store, fetch, refresh_ahead=300)
+    assert manager.get_token() == 'old'
+    deadline = time.time() + 5
+    while manager.cached_token() == 'old' and time.time() < deadline:
+        time.sleep(0.01)
+    assert manager.cached_token() == 'token1' and fetch.calls == 1
+    assert store.load()['token'] == 'token1'
+
+
+@pytest.fixture()
+def config_backend(monkeypatch):
+    ''' swaps ConfigState.backend, restoring CONFIG afterwards '''
+    saved = dict(config.CONFIG)
+    for attr in ('backend', 'version', 'loaded', 'next_check'):
+        monkeypatch.setattr(config.ConfigState, attr,
+                            getattr(config.ConfigState, attr))
+    reloaders = []
+    monkeypatch.setattr(config, 'start_reloader', reloaders.append)
+
+    def use(backend):
+        config.ConfigState.backend = backend
+        config.ConfigState.version = None
+        config.ConfigState.loaded = False
+        config.ConfigState.next_check = 0
+        return backend, reloaders
+    yield use
+    config.CONFIG.clear()
+    config.CONFIG.update(saved)
+
+
+def check_config_backend(backend, reloaders, other):
+    ''' other is another process' instance of backend '''
+    assert backend.load() == {}
+    version = backend.version()
+    expiry = datetime.datetime(2099, 1, 1)
+    update_config({'sender_name': "Mine", 'token_expiry': expiry}, save=True)
+    assert other.load() == {'sender_name': "Mine", 'token_expiry': expiry}
+    assert backend.version() != version
+    # first read starts the reloader ; our own change is not reloaded
+    generation = config.ConfigState.generation
+    assert config.get_config('sender_name') == "Mine"
+    assert reloaders == [config.get_config('config_reload_interval')]
+    assert config.ConfigState.generation == generation
+
+    time.sleep(0.01)  # distinct version
+    other.save({'sender_name': "Theirs"})
+    assert config.get_config('sender_name') == "Mine"
+    # what the reloader does every config_reload_interval
+    assert config.reload_config()
+    assert config.get_config('sender_name') == "Theirs"
+    assert config.get_config('token_expiry') == expiry
+    assert not config.reload_config()
+
+
+@pytest.mark.django_db
+def test_db_config_backend(config_backend):
+    backend, reloaders = config_backend(DatabaseConfigBackend())
+    check_config_backend(backend, reloaders, DatabaseConfigBackend())
+
+
+def test_cache_config_backend(config_backend):
+    backend, reloaders = config_backend(CacheConfigBackend())
+    keys = [backend.key, '{}:version'.format(backend.key)]
+    backend.cache.delete_many(keys)
+    try:
+        check_config_backend(backend, reloaders, CacheConfigBackend())
+    finally:
+        backend.cache.delete_many(keys)
+
+
+def test_journal_segment(tmpdir):
+    segment = JournalSegment.create(str(tmpdir), fsync=False)
+    segment.append('mo', {'uuid': 'abc'})
+    segment.append('dr', {'callbackData': 'abc'})
+    # crashed while writing
+    segment.file.write('["dr", {"callb')
+    segment.file.flush()
+    assert list(segment.read()) == [('mo', {'uuid': 'abc'}),
+                                    ('dr', {'callbackData': 'abc'})]
+    segment.remove()
+    assert not tmpdir.listdir()
+
+
+def test_segments():
+    assert count_segments("a" * 160).count == 1
+    assert count_segments("a" * 161).count == 2
+    # extension chars use two septets and are not split
+    assert count_segments("a" * 158 + "\u20ac").count == 1
+    assert count_segments("a" * 152 + "\u20ac" + "a" * 152).count == 3
+    # a single non-GSM char switches to UCS-2
+    assert count_segments("a" * 70 + "\u0161").encoding == 'UCS-2'
+    assert count_segments("a" * 70 + "\u0161").count == 2
+
+
+def test_transliterate():
+    text = transliterate("\u201cna\u00efve\u201d \u2013 l\u2019\u00e9t\u00e9")
+    assert text == "\"naive\" - l'\u00e9t\u00e9"
+    assert count_segments(text).encoding == 'GSM-7'
+
+
+def test_message_template():
+    template = MessageTemplate("Hello {name}, you owe {amount:.2f} F")
+    assert template.fields == ['name', 'amount']
+    assert template.render({'name': "Ami", 'amount': 3.5}) == \
+        "Hello Ami, you owe 3.50 F"
+    with pytest.raises(KeyError):
+        template.render({'name': "Ami"})
+    with pytest.raises(ValueError):
+        MessageTemplate("Hello {}")
+
+
+def test_campaign_resume(tmpdir, monkeypatch):
+    source = tmpdir.join('customers.csv')
+    source.write('number,name\n' + ''.join(
+        '7000000{},Ami{}\n'.format(index, index) for index in range(5)))
+    sent, interrupted = [], []
+
+    def submit_message(msg):
+        if len(sent) == 3 and not interrupted:
+            interrupted.append(msg.destination_address)
+            raise KeyboardInterrupt()
+        sent.append(msg.destination_address)
+        msg.record_attempt(reference='ref')
+        return True
+    monkeypatch.setattr(campaign, 'submit_message', submit_message)
+    template = MessageTemplate("Hello {name}")
+
+    def run():
+        return Campaign(str(source), template, batch_size=2, concurrency=1,
+                        db_save=False).run()
+    with pytest.raises(KeyboardInterrupt):
+        run()
+    # interrupted during the second batch, which is sent again
+    assert run()['offset'] == 5
+    assert sent[3:] == ['+22370000002', '+22370000003', '+22370000004']
+
+
+def test_emulator():
+    emulator = OrangeAPIEmulator(units=2, dr_delay=None)
+
+    def call(method, path, body=None, token=None):
+        content = simplejson.dumps(body).encode('utf-8') if body else b''
+        environ = {'REQUEST_METHOD': method, 'PATH_INFO': path,
+                   'CONTENT_LENGTH': str(len(content)),
+                   'wsgi.input': io.BytesIO(content),
+                   'HTTP_AUTHORIZATION': 'Bearer {}'.format(token)
+                   if token else 'Basic YTpi'}
+        setup_testing_defaults(environ)
+        statuses = []
+        body = emulator(environ, lambda status, headers:
+                        statuses.append(int(status.split()[0])))
+        return statuses[0], simplejson.loads(b''.join(body) or b'null')
+
+    status, token = call('POST', '/oauth/v2/token')
+    assert status == 200
+    sms = {'outboundSMSMessageRequest': {
+        'address': 'tel:+22376333005', 'senderAddress': 'tel:+22300000',
+        'outboundSMSTextMessage': {'message': "Hello"}}}
+    path = '/smsmessaging/v1/outbound/tel:+22300000/requests'
+    assert call('POST', path, sms)[0] == 401
+    assert call('POST', path, sms, token['access_token'])[0] == 201
+    # a single unit left
+    sms['outboundSMSMessageRequest']['outboundSMSTextMessage'] = {
+        'message': "a" * 161}
+    assert call('POST', path, sms, token['access_token'])[0] == 403
+
+
+def test_metrics_merge():
+    first, second = MetricsRegistry(buckets=(0.1, 1)), MetricsRegistry(
+        buckets=(0.1, 1))
+    first.inc('orangeapisms_api_requests_total', {'status': 201})
+    second.inc('orangeapisms_api_requests_total', {'status': '201'}, 2)
+    first.observe('orangeapisms_api_request_duration_seconds', 0.5)
+    second.observe('orangeapisms_api_request_duration_seconds', 2)
+    text = render(merge([first.dump(), second.dump()]))
+    assert 'orangeapisms_api_requests_total{status="201"} 3' in text
+    assert 'orangeapisms_api_request_duration_seconds_bucket{le="1"} 1' \
+        in text
+    assert 'orangeapisms_api_request_duration_seconds_count 2' in text
+
+
+def test_metrics_compact_exited(tmpdir):
+    exited = subprocess.Popen(['true'])
+    exited.wait()
+    exporter = FileExporter(MetricsRegistry(), folder=str(tmpdir))
+    for count in (1, 2):
+        # an exited process left its metrics
+        dead = FileExporter(MetricsRegistry(), folder=str(tmpdir))
+        dead.path = dead.path_for(exited.pid)
+        dead.registry.inc('orangeapisms_token_refreshes_total')
+        dead.export()
+        text = render(merge(exporter.collect()))
+        assert 'orangeapisms_token_refreshes_total {}'.format(count) in text
+    assert [path.strpath for path in tmpdir.listdir()
+            if path.ext == '.json'] == [exporter.retired_path]
+
+
+def test_metrics_access(client):
+    assert client.get('/metrics').status_code == 403
+    update_config({'metrics_token': 'secret'})
+    try:
+        response = client.get('/metrics', HTTP_AUTHORIZATION='Bearer secret')
+    finally:
+        update_config({'metrics_token': None})
+    assert response.status_code == 200
+
+
+def test_archive_roundtrip(tmpdir):
+    writer = ArchiveWriter(str(tmpdir))
+    messages = []
+    for day in (1, 1, 2):
+        msg = SMSMessage.build_mt('+22376333005', "Hello", '+22300000')
+        msg.created_on = datetime.datetime(2017, 1, day, 12, tzinfo=pytz.utc)
+        writer.write(msg)
+        messages.append(msg)
+    writer.close()
+    rows = list(read_archives(str(tmpdir)))
+    assert [row['uuid'] for row in rows] == [msg.suuid for msg in messages]
+    assert len(list(read_archives(str(tmpdir),
+                                  since=datetime.date(2017, 1, 2)))) == 1
+    restored = from_archive(rows[0])
+    assert restored.uuid == messages[0].uuid
+    assert restored.created_on == messages[0].created_on
+
+
+def test_export_filters():
+    assert parse_date('2017-05-01', 'since') == \
+        datetime.datetime(2017, 5, 1, tzinfo=pytz.utc)
+    # lazy: no query is run
+    filtered_messages({'status': SMSMessage.DELIVERED, 'since': '2017-05-01'})
+    for params in ({'status': 'lost'}, {'direction': 'sideways'},
+                   {'until': 'yesterday'}):
+        with pytest.raises(ValueError):
+            filtered_messages(params)
+
+
+def test_rollups():
+    msg = SMSMessage.build_mt('+22370000000', "hello", 'Shop')
+    msg.created_on = datetime.datetime(2017, 5, 1, 23, 30,
+                                       tzinfo=pytz.timezone('Etc/GMT+2'))
+    assert rollup_key(msg) == (datetime.date(2017, 5, 2), 'outgoing',
+                               'sms-mt', 'sent', 'Shop')
+
+    day = datetime.date(2017, 5, 2)
+    totals = summarize([
+        {'day': day, 'direction': 'outgoing', 'status': 'delivered',
+         'count': 3},
+        {'day': day, 'direction': 'outgoing', 'status': 'not_delivered',
+         'count': 1},
+        {'day': day, 'direction': 'incoming', 'status': 'received',
+         'count': 2},
+    ])
+    assert len(totals) == 1
+    assert totals[0]['outgoing'] == 4 and totals[0]['incoming'] == 2
+    assert totals[0]['delivery_rate'] == 0.75
+
+
+def test_search_query():
+    assert split_query('tel:+22370000000 promo 2017 "mai') == \
+        (['+22370000000'], ['promo', '2017', '"mai'])
+    assert SQLiteSearchBackend.match_query(['promo', '"mai']) == \
+        '"promo"* """mai"*'
+
+
+def stored_mt(index, status=SMSMessage.SENT, minutes_ago=0):
+    msg = SMSMessage.build_mt('+2237000{:04d}'.format(index), "hello",
+                              '+22300000', status)
+    msg.save(force_insert=True)
+    if minutes_ago:
+        # created_on is auto_now_add
+        msg.created_on -= datetime.timedelta(minutes=minutes_ago)
+        if msg.claimed_until:
+            msg.claimed_until -= datetime.timedelta(minutes=minutes_ago)
+        SMSMessage.bulk_update([msg], ['created_on', 'claimed_until'])
+    return msg
+
+
+@pytest.mark.django_db
+def test_bulk_update():
+    messages = [stored_mt(index) for index in range(3)]
+    for index, msg in enumerate(messages):
+        msg.status = SMSMessage.DELIVERED if index else SMSMessage.SENT
+        msg.reference_code = 'ref{}'.format(index)
+    assert SMSMessage.bulk_update(messages, ['status', 'reference_code'],
+                                  batch_size=2) == 3
+    assert dict(SMSMessage.objects.values_list('reference_code', 'status')) \
+        == {'ref0': 'sent', 'ref1': 'delivered', 'ref2': 'delivered'}
+
+
+@pytest.mark.django_db
+def test_send_bulk(monkeypatch):
+    def post_sms_mt_request(payload):
+        digit = payload['outboundSMSMessageRequest']['address'][-1]
+        # later recipients answered first
+        time.sleep(0.01 * (6 - int(digit)))
+        if digit == '2':
+            raise OrangeAPIError(503)
+        if digit == '4':
+            raise OrangeAPIError(400)
+        return 'ref-' + digit
+    monkeypatch.setattr(utils, 'post_sms_mt_request', post_sms_mt_request)
+    recipients = ['+2237000000{}'.format(digit) for digit in range(1, 6)]
+    results = utils.send_sms_bulk(recipients, "hello", '+22300000',
+                                  concurrency=3, batch_size=2)
+    assert [(success, msg.destination_address)
+            for success, msg in results] == [
+        (True, recipients[0]), (False, recipients[1]), (True, recipients[2]),
+        (False, recipients[3]), (True, recipients[4])]
+
+    rows = {row['destination_address']: row for row in SMSMessage.objects
+            .values('destination_address', *SMSMessage.ATTEMPT_FIELDS)}
+    for success, msg in results:
+        row = rows[msg.destination_address]
+        assert row == {field: getattr(msg, field) for field in row}
+        assert row['attempts'] == 1 and row['claimed_by'] is None
+        assert row['claimed_until'] is None
+    assert [rows[recipient]['status'] for recipient in recipients] == [
+        SMSMessage.SENT, SMSMessage.FAILED_TO_SEND, SMSMessage.SENT,
+        SMSMessage.FAILED_TO_SEND, SMSMessage.SENT]
+    assert rows[recipients[0]]['reference_code'] == 'ref-1'
+    assert rows[recipients[0]]['last_error'] is None
+    # retried by the outbox only if transient
+    assert 'HTTP503' in rows[recipients[1]]['last_error']
+    assert rows[recipients[1]]['next_attempt_on'] is not None
+    assert 'HTTP400' in rows[recipients[3]]['last_error']
+    assert rows[recipients[3]]['next_attempt_on'] is None
+
+
+@pytest.mark.django_db(transaction=True)
+def test_send_bulk_keeps_dr(monkeypatch):
+    def post_sms_mt_request(payload):
+        request = payload['outboundSMSMessageRequest']
+        # SMS-DR of the first one received before the API answered
+        if request['address'].endswith('1'):
+            SMSMessage.record_dr_from_payload({
+                'callbackData': request['callbackData'],
+                'deliveryInfo': {'deliveryStatus': 'DeliveredToTerminal'}})
+        return 'ref-' + request['address'][-1]
+    monkeypatch.setattr(utils, 'post_sms_mt_request', post_sms_mt_request)
+    results = utils.send_sms_bulk(['+22370000001', '+22370000002'], "hello",
+                                  '+22300000', concurrency=1)
+    assert [success for success, msg in results] == [True, True]
+    assert list(SMSMessage.objects.order_by('destination_address')
+                .values_list('reference_code', 'sms_type', 'status')) == [
+        ('ref-1', SMSMessage.DR, SMSMessage.DELIVERED),
+        ('ref-2', SMSMessage.MT, SMSMessage.SENT)]
+    assert dict(DailyRollup.objects.exclude(count=0)
+                .values_list('status', 'count')) == {'delivered': 1,
+                                                     'sent': 1}
+
+
+@pytest.mark.django_db
+def test_mo_dedup():
+    payload = {'senderAddress': 'tel:+22376333005',
+               'destinationAddress': '+22300000',
+               'messageId': uuid.uuid4().hex, 'message': "hello",
+               'dateTime': '2017-01-01T00:00:00.000Z'}
+    first, created = SMSMessage.get_or_create_mo_from_payload(payload)
+    assert created
+    again, created = SMSMessage.get_or_create_mo_from_payload(payload)
+    assert not created and again.uuid == first.uuid
+    assert SMSMessage.objects.count() == 1
+
+
+@pytest.mark.django_db
+def test_mo_handler_failure_is_retried(client, monkeypatch):
+    handled = []
+
+    def handle_smsmo(msg):
+        handled.append(msg.message_id)
+        if len(handled) == 1:
+            raise ValueError("handler failure")
+    monkeypatch.setattr(utils, 'get_handler', lambda slug: handle_smsmo)
+    body = simplejson.dumps({'inboundSMSMessageNotification': {
+        'inboundSMSMessage': {
+            'senderAddress': 'tel:+22376333005',
+            'destinationAddress': '+22300000',
+            'messageId': uuid.uuid4().hex, 'message': "hello",
+            'dateTime': '2017-01-01T00:00:00.000Z'}}})
+    statuses = [client.post('/smsmo', body, content_type='application/json')
+                .status_code for attempt in range(3)]
+    assert statuses == [500, 200, 200]
+    assert len(handled) == 2 and SMSMessage.objects.count() == 1
+
+
+@pytest.mark.django_db
+def test_notification_errors(client, monkeypatch):
+    def post(body):
+        return client.post('/smsmo', body, content_type='application/json')
+    assert post('not json').status_code == 400
+    assert post('{"inboundSMSMessageNotification": []}').status_code == 400
+
+    def get_or_create_mo_from_payload(payload):
+        raise OperationalError("database is locked")
+    monkeypatch.setattr(SMSMessage, 'get_or_create_mo_from_payload',
+                        get_or_create_mo_from_payload)
+    # not a payload error: the API retries it
+    response = post(simplejson.dumps({'inboundSMSMessageNotification': {
+        'inboundSMSMessage': {}}}))
+    assert response.status_code == 503 and response.has_header('Retry-After')
+
+
+@pytest.mark.django_db
+def test_handler_queue_full(client, monkeypatch):
+    dispatcher = HandlerDispatcher(mode='thread', workers=1, queue_size=1)
+    monkeypatch.setattr(workers, '_executors', {})
+    monkeypatch.setattr(views, 'get_dispatcher', lambda: dispatcher)
+    release = threading.Event()
+    handled = []
+
+    def handle_smsmo(msg):
+        release.wait(5)
+        handled.append(msg.message_id)
+    monkeypatch.setattr(utils, 'get_handler', lambda slug: handle_smsmo)
+
+    def post():
+        body = simplejson.dumps({'inboundSMSMessageNotification': {
+            'inboundSMSMessage': {
+                'senderAddress': 'tel:+22376333005',
+                'destinationAddress': '+22300000',
+                'messageId': uuid.uuid4().hex, 'message': "hello",
+                'dateTime': '2017-01-01T00:00:00.000Z'}}})
+        return client.post('/smsmo', body, content_type='application/json')
+    # one handler running, one waiting: handler_queue_size reached
+    assert [post().status_code for _ in range(2)] == [200, 200]
+    response = post()
+    assert response.status_code == 503
+    assert response['Retry-After'] == \
+        str(config.get_config('handler_retry_after'))
+    # rejected before recording: the API retries it
+    assert SMSMessage.objects.count() == 2
+
+    release.set()
+    # single worker: runs once queued handlers are done
+    dispatcher.executor.submit(lambda: None).result()
+    assert len(handled) == 2 and post().status_code == 200
+    dispatcher.executor.shutdown()
+
+
+@pytest.mark.django_db
+def test_rollups_stale_instance():
+    messages = [stored_mt(index) for index in range(3)]
+    stale = list(SMSMessage.objects.order_by('destination_address'))
+    messages[0].update_status(SMSMessage.DELIVERED)
+    # stale instances still think they're sent
+    for msg in stale:
+        msg.status = SMSMessage.NOT_DELIVERED
+    SMSMessage.bulk_update(stale, ['status'])
+    assert dict(DailyRollup.objects.exclude(count=0)
+                .values_list('status', 'count')) == {'not_delivered': 3}
+    # only rows still sent
+    messages[1].status = SMSMessage.DELIVERED
+    assert SMSMessage.save_states(messages[:2], [SMSMessage.SENT]) == 0
+    assert dict(DailyRollup.objects.exclude(count=0)
+                .values_list('status', 'count')) == {'not_delivered': 3}
+
+
+@pytest.mark.django_db(transaction=True)
+def test_search_backends():
+    messages = [stored_mt(index) for index in range(4)]
+    messages[2].content = "Promo de mai"
+    messages[2].save(update_fields=['content'])
+    # VACUUM may renumber rowids of the remaining messages
+    messages[0].delete()
+    with connection.cursor() as cursor:
+        cursor.execute("VACUUM")
+    for name in ('sqlite', 'like'):
+        update_config({'search_backend': name})
+        try:
+            assert type(get_search_backend()).__name__.lower() \
+                .startswith(name)
+            found = [msg.uuid for msg in search_messages('prom')]
+        finally:
+            update_config({'search_backend': 'auto'})
+        assert found == [messages[2].uuid]
+
+
+@pytest.mark.django_db
+def test_write_behind_dead_letter(tmpdir):
+    buffer_ = WriteBehindBuffer(folder=str(tmpdir), fsync=False, max_queue=2)
+    buffer_.journal = JournalSegment.create(str(tmpdir), fsync=False)
+    # content is mandatory: second one can't be stored
+    payloads = [{'senderAddress': 'tel:+22376333005',
+                 'destinationAddress': '+22300000',
+                 'messageId': str(index), 'message': content,
+                 'dateTime': '2017-01-01T00:00:00.000Z'}
+                for index, content in enumerate(["hello", None, "full"])]
+    buffer_.record_mo(payloads[0])
+    buffer_.record_mo(payloads[1])
+    with pytest.raises(BufferFull):
+        buffer_.record_mo(payloads[2])
+    assert buffer_.flush() == 2
+    assert list(SMSMessage.objects.values_list('message_id', flat=True)) \
+        == ['0']
+    lines = tmpdir.join(buffer_.dead_letter_name).readlines()
+    assert len(lines) == 1 and simplejson.loads(lines[0])[1]['payload'][
+        'messageId'] == '1'
+    assert buffer_.pending == [] and buffer_.sealed == []
+
+
+@pytest.mark.django_db
+def test_archive_messages(tmpdir):
+    old = [stored_mt(index, minutes_ago=3 * 24 * 60) for index in range(5)]
+    recent = stored_mt(5)
+    cutoff = datetime.datetime.now(pytz.utc) - datetime.timedelta(days=1)
+    assert archive_messages(cutoff, folder=str(tmpdir), chunk_size=2) == 5
+    assert list(SMSMessage.objects.values_list('uuid', flat=True)) \
+        == [recent.uuid]
+    # a corrupted file doesn't prevent reading others
+    folder = tmpdir.listdir()[0].listdir()[0]
+    folder.join('smsmessage-2000-01-01-x.jsonl.gz').write_binary(
+        b'\x1f\x8b\x08\x00garbage')
+    assert len(folder.listdir()) == 4
+    assert sorted(row['uuid'] for row in read_archives(str(tmpdir))) \
+        == sorted(msg.suuid for msg in old)
+
+
+@pytest.mark.django_db
+def test_outbox_claim():
+    pending = stored_mt(0, SMSMessage.PENDING, minutes_ago=60)
+    stored_mt(1, SMSMessage.PENDING)  # within grace: may still be sending
+    stored_mt(2, SMSMessage.SENT, minutes_ago=60)
+    assert [msg.uuid for msg in claim(10, worker_id='a')] == [pending.uuid]
+    assert claim(10, worker_id='b') == []
+
+
+@pytest.mark.django_db(transaction=True)
+def test_outbox_keeps_dr(monkeypatch):
+    stored_mt(0, SMSMessage.PENDING, minutes_ago=60)
+    failed = stored_mt(1, SMSMessage.FAILED_TO_SEND, minutes_ago=60)
+    failed.next_attempt_on = failed.created_on
+    SMSMessage.bulk_update([failed], ['next_attempt_on'])
+
+    def post_sms_mt_request(payload):
+        SMSMessage.record_dr_from_payload({
+            'callbackData': payload['outboundSMSMessageRequest'][
+                'callbackData'],
+            'deliveryInfo': {'deliveryStatus': 'DeliveryImpossible'}})
+        return 'ref'
+    monkeypatch.setattr(utils, 'post_sms_mt_request', post_sms_mt_request)
+    with ThreadPoolExecutor(max_workers=1) as executor:
+        assert len(drain_batch(executor, worker_id='worker')) == 2
+    assert set(SMSMessage.objects.values_list(
+        'reference_code', 'status', 'attempts')) == set([
+            ('ref', SMSMessage.NOT_DELIVERED, 1)])
+
+
+@pytest.mark.django_db
+def test_outbox_skips_inline_sends(monkeypatch):
+    claimed = []
+
+    def post_sms_mt_request(payload):
+        # an outbox worker running while the API call is in flight
+        claimed.extend(claim(10, worker_id='worker'))
+        return 'ref'
+    monkeypatch.setattr(utils, 'post_sms_mt_request', post_sms_mt_request)
+    update_config({'outbox_pending_grace': 0})
+    try:
+        success, msg = utils.send_sms('+22370000000', "hello", '+22300000')
+    finally:
+        update_config({'outbox_pending_grace': 120})
+    assert success and claimed == []
+    msg = SMSMessage.objects.get(uuid=msg.uuid)
+    assert msg.status == SMSMessage.SENT and msg.claimed_by is None
+
+
+@pytest.mark.django_db
+def test_send_keeps_dr(monkeypatch):
+    def post_sms_mt_request(payload):
+        # SMS-DR received before the API answered
+        SMSMessage.record_dr_from_payload({
+            'callbackData': payload['outboundSMSMessageRequest'][
+                'callbackData'],
+            'deliveryInfo': {'deliveryStatus': 'DeliveredToNetwork'}})
+        return 'ref'
+    monkeypatch.setattr(utils, 'post_sms_mt_request', post_sms_mt_request)
+    success, msg = utils.send_sms('+22370000000', "hello", '+22300000')
+    msg = SMSMessage.objects.get(uuid=msg.uuid)
+    assert success and (msg.reference_code, msg.attempts) == ('ref', 1)
+    assert (msg.sms_type, msg.status) == (SMSMessage.DR, SMSMessage.DELIVERED)
+
+
+@pytest.mark.django_db(transaction=True)
+def test_async_client(monkeypatch):
+    asyncio = pytest.importorskip('asyncio')
+    aiohttp = pytest.importorskip('aiohttp')
+    aio = pytest.importorskip('orangeapisms.aio')
+
+    class FakeResponse(object):
+        def __init__(self, status, body):
+            self.status, self.body, self.headers = status, body, {}
+
+        def text(self):
+            return asyncio.sleep(0, result=simplejson.dumps(self.body))
+
+        def __aenter__(self):
+            return asyncio.sleep(0, result=self)
+
+        def __aexit__(self, *exc_info):
+            return asyncio.sleep(0)
+
+    class FakeSession(object):
+        def __init__(self, *responses):
+            self.responses = list(responses)
+
+        def request(self, method, url, **kwargs):
+            response = self.responses.pop(0)
+            if isinstance(response, Exception):
+                raise response
+            return response
+
+        def close(self):
+            return asyncio.sleep(0)
+
+    monkeypatch.setattr('orangeapisms.aio.client.get_config_token',
+                        lambda: 'token')
+    saved = []
+    monkeypatch.setattr(utils, 'update_config',
+                        lambda extra, save: saved.append(extra))
+    monkeypatch.setattr(utils, 'api_cache', TTLCache())
+    utils.api_cache.set('balance:MLI', (10, None))
+    messages = [stored_mt(index, SMSMessage.PENDING) for index in range(2)]
+    api = aio.AsyncClient(session=FakeSession(
+        aiohttp.ClientConnectionError("reset"),
+        FakeResponse(201, {'outboundSMSMessageRequest': {
+            'resourceURL': '/outbound/tel:+22300000/requests/ref'}}),
+        FakeResponse(201, {'deliveryReceiptSubscription': {
+            'resourceURL': '/outbound/subscriptions/sub'}})))
+    run = asyncio.get_event_loop().run_until_complete
+    assert [run(api.submit_sms_mt_request(msg.to_mt(), msg,
+                                          silent_failure=True))
+            for msg in messages] == [False, True]
+    assert run(api.subscribe_sms_dr_endpoint('/smsdr'))
+    failed, sent = [SMSMessage.objects.get(uuid=msg.uuid) for msg in messages]
+    assert failed.status == SMSMessage.FAILED_TO_SEND and \
+        failed.attempts == 1 and failed.next_attempt_on is not None
+    assert sent.status == SMSMessage.SENT and sent.reference_code == 'ref'
+    assert utils.api_cache.get('balance:MLI') == (9, None)
+    assert saved == [{'smsmtdr_subsription_id': 'sub'}]
+
+
+@pytest.mark.django_db
+def test_export_lines():
+    for index in range(5):
+        stored_mt(index, minutes_ago=10 - index)
+    lines = list(export_lines(SMSMessage.objects.all(), 'csv', chunk_size=2))
+    assert len(lines) == 6 and lines[0].startswith('uuid,direction')
+    numbers = [line.split(',')[6] for line in lines[1:]]
+    assert numbers == ['+22370000{:03d}'.format(index) for index in range(5)]
+    lines = list(export_lines(SMSMessage.objects.filter(
+        destination_address='+22370000001'), 'jsonl'))
+    assert [simplejson.loads(line)['content'] for line in lines] == ["hello"]
+
+
+@pytest.mark.django_db
+def test_rollups_follow_changes():
+    messages = [stored_mt(index) for index in range(4)]
+    messages[0].update_status(SMSMessage.DELIVERED)
+    for msg in messages[1:]:
+        msg.status = SMSMessage.NOT_DELIVERED
+    SMSMessage.bulk_update(messages[1:], ['status'])
+
+    def counts():
+        return dict(DailyRollup.objects.exclude(count=0)
+                    .values_list('status', 'count'))
+    assert counts() == {'delivered': 1, 'not_delivered': 3}
+    DailyRollup.objects.update(count=0)
+    rebuild()
+    assert counts() == {'delivered': 1, 'not_delivered': 3}
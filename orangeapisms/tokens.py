@@ -0,0 +1,238 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# vim: ai ts=4 sts=4 et sw=4 nu
+
+''' OAuth token sharing between threads and processes '''
+
+from __future__ import (unicode_literals, absolute_import,
+                        division, print_function)
+
+import abc
+import os
+import time
+import logging
+import datetime
+import threading
+from contextlib import contextmanager
+
+from py3compat import with_metaclass
+
+from orangeapisms.config import (get_config, update_config, reload_config,
+                                 load_json, atomic_write_json, file_lock)
+
+logger = logging.getLogger(__name__)
+# remaining lifetime under which a token is not used anymore
+EXPIRY_MARGIN = datetime.timedelta(seconds=60)
+LOCK_TIMEOUT = 30
+
+
+def is_valid(token_data, margin=EXPIRY_MARGIN):
+    ''' whether token_data holds a token valid for at least margin '''
+    if not token_data or not token_data.get('token'):
+        return False
+    expiry = token_data.get('token_expiry')
+    return expiry is not None and expiry > datetime.datetime.now() + margin
+
+
+class TokenStore(with_metaclass(abc.ABCMeta, object)):
+    ''' where the current token is shared between processes '''
+
+    @abc.abstractmethod
+    def load(self):
+        ''' shared token_data (token, token_expiry) or None '''
+
+    @abc.abstractmethod
+    def save(self, token_data):
+        ''' share token_data '''
+
+    @contextmanager
+    def lock(self):
+        ''' cross-process lock held while refreshing '''
+        yield
+
+
+class ConfigTokenStore(TokenStore):
+    ''' token in orangeapi.json (through update_config) '''
+
+    def load(self):
+        # cheap when unchanged ; avoids using a token up to
+        # config_reload_interval old
+        reload_config()
+        return {'token': get_config('token'),
+                'token_expiry': get_config('token_expiry')}
+
+    def save(self, token_data):
+        update_config(token_data, save=True)
+
+
+class CacheTokenStore(TokenStore):
+    ''' token in a Django cache, lock through cache.add() '''
+
+    key = 'orangeapisms:token'
+
+    def __init__(self, alias='default'):
+        from django.core.cache import caches
+        self.cache = caches[alias]
+
+    def load(self):
+        return self.cache.get(self.key)
+
+    def save(self, token_data):
+        ttl = (token_data['token_expiry'] -
+               datetime.datetime.now()).total_seconds()
+        self.cache.set(self.key, token_data, max(int(ttl), 1))
+
+    @contextmanager
+    def lock(self):
+        lock_key = '{}:lock'.format(self.key)
+        deadline = time.time() + LOCK_TIMEOUT
+        acquired = self.cache.add(lock_key, os.getpid(), LOCK_TIMEOUT)
+        while not acquired and time.time() < deadline:
+            time.sleep(0.05)
+            acquired = self.cache.add(lock_key, os.getpid(), LOCK_TIMEOUT)
+        try:
+            yield
+        finally:
+            if acquired:
+                self.cache.delete(lock_key)
+
+
+class FileTokenStore(TokenStore):
+    ''' token in a JSON file replaced atomically, flock() on a lock file '''
+
+    def __init__(self, path):
+        self.path = path
+
+    def load(self):
+        try:
+            return load_json(self.path)
+        except (IOError, OSError, ValueError):
+            return None
+
+    def save(self, token_data):
+        atomic_write_json(self.path, token_data)
+
+    def lock(self):
+        return file_lock(self.path)
+
+
+class TokenManager(object):
+
+    def __init__(self, store, fetch, refresh_ahead=None,
+                 background_refresh=True):
+        self.store = store
+        self.fetch = fetch
+        self.refresh_ahead = datetime.timedelta(
+            seconds=refresh_ahead or EXPIRY_MARGIN.total_seconds())
+        self.background_refresh = background_refresh
+        self.token_data = None
+        self.lock = threading.Lock()
+        self.refresher = None
+
+    def cached_token(self):
+        ''' current token if valid, without any I/O ; None otherwise '''
+        token_data = self.token_data
+        if is_valid(token_data):
+            return token_data['token']
+        return None
+
+    def get_token(self):
+        token = self.cached_token()
+        if token is None:
+            token = self.get_token_data()['token']
+        self.start_refresher()
+        return token
+
+    def get_token_data(self, margin=EXPIRY_MARGIN):
+        ''' valid token_data, refreshing it only if no one else did '''
+        with self.lock:
+            if is_valid(self.token_data, margin):
+                return self.token_data
+            token_data = self.store.load()
+            if not is_valid(token_data, margin):
+                with self.store.lock():
+                    # another process might have refreshed meanwhile
+                    token_data = self.store.load()
+                    if not is_valid(token_data, margin):
+                        token_data = self.fetch()
+                        self.store.save(token_data)
+            self.use(token_data)
+            return token_data
+
+    def refresh(self):
+        ''' request a new token regardless of the current one '''
+        with self.lock:
+            with self.store.lock():
+                token_data = self.fetch()
+                self.store.save(token_data)
+            self.use(token_data)
+            return token_data
+
+    def set_token(self, token_data):
+        ''' share an externally retrieved token '''
+        with self.lock:
+            with self.store.lock():
+                self.store.save(token_data)
+            self.use(token_data)
+
+    def use(self, token_data):
+        self.token_data = token_data
+
+    def start_refresher(self):
+        if not self.background_refresh:
+            return
+        refresher = self.refresher
+        if refresher is not None and refresher.is_alive():
+            return
+        with self.lock:
+            if self.refresher is None or not self.refresher.is_alive():
+                self.refresher = threading.Thread(
+                    target=self.refresh_loop, name='orangeapisms-token')
+                self.refresher.daemon = True
+                self.refresher.start()
+
+    def refresh_loop(self):
+        while True:
+            try:
+                token_data = self.get_token_data(margin=self.refresh_ahead)
+                wait = (token_data['token_expiry'] - self.refresh_ahead -
+                        datetime.datetime.now()).total_seconds()
+            except Exception as exp:
+                logger.error("Unable to refresh token in background. {}"
+                             .format(exp))
+                wait = 30
+            # wake up regularly to pick up tokens refreshed by other workers
+            time.sleep(min(max(wait, 30), 300))
+
+
+def get_token_store():
+    store = get_config('token_store')
+    if store == 'cache':
+        return CacheTokenStore(get_config('token_cache_alias'))
+    if store == 'file':
+        from orangeapisms.config import get_settings_folder
+        return FileTokenStore(get_config('token_file') or os.path.join(
+            get_settings_folder(), 'orangeapi.token.json'))
+    return ConfigTokenStore()
+
+
+_lock = threading.Lock()
+_managers = {}
+
+
+def get_token_manager():
+    ''' process-wide TokenManager (one per pid so forks don't share it) '''
+    pid = os.getpid()
+    manager = _managers.get(pid)
+    if manager is not None:
+        return manager
+    with _lock:
+        if pid not in _managers:
+            from orangeapisms.utils import fetch_token
+            _managers.clear()
+            _managers[pid] = TokenManager(
+                store=get_token_store(),
+                fetch=fetch_token,
+                refresh_ahead=get_config('token_refresh_ahead'),
+                background_refresh=get_config('token_background_refresh'))
+    return _managers[pid]
@@ -20,6 +20,10 @@ urlpatterns = [
     url(r'^smsdr/?$', views.smsdr,
         name='oapisms_dr'),
 
+    # Prometheus scrape endpoint
+    url(r'^metrics/?$', views.scrape_metrics,
+        name='oapisms_metrics'),
+
     # in-browser tester
     url(r'^tester/smsmt/?$', views.form_view,
         {'form_name': 'smsmt', 'action_name': "Send SMS-MT"},
@@ -35,6 +39,12 @@ urlpatterns = [
         name='oapisms_tester_fsmsdr'),
     url(r'^tester/logs/?$', views.logs,
         name='oapisms_tester_logs'),
+    url(r'^tester/logs\.json$', views.logs_json,
+        name='oapisms_tester_logs_json'),
+    url(r'^tester/search\.json$', views.search_json,
+        name='oapisms_tester_search_json'),
+    url(r'^tester/logs/export/?$', views.export_logs,
+        name='oapisms_tester_logs_export'),
     url(r'^tester/balance/?$', views.check_balance,
         name='oapisms_tester_balance'),
     url(r'^tester/?$', views.tester,
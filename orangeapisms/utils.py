@@ -5,21 +5,28 @@
 from __future__ import (unicode_literals, absolute_import,
                         division, print_function)
 
+import time
 import datetime
 import logging
 import base64
 import re
 import json
+from concurrent.futures import ThreadPoolExecutor
 
-import requests
 import pytz
 from py3compat import PY2
+from requests import RequestException
 
-from orangeapisms import import_path, async_check
+from orangeapisms import import_path, async_check, chunked, client
 from orangeapisms.models import SMSMessage
-from orangeapisms.config import get_config, update_config
+from orangeapisms.config import get_config, update_config, ConfigState
 from orangeapisms.datetime import datetime_from_iso
-from orangeapisms.exceptions import OrangeAPIError
+from orangeapisms.exceptions import OrangeAPIError, InsufficientBalance
+from orangeapisms.ratelimit import get_rate_limiter, TOO_MANY_REQUESTS
+from orangeapisms.tokens import get_token_manager
+from orangeapisms.segments import count_segments, transliterate
+from orangeapisms.cache import TTLCache
+from orangeapisms import metrics
 
 if PY2:
     import urllib.quote_plus as quote
@@ -32,6 +39,8 @@ ONE_DAY = 86400
 SMS_SERVICE = 'SMS_OCB'
 API_TZ = pytz.timezone('Europe/Paris')
 UTC = pytz.utc
+# read-only admin API calls (contracts, SMS-DR subscription)
+api_cache = TTLCache()
 
 
 def b64encode(data):
@@ -47,43 +56,125 @@ def jsonloads(data):
     return json.loads(data)
 
 
+class MSISDNCleaner(object):
+    ''' cleaned_msisdn() for a given country prefix
+
+        calling it memoizes results (up to memo_size numbers) '''
+
+    NON_DIGITS = re.compile(r"\D")
+    DIGITS = re.compile(r"\d*\Z")
+
+    def __init__(self, prefix, fix=True, memo_size=10000, generation=None):
+        self.prefix = prefix
+        self.fix = fix
+        self.memo_size = memo_size
+        self.memo = {}
+        # config generation it was built for
+        self.generation = generation
+
+    def __call__(self, to_addr):
+        try:
+            return self.memo[to_addr]
+        except KeyError:
+            pass
+        msisdn = self.clean(to_addr)
+        if len(self.memo) >= self.memo_size:
+            self.memo.clear()
+        # cleaning is idempotent: remember cleaned number as well
+        self.memo[to_addr] = self.memo[msisdn] = msisdn
+        return msisdn
+
+    def clean(self, to_addr):
+        if not self.fix:
+            return to_addr
+
+        # harmonize intl. number format (00xxx) to +xxx
+        if to_addr.startswith('00'):
+            to_addr = '+' + to_addr[2:]
+
+        # if a suffix was supplied, fix chars only
+        if to_addr.startswith('+'):
+            if self.DIGITS.match(to_addr, 1):
+                return to_addr
+            return '+' + self.NON_DIGITS.sub('', to_addr)
+
+        # no prefix, make sure to remove default prefix if present
+        if not self.DIGITS.match(to_addr):
+            to_addr = self.NON_DIGITS.sub('', to_addr)
+        if to_addr.startswith(self.prefix):
+            to_addr = to_addr[len(self.prefix):]
+        return '+' + self.prefix + to_addr
+
+
+_cleaner = None
+
+
+def get_msisdn_cleaner():
+    ''' MSISDNCleaner for current config, rebuilt if config changed '''
+    global _cleaner
+    if _cleaner is None or _cleaner.generation != ConfigState.generation:
+        _cleaner = MSISDNCleaner(get_config('country_prefix'),
+                                 fix=get_config('fix_msisdn'),
+                                 memo_size=get_config('msisdn_memo_size'),
+                                 generation=ConfigState.generation)
+    return _cleaner
+
+
 def cleaned_msisdn(to_addr):
     """ fixes common mistakes to make to_addr a MSISDN
 
         - removes extra chars
         - starts with a +
         - adds prefix if it seems missing """
+    return get_msisdn_cleaner()(to_addr)
+
+
+def cleaned_msisdn_many(addresses):
+    """ cleaned_msisdn() of each of addresses (generator)
 
-    if not get_config('fix_msisdn'):
-        return to_addr
+        config is read once and results are not memoized """
+    clean = get_msisdn_cleaner().clean
+    for to_addr in addresses:
+        yield clean(to_addr)
 
-    # harmonize intl. number format (00xxx) to +xxx
-    to_addr = re.sub(r"^00", "+", to_addr)
 
-    # if a suffix was supplied, fix chars only
-    if to_addr.startswith('+'):
-        return "+{addr}".format(addr=re.sub(r"\D", "", to_addr))
+def sms_content(message):
+    ''' message as it will be sent (transliterated if gsm7_transliterate) '''
+    if get_config('gsm7_transliterate'):
+        return transliterate(message)
+    return message
 
-    # no prefix, make sure to remove default prefix if present and fix chars
-    prefix = get_config('country_prefix')
-    to_addr = re.sub(r"\D", "", to_addr)
-    if to_addr.startswith(prefix):
-        to_addr = re.sub(r"^{prefix}".format(prefix=prefix), "", to_addr)
-    return "+{prefix}{addr}".format(prefix=prefix, addr=to_addr)
+
+def sms_segments(message):
+    ''' Segments (encoding, length, count, remaining) message will use '''
+    return count_segments(sms_content(message))
+
+
+def sms_units(message):
+    ''' units of balance and rate limits used by sending message '''
+    if get_config('count_segments'):
+        return max(count_segments(message).count, 1)
+    return 1
 
 
 def send_sms(to_addr, message,
              as_addr=get_config('default_sender_name'),
              db_save=get_config('use_db')):
-    ''' SMS-MT shortcut function '''
+    ''' SMS-MT shortcut function
+
+        With send_async, success is the celery AsyncResult or the
+        concurrent.futures.Future of the submission.
+        raises InsufficientBalance (if check_sms_balance) '''
     to_addr = cleaned_msisdn(to_addr)
+    message = sms_content(message)
+    check_sms_balance(sms_units(message))
     if not db_save:
         return submit_sms_mt(to_addr, message, as_addr)
     msg = SMSMessage.create_mt(to_addr, message,
                                as_addr, SMSMessage.PENDING)
+    # status and reference are saved by the submission itself ; saving msg
+    # here would overwrite them when sending asynchronously.
     success = submit_sms_mt_request(msg.to_mt(), msg)
-    msg.sending_status = msg.SENT if success else msg.FAILED_TO_SEND
-    msg.save()
     return success, msg
 
 
@@ -97,52 +188,135 @@ def do_submit_sms_mt_request(payload, message=None, silent_failure=False):
     ''' Use submit_sms_mt_request
 
     actual submission of API request for SMS-MT '''
-    def update_status(msg, success):
-        if msg is None:
-            return
-        msg.update_status(msg.SENT if success else msg.FAILED_TO_SEND)
-        return success
-
-    sender_address = payload['outboundSMSMessageRequest']['senderAddress']
-    url = "{api}/outbound/{addr}/requests".format(
-        api=get_config('smsmt_url'),
-        addr=quote(sender_address))
-    headers = get_standard_header()
-
-    req = requests.post(url, headers=headers, json=payload)
-
     try:
-        assert req.status_code == 201
-        resp = req.json()
-    except AssertionError:
-        exp = OrangeAPIError.from_request(req)
+        rurl = post_sms_mt_request(payload)
+    except (OrangeAPIError, RequestException) as exp:
         logger.error("Unable to transmit SMS-MT. {exp}".format(exp=exp))
         logger.exception(exp)
-        update_status(message, False)
+        record_submission(message, error=exp)
         if not silent_failure:
             raise exp
         return False
 
-    rurl = resp['outboundSMSMessageRequest'] \
-        .get('resourceURL', '').rsplit('/', 1)[-1]
-    if message is not None and rurl:
-        message.update_reference(rurl)
-        return update_status(message, True)
-    return bool(rurl)
+    return record_submission(message, reference=rurl)
+
+
+def record_submission(message=None, reference=None, error=None):
+    ''' save the outcome of submitting message (if any) to the API
+
+        retryable failures will be resent by the outbox.
+        returns whether it was accepted '''
+    if message is not None and (reference or error is not None):
+        message.update_attempt(reference=reference, error=error)
+    return error is None and bool(reference)
+
+
+def post_sms_mt_request(payload):
+    ''' POST an SMS-MT payload to the API and return its reference code
+
+        raises OrangeAPIError if the API refused it '''
+    request = payload['outboundSMSMessageRequest']
+    sender_address = request['senderAddress']
+    units = sms_units(request['outboundSMSTextMessage']['message'])
+    limiter = get_rate_limiter()
+    retries = get_config('throttle_retries')
+
+    for attempt in range(retries + 1):
+        headers = get_standard_header()
+        with limiter.limit(sender_address, cost=units) as slot:
+            req = client.post(sms_mt_url(sender_address), headers=headers,
+                              json=payload)
+            slot.observe(req)
+        # throttled requests are retried once paused buckets let us
+        if req.status_code != TOO_MANY_REQUESTS:
+            break
+        if attempt < retries and slot.backoff:
+            time.sleep(slot.backoff)
+
+    return sms_mt_reference(req, units)
+
+
+def sms_mt_reference(req, units):
+    ''' reference code of an SMS-MT request from the API response
+
+        raises OrangeAPIError if the API refused it. units are
+        deducted from the SMS balance estimate otherwise '''
+    if req.status_code != 201:
+        raise OrangeAPIError.from_request(req)
+
+    consume_sms_balance(units)
+    return reference_from_url(
+        req.json()['outboundSMSMessageRequest'].get('resourceURL'))
+
+
+def submit_message(msg):
+    ''' submit msg, recording the attempt on it (no DB access)
+
+        returns whether it was accepted by the API '''
+    try:
+        msg.record_attempt(reference=post_sms_mt_request(msg.to_mt()))
+    except Exception as exp:
+        logger.error("Unable to transmit SMS-MT #{uuid} to {addr}. {exp}"
+                     .format(uuid=msg.suuid, addr=msg.destination_address,
+                             exp=exp))
+        msg.record_attempt(error=exp)
+    return msg.status == msg.SENT
+
+
+def send_sms_bulk(recipients, message,
+                  as_addr=get_config('default_sender_name'),
+                  db_save=get_config('use_db'),
+                  concurrency=None, batch_size=None):
+    ''' SMS-MT shortcut function for many recipients
+
+        Recipients are processed in batches: SMSMessage rows of a batch are
+        inserted in a single query, submitted concurrently to the API then
+        updated (reference and status) in a single query. Status of those
+        which got their SMS-DR meanwhile is left alone.
+
+        returns a list of (success, msg) in recipients order '''
+    concurrency = concurrency or get_config('bulk_concurrency')
+    batch_size = batch_size or get_config('bulk_batch_size')
+    message = sms_content(message)
+
+    results = []
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        for batch in chunked(recipients, batch_size):
+            messages = [
+                SMSMessage.build_mt(to_addr, message,
+                                    as_addr, SMSMessage.PENDING)
+                for to_addr in cleaned_msisdn_many(batch)]
+            if db_save:
+                SMSMessage.objects.bulk_create(messages)
+            try:
+                check_sms_balance(sms_units(message) * len(messages))
+            except InsufficientBalance as exp:
+                logger.error("Unable to transmit SMS-MT. {}".format(exp))
+                for msg in messages:
+                    msg.record_attempt(error=exp)
+                successes = [False] * len(messages)
+            else:
+                successes = list(executor.map(submit_message, messages))
+            if db_save:
+                SMSMessage.save_attempts(messages)
+            results.extend(zip(successes, messages))
+    return results
 
 
 def submit_sms_mt(address, message,
                   sender_name=get_config('default_sender_name'),
                   callback_data=None):
     return submit_sms_mt_request(
-        mt_payload(dest_addr=cleaned_msisdn(address),
-                   message=message,
+        mt_payload(dest_addr=address,
+                   message=sms_content(message),
                    sender_address=get_config('sender_address'),
-                   sender_name=sender_name))
+                   sender_name=sender_name,
+                   callback_data=callback_data))
 
 
-def mt_payload(dest_addr, message, sender_address, sender_name):
-    return {
+def mt_payload(dest_addr, message, sender_address, sender_name,
+               callback_data=None):
+    payload = {
         "outboundSMSMessageRequest": {
             "address": "tel:{dest_addr}".format(
                 dest_addr=cleaned_msisdn(dest_addr)),
@@ -153,6 +327,10 @@ def mt_payload(dest_addr, message, sender_address, sender_name):
             "senderName": sender_name
         }
     }
+    if callback_data is not None:
+        # sent back in SMS-DR to find the SMS-MT by primary key
+        payload["outboundSMSMessageRequest"]["callbackData"] = callback_data
+    return payload
 
 
 def get_handler(slug):
@@ -164,43 +342,89 @@ def get_handler(slug):
     return import_path('handle_{}'.format(slug), module=mod, fallback=stub)
 
 
+def get_config_token():
+    ''' current token or None if missing or about to expire '''
+    return get_token_manager().cached_token()
+
+
 def get_token():
-    token_expiry = get_config('token_expiry')
-    if token_expiry is None or token_expiry < datetime.datetime.now() \
-            + datetime.timedelta(days=0, seconds=60):
-        assert request_token()
-    return get_config('token')
+    return get_token_manager().get_token()
 
 
 def get_standard_header():
+    return bearer_header(get_token())
+
+
+def bearer_header(token):
     return {
-        'Authorization': 'Bearer {token}'.format(token=get_token()),
+        'Authorization': 'Bearer {token}'.format(token=token),
         'Content-type': 'application/json;charset=UTF-8'
     }
 
 
-def request_token(silent_failure=False):
-    url = "{oauth_url}/token".format(oauth_url=get_config('oauth_url'))
+def reference_from_url(resource_url):
+    ''' API reference (last part) from a resourceURL '''
+    return (resource_url or '').rsplit('/', 1)[-1]
+
+
+def sms_mt_url(sender_address):
+    return "{api}/outbound/{addr}/requests".format(
+        api=get_config('smsmt_url'),
+        addr=quote(sender_address))
+
+
+def token_url():
+    return "{oauth_url}/token".format(oauth_url=get_config('oauth_url'))
+
+
+def token_headers():
     basic_header = b64encode(
         "{client_id}:{client_secret}".format(
             client_id=get_config('client_id'),
             client_secret=get_config('client_secret')))
-    headers = {'Authorization': "Basic {b64}".format(b64=basic_header)}
+    return {'Authorization': "Basic {b64}".format(b64=basic_header)}
+
+
+def token_data_from_response(resp):
+    ''' token config data from OAuth response or None if unsuccessful '''
+    if "token_type" not in resp:
+        return None
+    expire_in = int(resp['expires_in'])
+    return {
+        'token': resp['access_token'],
+        'token_expiry': datetime.datetime.now() + datetime.timedelta(
+            days=expire_in / ONE_DAY,
+            seconds=expire_in % ONE_DAY) - datetime.timedelta(
+            days=0, seconds=60)}
+
+
+def fetch_token():
+    ''' request a new token from the API, raising OrangeAPIError '''
     payload = {'grant_type': 'client_credentials'}
-    req = requests.post(url, headers=headers, data=payload)
-    resp = req.json()
-    if "token_type" in resp:
-        expire_in = int(resp['expires_in'])
-        token_data = {
-            'token': resp['access_token'],
-            'token_expiry': datetime.datetime.now() + datetime.timedelta(
-                days=expire_in / ONE_DAY,
-                seconds=expire_in % ONE_DAY) - datetime.timedelta(
-                days=0, seconds=60)}
-        update_config(token_data, save=True)
-        return token_data
-    else:
-        exp = OrangeAPIError.from_request(req)
+    started = time.time()
+    token_data = None
+    try:
+        req = client.post(token_url(), headers=token_headers(), data=payload)
+        try:
+            token_data = token_data_from_response(req.json())
+        except ValueError:
+            pass
+    finally:
+        metrics.inc('orangeapisms_token_refreshes_total',
+                    {'result': 'failure' if token_data is None
+                     else 'success'})
+        metrics.observe('orangeapisms_token_refresh_duration_seconds',
+                        time.time() - started)
+    if token_data is None:
+        raise OrangeAPIError.from_request(req)
+    return token_data
+
+
+def request_token(silent_failure=False):
+    ''' request a new token and share it with other workers '''
+    try:
+        return get_token_manager().refresh()
+    except OrangeAPIError as exp:
         logger.error("Unable to retrieve token. {}".format(exp))
         logger.exception(exp)
         if not silent_failure:
@@ -208,24 +432,75 @@ def request_token(silent_failure=False):
         return False
 
 
-def get_contracts(silent_failure=False):
-    url = "{api}/contracts".format(api=get_config('smsadmin_url'))
+def contracts_url():
+    return "{api}/contracts".format(api=get_config('smsadmin_url'))
+
+
+def get_contracts(silent_failure=False, use_cache=True):
+    ''' contracts from the API, cached for contracts_cache_ttl seconds '''
+    if use_cache:
+        contracts = api_cache.get('contracts')
+        if contracts is not None:
+            return contracts
+
     headers = get_standard_header()
 
-    req = requests.get(url, headers=headers)
+    req = client.get(contracts_url(), headers=headers)
     try:
         assert req.status_code == 200
-        return req.json()
+        contracts = req.json()
     except AssertionError:
         exp = OrangeAPIError.from_request(req)
         logger.error("Unable to retrieve contracts. {exp}".format(exp=exp))
         logger.exception(exp)
         if not silent_failure:
             raise exp
+        return
+
+    api_cache.set('contracts', contracts, get_config('contracts_cache_ttl'))
+    return contracts
+
+
+def get_sms_balance(country=get_config('country'), use_cache=True):
+    ''' (balance, expiry) of SMS units for country
+
+        balance is an estimate decremented on each SMS-MT sent since
+        contracts were retrieved (at most contracts_cache_ttl ago) '''
+    key = 'balance:{}'.format(country)
+    if use_cache:
+        balance = api_cache.get(key)
+        if balance is not None:
+            return balance
+    # fresh contracts: cached ones don't account for SMS-MT sent since
+    balance = sms_balance_from_contracts(
+        get_contracts(use_cache=False), country)
+    api_cache.set(key, balance, get_config('contracts_cache_ttl'))
+    return balance
+
 
+def consume_sms_balance(units, country=None):
+    ''' decrement balance estimate of units (no API call) '''
+    api_cache.update('balance:{}'.format(country or get_config('country')),
+                     lambda balance: (balance[0] - units, balance[1]))
 
-def get_sms_balance(country=get_config('country')):
-    contracts = get_contracts()
+
+def check_sms_balance(units):
+    ''' raises InsufficientBalance if check_sms_balance is set and
+        remaining SMS balance doesn't allow sending units '''
+    if get_config('check_sms_balance') and not has_sms_balance(units):
+        raise InsufficientBalance(units)
+
+
+def has_sms_balance(units=1, country=None):
+    ''' whether remaining SMS balance allows sending units (see sms_units) '''
+    balance, expiry = get_sms_balance(country or get_config('country'))
+    if expiry is None or expiry <= datetime.datetime.now(UTC):
+        return False
+    return balance >= units
+
+
+def sms_balance_from_contracts(contracts, country):
+    ''' (balance, expiry) of SMS service for country from contracts '''
     expiry = None
     balance = 0
     for contract in contracts.get('partnerContracts', {}).get('contracts', []):
@@ -248,49 +523,83 @@ def get_sms_balance(country=get_config('country')):
     return balance, expiry
 
 
-def get_sms_dr_subscriptions(silent_failure=False):
+def dr_subscription_url(subscription_id):
+    return "{api}/outbound/subscriptions/{subscription}".format(
+        api=get_config('smsmt_url'),
+        subscription=subscription_id)
+
+
+def dr_subscriptions_url(sender_address, subscription_id=None):
+    url = "{api}/outbound/{addr}/subscriptions".format(
+        api=get_config('smsmt_url'),
+        addr=quote(sender_address))
+    if subscription_id is not None:
+        url = "{url}/{sub}".format(url=url, sub=subscription_id)
+    return url
+
+
+def dr_subscription_payload(endpoint_url):
+    return {
+        'deliveryReceiptSubscription': {
+            'callbackReference': {
+                'notifyURL': endpoint_url
+            }
+        }
+    }
+
+
+def get_sms_dr_subscriptions(silent_failure=False, use_cache=True):
+    ''' current SMS-DR subscription, cached for
+        dr_subscription_cache_ttl seconds '''
     subscription_id = get_config('smsmtdr_subsription_id')
     if not subscription_id:
         return {}
-    url = "{api}/outbound/subscriptions/{subscription}".format(
-        api=get_config('smsmt_url'),
-        subscription=subscription_id)
+    key = 'dr_subscription:{}'.format(subscription_id)
+    if use_cache:
+        subscription = api_cache.get(key)
+        if subscription is not None:
+            return subscription
+
     headers = get_standard_header()
 
-    req = requests.get(url, headers=headers)
+    req = client.get(dr_subscription_url(subscription_id), headers=headers)
     try:
         assert req.status_code == 200
-        return req.json()
+        subscription = req.json()
     except AssertionError:
         exp = OrangeAPIError.from_request(req)
         logger.error("Unable to retrieve contracts. {exp}".format(exp=exp))
         logger.exception(exp)
         if not silent_failure:
             raise exp
+        return
+
+    api_cache.set(key, subscription, get_config('dr_subscription_cache_ttl'))
+    return subscription
+
+
+def invalidate_dr_subscription(subscription_id=None):
+    api_cache.delete('dr_subscription:{}'.format(
+        subscription_id or get_config('smsmtdr_subsription_id')))
 
 
 def get_sms_dr_endpoint(silent_failure=False):
     subscriptions = get_sms_dr_subscriptions(silent_failure)
-    return subscriptions.get('deliveryReceiptSubscription', {}) \
+    return dr_endpoint_from_subscriptions(subscriptions)
+
+
+def dr_endpoint_from_subscriptions(subscriptions):
+    return (subscriptions or {}).get('deliveryReceiptSubscription', {}) \
         .get('callbackReference', {}) \
         .get('notifyURL', None)
 
 
 def subscribe_sms_dr_endpoint(endpoint_url, silent_failure=False):
-    sender_address = get_config('sender_address')
-    payload = {
-        'deliveryReceiptSubscription': {
-            'callbackReference': {
-                'notifyURL': endpoint_url
-            }
-        }
-    }
-    url = "{api}/outbound/{addr}/subscriptions".format(
-        api=get_config('smsmt_url'),
-        addr=quote(sender_address))
+    url = dr_subscriptions_url(get_config('sender_address'))
     headers = get_standard_header()
 
-    req = requests.post(url, headers=headers, json=payload)
+    req = client.post(url, headers=headers,
+                      json=dr_subscription_payload(endpoint_url))
 
     try:
         assert req.status_code == 201
@@ -304,27 +613,35 @@ def subscribe_sms_dr_endpoint(endpoint_url, silent_failure=False):
             raise exp
         return False
 
-    subscription_id = resp['deliveryReceiptSubscription'] \
-        .get('resourceURL', '').rsplit('/', 1)[-1]
+    subscription_id = reference_from_url(
+        resp['deliveryReceiptSubscription'].get('resourceURL'))
+    dr_subscribed(subscription_id)
+    return bool(subscription_id)
+
 
+def dr_subscribed(subscription_id):
+    ''' save the SMS-DR subscription just made (if we got its id) '''
+    invalidate_dr_subscription()
     if subscription_id:
+        invalidate_dr_subscription(subscription_id)
         update_config({'smsmtdr_subsription_id': subscription_id}, save=True)
-    return bool(subscription_id)
+
+
+def dr_unsubscribed(subscription_id):
+    ''' forget the SMS-DR subscription just deleted '''
+    invalidate_dr_subscription(subscription_id)
+    update_config({'smsmtdr_subsription_id': None}, save=True)
 
 
 def unsubscribe_sms_dr_endpoint(subscription_id, silent_failure=False):
-    sender_address = get_config('sender_address')
-    url = "{api}/outbound/{addr}/subscriptions/{sub}".format(
-        api=get_config('smsmt_url'),
-        addr=quote(sender_address),
-        sub=subscription_id)
+    url = dr_subscriptions_url(get_config('sender_address'), subscription_id)
     headers = get_standard_header()
 
-    req = requests.delete(url, headers=headers)
+    req = client.delete(url, headers=headers)
 
     try:
         assert req.status_code == 204
-        update_config({'smsmtdr_subsription_id': None}, save=True)
+        dr_unsubscribed(subscription_id)
     except AssertionError:
         exp = OrangeAPIError.from_request(req)
         logger.error("Unable to unsubscribe an SMS-DR endpoint. {exp}"
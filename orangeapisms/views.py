@@ -4,17 +4,20 @@
 
 from __future__ import (unicode_literals, absolute_import,
                         division, print_function)
+import time
 import logging
 
 from django.utils import timezone
-from django.http import JsonResponse
+from django.db import DatabaseError
+from django.http import (JsonResponse, HttpResponse, HttpResponseBadRequest,
+                         Http404)
 from django.shortcuts import render, redirect
 from django.core.exceptions import PermissionDenied
+from django.utils.crypto import constant_time_compare
 from django.views.decorators.csrf import csrf_exempt
 from django.views.decorators.http import require_POST
 from django import forms
 from django.contrib import messages
-from django.core.paginator import Paginator, EmptyPage, PageNotAnInteger
 
 from orangeapisms.models import SMSMessage
 from orangeapisms.utils import (get_handler, send_sms,
@@ -23,12 +26,21 @@ from orangeapisms.utils import (get_handler, send_sms,
                                 subscribe_sms_dr_endpoint, jsonloads,
                                 unsubscribe_sms_dr_endpoint)
 from orangeapisms.datetime import datetime_to_iso
+from orangeapisms.pagination import keyset_page
+from orangeapisms.dispatch import get_dispatcher
+from orangeapisms.buffer import get_write_buffer, BufferFull
 from orangeapisms.config import get_config
+from orangeapisms.export import filtered_messages, export_response
+from orangeapisms.rollups import recent_totals
+from orangeapisms.search import search_messages
+from orangeapisms import metrics
 
 logger = logging.getLogger(__name__)
 handle_smsmo = get_handler('smsmo')
 handle_smsmt = get_handler('smsmt')
 handle_smsdr = get_handler('smsdr')
+# raised recording a malformed notification
+PAYLOAD_ERRORS = (ValueError, KeyError, TypeError, AttributeError)
 
 
 def activated(aview):
@@ -130,7 +142,10 @@ def home(request):
              ('oapisms_register_smsdr_endpoint', "register")),
             ("Registered SMS-DR", smsmt_dr_endpoint,
              ('oapisms_unregister_smsdr_endpoint', "unregister"))
-        ]
+        ],
+        'handler_stats': sorted(get_dispatcher().snapshot().items()),
+        'traffic': recent_totals() if get_config('use_db') and
+        get_config('rollups_enabled') else [],
     })
 
     return render(request, 'orangeapisms/home.html', context)
@@ -292,89 +307,218 @@ def form_view(request, form_name, action_name="Submit"):
     return render(request, 'orangeapisms/tester_form.html', context)
 
 
+def logs_page(request, queryset=None):
+    per_page = max(1, min(int(request.GET.get('per_page') or 25), 500))
+    return keyset_page(queryset if queryset is not None
+                       else SMSMessage.objects.all(),
+                       after=request.GET.get('after'),
+                       before=request.GET.get('before'),
+                       per_page=per_page)
+
+
 @activated
 def logs(request):
 
     context = {'page': 'logs'}
 
-    messages_list = SMSMessage.objects.all().order_by('-created_on')
-    paginator = Paginator(messages_list, 25)
-    page = request.GET.get('page')
-
     try:
-        messages_log = paginator.page(page)
-    except PageNotAnInteger:
-        # If page is not an integer, deliver first page.
-        messages_log = paginator.page(1)
-    except EmptyPage:
-        # If page is out of range (e.g. 9999), deliver last page of results.
-        messages_log = paginator.page(paginator.num_pages)
+        messages_log = logs_page(request)
+    except ValueError as exp:
+        return HttpResponseBadRequest("{}".format(exp))
 
-    context.update({'messages_log': messages_log,
-                    'paginator': paginator})
+    context.update({'messages_log': messages_log})
 
     return render(request, 'orangeapisms/tester_logs.html', context)
 
 
-@csrf_exempt
-@require_POST
-def smsmo(request, **options):
+@activated
+def logs_json(request):
+    try:
+        messages_log = logs_page(request)
+    except ValueError as exp:
+        return JsonResponse({'status': 'error', 'reason': "{}".format(exp)},
+                            status=400)
+
+    return JsonResponse({
+        'messages': [msg.to_dict() for msg in messages_log],
+        'next': messages_log.next_cursor,
+        'previous': messages_log.previous_cursor,
+    })
+
 
-    def failure(code, text, msg=None):
-        payload = {
-            'status': 'error',
-            'reason': text
-        }
-        if msg is not None:
-            payload.update({'message_id': msg.suuid})
-        return JsonResponse(payload, status=code)
+@activated
+def search_json(request):
+    ''' messages matching `q` (numbers and words), paginated as logs_json
 
+        accepts the filters of export_logs '''
+    query = request.GET.get('q', '').strip()
     try:
-        payload = jsonloads(request.body)[
-            'inboundSMSMessageNotification']['inboundSMSMessage']
+        if not query:
+            raise ValueError("Missing search query `q`")
+        messages_log = logs_page(request, search_messages(
+            query, filtered_messages(request.GET)))
+    except ValueError as exp:
+        return JsonResponse({'status': 'error', 'reason': "{}".format(exp)},
+                            status=400)
+
+    return JsonResponse({
+        'messages': [msg.to_dict() for msg in messages_log],
+        'next': messages_log.next_cursor,
+        'previous': messages_log.previous_cursor,
+    })
+
 
-        msg = SMSMessage.create_mo_from_payload(payload)
-    except:
-        return failure(400, "Incorrect JSON payload")
+@activated
+def export_logs(request):
+    ''' messages matching GET filters, as a streamed CSV or JSONL file '''
+    try:
+        return export_response(filtered_messages(request.GET),
+                               fmt=request.GET.get('format') or 'csv')
+    except ValueError as exp:
+        return HttpResponseBadRequest("{}".format(exp))
+
+
+def can_scrape(request):
+    ''' staff users or `Authorization: Bearer <metrics_token>` '''
+    user = getattr(request, 'user', None)
+    if user is not None and user.is_active and user.is_staff:
+        return True
+    token = get_config('metrics_token')
+    auth = request.META.get('HTTP_AUTHORIZATION', '')
+    return bool(token) and auth.startswith('Bearer ') and \
+        constant_time_compare(auth[7:], token)
+
+
+def scrape_metrics(request):
+    ''' metrics in Prometheus text format '''
+    if not get_config('metrics_enabled'):
+        raise Http404
+    if not can_scrape(request):
+        raise PermissionDenied
+    return HttpResponse(metrics.render_metrics(),
+                        content_type='text/plain; version=0.0.4; '
+                                     'charset=utf-8')
+
+
+def webhook_failure(code, text, msg=None):
+    payload = {
+        'status': 'error',
+        'reason': text
+    }
+    if msg is not None:
+        payload.update({'message_id': msg.suuid})
+    return JsonResponse(payload, status=code)
+
+
+def too_busy(text="Too busy. Retry later"):
+    response = webhook_failure(503, text)
+    response['Retry-After'] = get_config('handler_retry_after')
+    return response
+
+
+def process_notification(request, slug, label, record):
+    ''' handle_notification() accounted in webhook metrics '''
+    started = time.time()
+    response = handle_notification(request, slug, label, record)
+    metrics.inc('orangeapisms_webhook_requests_total',
+                {'webhook': slug, 'status': response.status_code})
+    metrics.observe('orangeapisms_webhook_duration_seconds',
+                    time.time() - started, {'webhook': slug, 'phase': 'total'})
+    return response
+
+
+def handle_notification(request, slug, label, record):
+    ''' record (store) the notified message then run its handler
+
+        record returns (msg, created). Duplicates are acknowledged with the
+        original message_id, without running the handler again. An SMS-MO
+        whose inline handler failed is forgotten so the API retry runs it.
+        msg is None if recording is deferred (along with the handler)
+        handler runs inline or is deferred depending on handler_dispatch.
+        Only malformed payloads get a 400: the API doesn't retry those '''
+    dispatcher = get_dispatcher()
+    if not dispatcher.reserve():
+        logger.warning("Handlers pool saturated. Rejecting {}".format(slug))
+        return too_busy()
 
     try:
-        handle_smsmo(msg)
+        with metrics.timed('orangeapisms_webhook_duration_seconds',
+                           {'webhook': slug, 'phase': 'parse'}):
+            payload = jsonloads(request.body)
+        with metrics.timed('orangeapisms_webhook_duration_seconds',
+                           {'webhook': slug, 'phase': 'db'}):
+            msg, created = record(payload)
+    except BufferFull as exp:
+        dispatcher.cancel()
+        logger.warning("{}. Rejecting {}".format(exp, slug))
+        return too_busy()
+    except PAYLOAD_ERRORS as exp:
+        dispatcher.cancel()
+        logger.warning("Incorrect {} payload. {!r}".format(label, exp))
+        return webhook_failure(400, "Incorrect JSON payload")
+    except DatabaseError as exp:
+        dispatcher.cancel()
+        logger.error("Unable to record {}".format(label))
+        logger.exception(exp)
+        return too_busy("Unable to record {}. Retry later".format(label))
+    except Exception as exp:
+        dispatcher.cancel()
+        error_text = "Exception recording {}".format(label)
+        logger.error(error_text)
+        logger.exception(exp)
+        return webhook_failure(500, error_text)
+
+    if msg is None:
+        dispatcher.cancel()
+        return JsonResponse({'status': 'success', 'message_id': None},
+                            status=200)
+
+    if not created:
+        dispatcher.cancel()
+        msg.mark_seen()
+        logger.info("Duplicate {} #{}".format(label, msg.suuid))
+        return JsonResponse({'status': 'success', 'duplicate': True,
+                             'message_id': msg.suuid}, status=200)
+
+    try:
+        dispatcher.dispatch(slug, msg)
     except Exception as e:
-        error_text = "Exception in SMS-MO processing #{}".format(msg.suuid)
+        error_text = "Exception in {} processing #{}".format(label,
+                                                             msg.suuid)
         logger.error(error_text)
         logger.exception(e)
-        return failure(500, error_text, msg)
+        response = webhook_failure(500, error_text, msg)
+        if msg.sms_type == msg.MO:
+            msg.forget_mo()
+        return response
 
+    msg.mark_seen()
     return JsonResponse({'status': 'success',
                          'message_id': msg.suuid}, status=200)
 
 
-@csrf_exempt
-@require_POST
-def smsdr(request, **options):
+def record_smsmo(payload):
+    payload = payload['inboundSMSMessageNotification']['inboundSMSMessage']
+    if get_config('write_behind'):
+        return get_write_buffer().record_mo(payload)
+    return SMSMessage.get_or_create_mo_from_payload(payload)
 
-    def failure(code, text, msg=None):
-        payload = {
-            'status': 'error',
-            'reason': text
-        }
-        if msg is not None:
-            payload.update({'message_id': msg.suuid})
-        return JsonResponse(payload, status=code)
 
-    try:
-        payload = jsonloads(request.body)['deliveryInfoNotification']
-        msg = SMSMessage.record_dr_from_payload(payload)
-    except:
-        return failure(400, "Incorrect JSON payload")
+def record_smsdr(payload):
+    payload = payload['deliveryInfoNotification']
+    if get_config('write_behind'):
+        get_write_buffer().record_dr(payload)
+        return None, True
+    return SMSMessage.record_dr_from_payload(payload), True
 
-    try:
-        handle_smsdr(msg)
-    except Exception as e:
-        error_text = "Exception in SMS-DR processing #{}".format(msg.suuid)
-        logger.error(error_text)
-        logger.exception(e)
-        return failure(500, error_text, msg)
 
-    return JsonResponse({'status': 'success',
-                         'message_id': msg.suuid}, status=200)
+@csrf_exempt
+@require_POST
+def smsmo(request, **options):
+    return process_notification(request, 'smsmo', "SMS-MO", record_smsmo)
+
+
+@csrf_exempt
+@require_POST
+def smsdr(request, **options):
+    return process_notification(request, 'smsdr', "SMS-DR", record_smsdr)
@@ -0,0 +1,90 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# vim: ai ts=4 sts=4 et sw=4 nu
+
+''' In-process thread pools used to defer work without a broker '''
+
+from __future__ import (unicode_literals, absolute_import,
+                        division, print_function)
+
+import os
+import atexit
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from django.db import close_old_connections
+
+from orangeapisms.config import get_config
+
+logger = logging.getLogger(__name__)
+
+
+class BoundedExecutor(object):
+    ''' ThreadPoolExecutor accepting at most queue_size waiting tasks
+
+        submit() blocks once max_workers + queue_size tasks are pending '''
+
+    def __init__(self, max_workers, queue_size):
+        self.max_workers = max_workers
+        self.queue_size = queue_size
+        self.executor = ThreadPoolExecutor(max_workers=max_workers)
+        self.slots = threading.BoundedSemaphore(max_workers + queue_size)
+
+    def submit(self, fn, *args, **kwargs):
+        self.slots.acquire()
+        return self.submit_reserved(fn, *args, **kwargs)
+
+    def reserve(self):
+        ''' reserve a slot for submit_reserved(). False if saturated '''
+        return self.slots.acquire(False)
+
+    def cancel(self):
+        ''' release a reserved slot which won't be used '''
+        self.slots.release()
+
+    def submit_reserved(self, fn, *args, **kwargs):
+        try:
+            future = self.executor.submit(self.run, fn, *args, **kwargs)
+        except Exception:
+            self.slots.release()
+            raise
+        future.add_done_callback(lambda future: self.slots.release())
+        return future
+
+    @staticmethod
+    def run(fn, *args, **kwargs):
+        try:
+            return fn(*args, **kwargs)
+        finally:
+            # worker threads get their own DB connection ; don't leak it
+            close_old_connections()
+
+    def shutdown(self, wait=True):
+        ''' stop accepting tasks, waiting for pending ones if wait '''
+        self.executor.shutdown(wait=wait)
+
+
+_lock = threading.Lock()
+_executors = {}
+
+
+def get_executor(name, max_workers, queue_size):
+    ''' process-wide named BoundedExecutor, drained on interpreter exit '''
+    key = (name, os.getpid())
+    executor = _executors.get(key)
+    if executor is not None:
+        return executor
+    with _lock:
+        if key not in _executors:
+            executor = BoundedExecutor(max_workers, queue_size)
+            atexit.register(executor.shutdown, True)
+            _executors[key] = executor
+    return _executors[key]
+
+
+def get_send_executor():
+    ''' executor for the `thread` send_async_backend '''
+    return get_executor('send',
+                        max_workers=get_config('send_async_workers'),
+                        queue_size=get_config('send_async_queue_size'))
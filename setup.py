@@ -4,9 +4,25 @@
 
 """ Allow any django app to handle SMS-MO, SMS-MT using the Orange API. """
 
+import sys
 from codecs import open
 
 from setuptools import setup, find_packages
+from setuptools.command.build_py import build_py
+
+
+class BuildPy(build_py):
+    ''' leave out Python 3.5+ only modules when installing on Python 2 '''
+
+    PY3_ONLY = [('orangeapisms.aio', 'client')]
+
+    def find_package_modules(self, package, package_dir):
+        modules = build_py.find_package_modules(self, package, package_dir)
+        if sys.version_info >= (3, 5):
+            return modules
+        return [module for module in modules
+                if module[:2] not in self.PY3_ONLY]
+
 
 with open('README.rst', 'r', 'utf-8') as f:
     readme = f.read()
@@ -35,7 +51,12 @@ setup(
         'requests == 2.12.1',
         'simplejson == 3.10.0',
         'py3compat >= 0.3',
+        'futures >= 3.0; python_version < "3.0"',
     ],
+    extras_require={
+        # asyncio client (orangeapisms.aio), Python 3.5+ only
+        'async': ['aiohttp >= 3.3; python_version >= "3.5"'],
+    },
     classifiers=[
         'Development Status :: 4 - Beta',
         'Intended Audience :: Developers',
@@ -45,6 +66,7 @@ setup(
         'Programming Language :: Python :: 2.7',
         'Programming Language :: Python :: 3.5',
     ],
+    cmdclass={'build_py': BuildPy},
     setup_requires=[
         'pytest-runner',
     ],